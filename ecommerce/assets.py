@@ -0,0 +1,186 @@
+"""
+Static assets: self-hosted vendor files, fingerprinting and compression.
+
+Bootstrap and bootstrap-icons are served from ``ecommerce/static/vendor/``.
+``manage.py vendor_assets`` downloads the versions in ``VENDOR_ASSETS`` and
+only writes a file whose SHA-384 matches the hash pinned there; files are
+kept byte for byte as released so the pins stay checkable, and
+``collectstatic`` refuses local copies that do not match. Until a file is
+there, pages link its CDN copy, with its integrity hash when one is pinned.
+
+``CompressedManifestStaticFilesStorage`` is Django's manifest storage, which
+names every collected file after a hash of its content, plus a ``.gz`` (and,
+with the optional ``brotli`` package, ``.br``) copy of each text file written
+by ``collectstatic``. ``serve`` hands those out from ``STATIC_ROOT`` with
+far-future cache headers when no web server sits in front of Django.
+"""
+import base64
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, StaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+from django.templatetags.static import static
+from django.http import FileResponse, Http404
+from django.utils.cache import patch_vary_headers
+from django.views import static as static_views
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Local static path: (download URL, pinned SHA-384 in subresource-integrity
+# form, or None until it has been checked against the release).
+VENDOR_ASSETS = {
+    'vendor/bootstrap/bootstrap.min.css': (
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.7/dist/css/bootstrap.min.css',
+        'sha384-LN+7fdVzj6u52u30Kp6M/trliBMCMKTyK833zpbD+pXdCLuTusPj697FH4R/5mcr',
+    ),
+    'vendor/bootstrap/bootstrap.bundle.min.js': (
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.7/dist/js/bootstrap.bundle.min.js',
+        'sha384-ndDqU0Gzau9qJ1lfW4pNLlhNTkCfHzAVBReH9diLvGRem5+R9g2FzA8ZGN954O5Q',
+    ),
+    'vendor/bootstrap-icons/bootstrap-icons.min.css': (
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.13.1/font/bootstrap-icons.min.css', None,
+    ),
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff2': (
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.13.1/font/fonts/bootstrap-icons.woff2', None,
+    ),
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff': (
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.13.1/font/fonts/bootstrap-icons.woff', None,
+    ),
+}
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map', '.html')
+MIN_COMPRESS_SIZE = 256
+IMMUTABLE = 'public, max-age=31536000, immutable'
+ACCEPTS = {'br': re.compile(r'\bbr\b'), 'gzip': re.compile(r'\bgzip\b')}
+
+
+def integrity(body, algorithm='sha384'):
+    """``body``'s hash in subresource-integrity form."""
+    return f'{algorithm}-' + base64.b64encode(hashlib.new(algorithm, body).digest()).decode()
+
+
+@lru_cache(maxsize=None)
+def is_local(path):
+    """Whether a static file is available to serve ourselves."""
+    return finders.find(path) is not None
+
+
+def asset(path):
+    """Return (url, integrity) for a static path, using the CDN for vendor files not downloaded yet."""
+    if path in VENDOR_ASSETS and not is_local(path):
+        url, pinned = VENDOR_ASSETS[path]
+        return url, pinned or ''
+    return static(path), ''
+
+
+def check_vendor_files():
+    """Return ([missing paths], [(path, problem)]) for the local vendor files."""
+    missing, problems = [], []
+    for path, (_, pinned) in VENDOR_ASSETS.items():
+        found = finders.find(path)
+        if found is None:
+            missing.append(path)
+            continue
+        with open(found, 'rb') as f:
+            actual = integrity(f.read(), pinned.split('-', 1)[0] if pinned else 'sha384')
+        if pinned is None:
+            problems.append((path, f'no hash is pinned; it is {actual}'))
+        elif actual != pinned:
+            problems.append((path, f'does not match its pinned hash; it is {actual}'))
+    return missing, problems
+
+
+@lru_cache(maxsize=None)
+def read_text(path):
+    """Contents of a static file, for inlining."""
+    found = finders.find(path)
+    if found is None:
+        return ''
+    with open(found, encoding='utf-8') as f:
+        return f.read()
+
+
+def compress(data):
+    """Return {suffix: bytes} of the encodings that make ``data`` smaller."""
+    encoded = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded['.br'] = brotli.compress(data)
+    return {suffix: body for suffix, body in encoded.items() if len(body) < len(data)}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # Vendor files keep their sourceMappingURL comments so they match their
+    # pins; the maps are not shipped, so those references are left alone.
+    patterns = tuple(
+        (extension, tuple(pattern for pattern in group if 'sourceMappingURL' not in str(pattern)))
+        for extension, group in ManifestStaticFilesStorage.patterns
+    )
+
+    def url(self, name, force=False):
+        try:
+            return super().url(name, force)
+        except ValueError:
+            # Not collected yet (tests, a fresh checkout): the plain name.
+            return StaticFilesStorage.url(self, name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in set(self.hashed_files.values()):
+            if name.endswith(COMPRESSIBLE) and self.exists(name):
+                self.write_compressed(name)
+
+    def write_compressed(self, name):
+        with self.open(name) as f:
+            data = f.read()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return
+        for suffix, body in compress(data).items():
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            self._save(name + suffix, ContentFile(body))
+
+
+@lru_cache(maxsize=1)
+def _fingerprinted(manifest_hash):
+    return frozenset(getattr(staticfiles_storage, 'hashed_files', {}).values())
+
+
+def serve(request, path):
+    """Serve a collected static file, precompressed and cached forever when its name is hashed."""
+    if not settings.STATIC_ROOT:
+        raise Http404('STATIC_ROOT is not set.')
+    name = path.lstrip('/')
+    if name not in _fingerprinted(getattr(staticfiles_storage, 'manifest_hash', '')):
+        response = static_views.serve(request, name, document_root=settings.STATIC_ROOT)
+        response['Cache-Control'] = 'no-cache'
+        return response
+    full_path = os.path.join(settings.STATIC_ROOT, name)
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    accept = request.headers.get('Accept-Encoding', '')
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if ACCEPTS[encoding].search(accept) and os.path.exists(full_path + suffix):
+            response = FileResponse(open(full_path + suffix, 'rb'), content_type=content_type)
+            response['Content-Encoding'] = encoding
+            break
+    if response is None:
+        if not os.path.exists(full_path):
+            raise Http404(name)
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+    # FileResponse names the file it read, which may be the .gz copy.
+    del response['Content-Disposition']
+    response['Cache-Control'] = IMMUTABLE
+    if name.endswith(COMPRESSIBLE):
+        patch_vary_headers(response, ['Accept-Encoding'])
+    return response
@@ -0,0 +1,371 @@
+"""
+End-to-end benchmark of the shopping funnel.
+
+Each iteration walks the real URL conf with the Django test client: browse,
+filter, search, product detail, add to cart, increment/decrement, checkout
+session creation, the Stripe webhook and the payment success page, with
+Stripe replaced by ``ecommerce.stripe_stub.FakeStripe``. Every step records wall-clock latency
+and the number of SQL queries; ``summarize`` turns those samples into
+p50/p95/p99, median query count and throughput, and ``compare`` checks a
+summary against a stored baseline.
+
+Run it with ``python manage.py run_benchmarks``. ``ReservationStress`` is a
+separate concurrency test of stock reservations, run by
+``python manage.py stress_reservations``. ``MixedLoadBenchmark`` compares
+SQLite connection profiles under concurrent reads and writes, run by
+``python manage.py benchmark_db_profile``.
+"""
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import F
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from . import reservations
+from .models import Customer, Order, OrderItem, Product, StockHold
+from .stripe_stub import FakeStripe
+
+BENCHMARK_USERNAME = 'benchmark-shopper'
+# Each iteration buys one unit; skip products that a run could sell out.
+BENCHMARK_STOCK = 10
+WEBHOOK_SECRET = 'whsec_benchmark'
+
+
+class StepFailed(Exception):
+    pass
+
+
+class FunnelBenchmark:
+    def __init__(self, iterations=50, warmup=5):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.recording = True
+        self.samples = {}
+
+    def setup(self):
+        user = User.objects.filter(username=BENCHMARK_USERNAME).first()
+        if user is None:
+            user = User.objects.create_user(BENCHMARK_USERNAME, password='benchmark')
+        self.customer, _ = Customer.objects.get_or_create(user=user, defaults={'phone': '5550100'})
+        self.anonymous = Client()
+        self.shopper = Client()
+        self.shopper.force_login(user)
+        # A fixed sample keeps runs comparable with each other.
+        self.products = list(Product.objects.filter(stock__gte=BENCHMARK_STOCK).order_by('pk').values_list('pk', 'name', 'category', 'brand')[:100])
+        if not self.products:
+            raise StepFailed('No products to benchmark; run generate_fake_data first.')
+
+    def measure(self, name, request, expected_status=(200,)):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = request()
+            elapsed = time.perf_counter() - started
+        if response.status_code not in expected_status:
+            raise StepFailed(f'{name} returned {response.status_code}')
+        if self.recording:
+            self.samples.setdefault(name, []).append((elapsed, len(queries)))
+        return response
+
+    def iteration(self, i, fake_stripe):
+        pk, name, category, brand = self.products[i % len(self.products)]
+        catalogue = reverse('ecommerce:product_list')
+        self.measure('product_list (anonymous)', lambda: self.anonymous.get(catalogue))
+        self.measure('product_list', lambda: self.shopper.get(catalogue))
+        self.measure('product_list (filter)',
+                     lambda: self.shopper.get(catalogue, {'category': category, 'brand': brand}))
+        self.measure('product_list (search)', lambda: self.shopper.get(catalogue, {'search': name.split()[0]}))
+        self.measure('product_detail', lambda: self.shopper.get(reverse('ecommerce:product_detail', args=[pk])))
+        self.measure('add_to_cart', lambda: self.shopper.post(reverse('ecommerce:add_to_cart', args=[pk])), (302,))
+        self.measure('increment_cart_item',
+                     lambda: self.shopper.post(reverse('ecommerce:increment_cart_item', args=[pk])), (302,))
+        self.measure('decrement_cart_item',
+                     lambda: self.shopper.post(reverse('ecommerce:decrement_cart_item', args=[pk])), (302,))
+        self.measure('view_cart', lambda: self.shopper.get(reverse('ecommerce:view_cart')))
+        self.measure('create_checkout_session',
+                     lambda: self.shopper.post(reverse('ecommerce:create_checkout_session')), (302,))
+        session_id = fake_stripe.last_session['id']
+        fake_stripe.complete(session_id)
+        self.measure('stripe_webhook',
+                     lambda: fake_stripe.send_webhook(self.anonymous, session_id, WEBHOOK_SECRET))
+        self.measure('payment_success',
+                     lambda: self.shopper.get(reverse('ecommerce:payment_success'), {'session_id': session_id}))
+
+    def run(self):
+        cache.clear()
+        self.setup()
+        self.samples = {}
+        # Fulfil inline so the success page finds the order the webhook built.
+        with FakeStripe() as fake_stripe, override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+                                                            ECOMMERCE_FULFILMENT='inline'):
+            for i in range(self.warmup + self.iterations):
+                self.recording = i >= self.warmup
+                self.iteration(i, fake_stripe)
+        return summarize(self.samples)
+
+
+def _percentiles(values):
+    if len(values) < 2:
+        return values * 3
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return cuts[49], cuts[94], cuts[98]
+
+
+def summarize(samples):
+    """Return {step: {'p50_ms', 'p95_ms', 'p99_ms', 'queries', 'throughput'}}."""
+    summary = {}
+    for name, measurements in samples.items():
+        latencies = [elapsed for elapsed, _ in measurements]
+        p50, p95, p99 = _percentiles(latencies)
+        summary[name] = {
+            'p50_ms': round(p50 * 1000, 3),
+            'p95_ms': round(p95 * 1000, 3),
+            'p99_ms': round(p99 * 1000, 3),
+            'queries': statistics.median_low(queries for _, queries in measurements),
+            'throughput': round(len(latencies) / sum(latencies), 1),
+        }
+    return summary
+
+
+def compare(summary, baseline, tolerance=0.2):
+    """
+    Return a list of regression messages.
+
+    A step regresses when its p95 latency exceeds the baseline by more than
+    ``tolerance`` (a fraction) or when it issues more queries.
+    """
+    regressions = []
+    for name, result in summary.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result['queries'] > before['queries']:
+            regressions.append(f"{name}: queries {before['queries']} -> {result['queries']}")
+    return regressions
+
+
+class ReservationStress:
+    """
+    Threads reserving one hot product at the same time, each on its own
+    database connection. ``run`` reports throughput and checks that no more
+    units were reserved than were in stock and that shards plus holds still
+    add up to the stock.
+    """
+
+    def __init__(self, workers=8, attempts=50, stock=100, quantity=1, lock_retries=50):
+        self.workers = workers
+        self.attempts = attempts
+        self.stock = stock
+        self.quantity = quantity
+        self.lock_retries = lock_retries
+
+    def reserve(self, customer, product_id):
+        # SQLite allows one writer at a time and reports the rest as locked;
+        # server databases only block on the row (shard) actually contended.
+        for retry in range(self.lock_retries + 1):
+            try:
+                reservations.reserve(customer, {product_id: self.quantity})
+                return 'reserved', retry
+            except reservations.OutOfStock:
+                return 'rejected', retry
+            except OperationalError:
+                time.sleep(random.uniform(0.001, 0.005))
+        return 'failed', self.lock_retries
+
+    def run(self):
+        """Run the workers and return the report; the product and shopper it creates are deleted afterwards."""
+        user = User.objects.filter(username=BENCHMARK_USERNAME).first()
+        created_user = user is None
+        if created_user:
+            user = User.objects.create_user(BENCHMARK_USERNAME, password='benchmark')
+        product = None
+        try:
+            customer, _ = Customer.objects.get_or_create(user=user)
+            product = Product.objects.create(name='Stress test product', brand='Bench', category='Bench',
+                                             description='', price='1.00', stock=self.stock)
+            return self._run(customer, product)
+        finally:
+            # With --use-existing-db this is the real database.
+            if product is not None:
+                product.delete()
+            if created_user:
+                user.delete()
+
+    def _run(self, customer, product):
+        counts = {'reserved': 0, 'rejected': 0, 'failed': 0, 'lock_retries': 0}
+        lock = threading.Lock()
+        barrier = threading.Barrier(self.workers)
+
+        def worker():
+            try:
+                barrier.wait()
+                for _ in range(self.attempts):
+                    outcome, retries = self.reserve(customer, product.pk)
+                    with lock:
+                        counts[outcome] += 1
+                        counts['lock_retries'] += retries
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        held = StockHold.objects.filter(product=product).values_list('quantity', flat=True)
+        held = sum(held)
+        left = reservations.available([product.pk])[product.pk]
+        attempts = self.workers * self.attempts
+        return dict(
+            counts,
+            attempts=attempts,
+            seconds=round(elapsed, 3),
+            throughput=round(attempts / elapsed, 1),
+            units_reserved=held,
+            units_left=left,
+            oversold=max(held - self.stock, 0),
+            consistent=held + left == self.stock and held == counts['reserved'] * self.quantity,
+        )
+
+
+class MixedLoadBenchmark:
+    """
+    Threads mixing catalogue reads with order writes against a fresh SQLite
+    file, once per connection profile.
+
+    ``basic`` is Django's default: a new connection per request, deferred
+    transactions, rollback journal. ``production`` is the profile from
+    settings: persistent connections, ``BEGIN IMMEDIATE`` and
+    ``ECOMMERCE_SQLITE_PRAGMAS`` (see ``ecommerce.dbprofile``). Each operation
+    ends like a request does, with ``close_if_unusable_or_obsolete``.
+    """
+
+    MODELS = (User, Customer, Product, Order, OrderItem)
+
+    def __init__(self, workers=8, operations=200, write_ratio=0.2, products=2000):
+        self.workers = workers
+        self.operations = operations
+        self.write_ratio = write_ratio
+        self.products = products
+
+    def profiles(self):
+        from django.conf import settings
+
+        default = settings.DATABASES['default']
+        return {
+            'basic': ({'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False, 'OPTIONS': {}}, {}),
+            'production': (
+                {
+                    'CONN_MAX_AGE': default.get('CONN_MAX_AGE') or 600,
+                    'CONN_HEALTH_CHECKS': True,
+                    'OPTIONS': default.get('OPTIONS') or {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+                },
+                settings.ECOMMERCE_SQLITE_PRAGMAS or {'journal_mode': 'wal', 'synchronous': 'normal'},
+            ),
+        }
+
+    def setup(self, alias):
+        with connections[alias].schema_editor() as editor:
+            for model in self.MODELS:
+                editor.create_model(model)
+        # Ids rather than instances: the router sends every new object to the primary.
+        user = User.objects.db_manager(alias).create(username=BENCHMARK_USERNAME)
+        self.customer_id = Customer.objects.using(alias).create(user_id=user.pk).pk
+        Product.objects.using(alias).bulk_create([
+            Product(name=f'Product {i}', brand=f'Brand {i % 20}', category=f'Category {i % 10}',
+                    description='', price='9.99', stock=1000000)
+            for i in range(self.products)
+        ], batch_size=1000)
+        self.product_ids = list(Product.objects.using(alias).values_list('pk', flat=True))
+
+    def read(self, alias, rng):
+        products = Product.objects.using(alias)
+        list(products.filter(category=f'Category {rng.randrange(10)}').order_by('pk')[:20])
+        products.get(pk=rng.choice(self.product_ids))
+
+    def write(self, alias, rng):
+        pk = rng.choice(self.product_ids)
+        with transaction.atomic(using=alias):
+            product = Product.objects.using(alias).get(pk=pk)
+            order = Order.objects.using(alias).create(customer_id=self.customer_id, total=product.price, status='Paid')
+            OrderItem.objects.using(alias).create(order_id=order.pk, product_id=pk, quantity=1, price=product.price)
+            Product.objects.using(alias).filter(pk=pk).update(stock=F('stock') - 1)
+
+    def run_profile(self, name, database, pragmas):
+        from django.conf import settings
+
+        directory = Path(tempfile.mkdtemp())
+        alias = f'benchmark_{name}'
+        connections.settings[alias] = {
+            **connections['default'].settings_dict, **database,
+            'NAME': str(directory / 'db.sqlite3'), 'TEST': {'MIRROR': None},
+        }
+        latencies, errors = [], []
+        lock = threading.Lock()
+        barrier = threading.Barrier(self.workers)
+        try:
+            with override_settings(ECOMMERCE_SQLITE_PRAGMAS=pragmas):
+                self.setup(alias)
+                connections[alias].close()
+
+                def worker(seed):
+                    rng = random.Random(seed)
+                    mine, failed = [], 0
+                    try:
+                        barrier.wait()
+                        for _ in range(self.operations):
+                            started = time.perf_counter()
+                            try:
+                                if rng.random() < self.write_ratio:
+                                    self.write(alias, rng)
+                                else:
+                                    self.read(alias, rng)
+                                mine.append(time.perf_counter() - started)
+                            except OperationalError:
+                                failed += 1
+                            connections[alias].close_if_unusable_or_obsolete()
+                    finally:
+                        connections[alias].close()
+                        with lock:
+                            latencies.extend(mine)
+                            errors.append(failed)
+
+                threads = [threading.Thread(target=worker, args=(i,)) for i in range(self.workers)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - started
+        finally:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+            shutil.rmtree(directory, ignore_errors=True)
+        _, p95, _ = _percentiles(latencies or [0.0])
+        return {
+            'operations': len(latencies),
+            'errors': sum(errors),
+            'seconds': round(elapsed, 3),
+            'ops_per_sec': round(len(latencies) / elapsed, 1),
+            'p95_ms': round(p95 * 1000, 3),
+        }
+
+    def run(self):
+        """Return {profile: {'operations', 'errors', 'seconds', 'ops_per_sec', 'p95_ms'}}."""
+        return {name: self.run_profile(name, database, pragmas)
+                for name, (database, pragmas) in self.profiles().items()}
@@ -0,0 +1,225 @@
+"""
+Rendered-output caching for the catalogue.
+
+Three layers, all keyed on catalogue versions (see ``ecommerce.catalogue``)
+so Product signals invalidate them by bumping a counter:
+
+* product cards, one entry per product and product version;
+* arbitrary fragments such as the catalogue filter form, keyed on the
+  catalogue generation plus whatever the fragment varies on;
+* whole pages for anonymous visitors, via ``cache_anonymous_page``. Pages
+  are keyed on the path and the query parameters the view declares it
+  reads; others are dropped from the request before the view runs, so
+  made-up query strings cannot fill the cache with copies of a page.
+  CSRF tokens in forms are blanked before a page is stored and filled in
+  with the visitor's own token whenever it is served.
+
+``conditional_page`` sits in front of the page cache. It gives anonymous pages
+an ETag built from the same version and a Last-Modified, and answers a
+matching ``If-None-Match``/``If-Modified-Since`` with 304 before the view
+runs. Its Cache-Control/Vary headers let a reverse proxy keep anonymous pages
+for ``ECOMMERCE_SHARED_CACHE_SECONDS`` and revalidate them after that, except
+a page that hands a first-time visitor a new CSRF cookie, which is private.
+
+Both render cacheable pages with ``routing.primary_reads()``, so what is
+stored or ETagged under a version never comes from a lagging replica.
+
+Only the Django cache API is used, so any backend works. With more than one
+worker process use a shared backend (file-based or better), otherwise an
+invalidation only reaches the worker that handled the write.
+
+Hits and misses are counted per worker process and reported by ``get_stats``.
+"""
+import hashlib
+import re
+import threading
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse, QueryDict
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
+
+from . import catalogue, routing
+
+FRAGMENT_TIMEOUT = 60 * 60 * 24
+PAGE_TIMEOUT = 60 * 60
+
+# The hidden input {% csrf_token %} renders.
+CSRF_INPUT = re.compile(rb'(<input type="hidden" name="csrfmiddlewaretoken" value=")[^"]*(")')
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _record(layer, hits=0, misses=0):
+    with _stats_lock:
+        _stats[layer, 'hits'] += hits
+        _stats[layer, 'misses'] += misses
+
+
+def get_stats():
+    """Return {layer: {'hits': n, 'misses': n}} for this process."""
+    with _stats_lock:
+        stats = {}
+        for (layer, outcome), count in _stats.items():
+            stats.setdefault(layer, {'hits': 0, 'misses': 0})[outcome] = count
+        return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _digest(*parts):
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def product_cards(products, template_name='ecommerce/includes/product_card.html'):
+    """Return the rendered card of each product, rendering only cache misses."""
+    products = list(products)
+    versions = catalogue.get_product_versions([product.pk for product in products])
+    keys = [f'fragment:product_card:{product.pk}:{versions[product.pk]}' for product in products]
+    cached = cache.get_many(keys)
+    rendered = {}
+    cards = []
+    for product, key in zip(products, keys):
+        html = cached.get(key)
+        if html is None:
+            html = render_to_string(template_name, {'product': product})
+            rendered[key] = html
+        cards.append(mark_safe(html))
+    if rendered:
+        cache.set_many(rendered, FRAGMENT_TIMEOUT)
+    _record('product_card', hits=len(products) - len(rendered), misses=len(rendered))
+    return cards
+
+
+def cached_fragment(name, vary_on, render):
+    """Return render() output cached per catalogue generation and vary_on."""
+    key = f'fragment:{name}:' + _digest(catalogue.get_generation(), *vary_on)
+    html = cache.get(key)
+    if html is None:
+        _record(name, misses=1)
+        html = render()
+        cache.set(key, html, FRAGMENT_TIMEOUT)
+    else:
+        _record(name, hits=1)
+    return mark_safe(html)
+
+
+def _cacheable(request):
+    if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+        return False
+    # A page carrying a flash message is specific to this visitor.
+    return len(messages.get_messages(request)) == 0
+
+
+def _normalise_query(request, query):
+    """Keep only the non-empty ``query`` parameters (last value of each); return the page's path."""
+    kept = QueryDict(mutable=True)
+    for name in query:
+        value = request.GET.get(name, '')
+        if value:
+            kept[name] = value
+    kept._mutable = False
+    request.GET = kept
+    return request.path + ('?' + kept.urlencode() if kept else '')
+
+
+def _with_csrf_token(request, content):
+    if CSRF_INPUT.search(content) is None:
+        return content
+    token = get_token(request).encode()
+    return CSRF_INPUT.sub(lambda match: match[1] + token + match[2], content)
+
+
+def cache_anonymous_page(version, query=()):
+    """
+    Cache successful anonymous responses of a view, with their headers.
+
+    ``version(request, *args, **kwargs)`` returns the catalogue version the
+    page depends on; bumping it invalidates the page. ``query`` names the
+    GET parameters the view reads; the view only sees those.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not _cacheable(request):
+                return view(request, *args, **kwargs)
+            path = _normalise_query(request, query)
+            key = 'page:' + _digest(view.__module__, view.__name__, version(request, *args, **kwargs), path)
+            cached = cache.get(key)
+            if cached is not None:
+                _record('page', hits=1)
+                content, headers = cached
+                response = HttpResponse(_with_csrf_token(request, content))
+                for name, value in headers.items():
+                    response[name] = value
+                response['X-Cache'] = 'HIT'
+                return response
+            _record('page', misses=1)
+            with routing.primary_reads():
+                response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                # Cookies are kept apart from the headers, so none are stored.
+                content = CSRF_INPUT.sub(rb'\1\2', response.content)
+                cache.set(key, (content, dict(response.items())), PAGE_TIMEOUT)
+                response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def conditional_page(version, last_modified, query=()):
+    """
+    Answer conditional GETs of anonymous visitors without running the view.
+
+    ``version`` and ``query`` are as for ``cache_anonymous_page``; ``last_modified(request,
+    *args, **kwargs)`` returns an aware datetime, a Unix time or None. Pages
+    for signed-in visitors, or carrying a flash message, are marked private.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not _cacheable(request):
+                response = view(request, *args, **kwargs)
+                patch_cache_control(response, private=True, max_age=0)
+                patch_vary_headers(response, ['Cookie'])
+                return response
+            path = _normalise_query(request, query)
+            etag = 'W/"%s"' % _digest(view.__module__, view.__name__, version(request, *args, **kwargs), path)
+            modified = last_modified(request, *args, **kwargs)
+            if modified is not None and not isinstance(modified, (int, float)):
+                modified = modified.timestamp()
+            modified = int(modified) if modified is not None else None
+            response = get_conditional_response(request, etag=etag, last_modified=modified)
+            if response is not None:
+                _record('conditional', hits=1)
+            else:
+                _record('conditional', misses=1)
+                with routing.primary_reads():
+                    response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            response['ETag'] = etag
+            if modified is not None:
+                response['Last-Modified'] = http_date(modified)
+            if request.META.get('CSRF_COOKIE_NEEDS_UPDATE') and settings.CSRF_COOKIE_NAME not in request.COOKIES:
+                # The page's token only works with the cookie set for this visitor.
+                patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+            else:
+                patch_cache_control(response, public=True, max_age=0, must_revalidate=True,
+                                    s_maxage=settings.ECOMMERCE_SHARED_CACHE_SECONDS)
+            # Signed-in visitors get a different page at the same URL.
+            patch_vary_headers(response, ['Cookie'])
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,152 @@
+"""
+Batched, atomic cart mutations.
+
+``apply_operations`` takes a list of operations::
+
+    {'op': 'add', 'product': 12, 'quantity': 2}   # quantity may be negative
+    {'op': 'set', 'product': 12, 'quantity': 5}   # 0 removes the line
+    {'op': 'remove', 'product': 12}
+
+and applies the whole batch in one transaction with a fixed number of
+statements: quantities are changed by ``UPDATE ... SET quantity = quantity +
+n`` rather than read-modify-write in Python, so concurrent requests cannot
+lose each other's updates, and missing lines are inserted against the unique
+(cart, product) constraint so two racing inserts cannot create duplicates.
+A line holds at most ``MAX_QUANTITY``; larger requested quantities are
+refused and adds beyond it stop at it.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product
+
+OPERATIONS = ('add', 'set', 'remove')
+MAX_OPERATIONS = 500
+MAX_QUANTITY = 10_000
+# Largest value SQLite (and a bigint column) can store.
+MAX_ID = 2 ** 63 - 1
+
+
+class CartOperationError(ValueError):
+    pass
+
+
+def _int(value, field, limit):
+    if isinstance(value, bool):
+        raise CartOperationError(f'{field} must be an integer.')
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise CartOperationError(f'{field} must be an integer.')
+    if abs(value) > limit:
+        raise CartOperationError(f'{field} must be at most {limit}.')
+    return value
+
+
+def reduce_operations(operations):
+    """
+    Validate operations and fold them, in order, into one change per product.
+
+    Returns {product id: (absolute, delta)}: the line ends at ``absolute +
+    delta`` when ``absolute`` is set, otherwise its current quantity moves by
+    ``delta``.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise CartOperationError('operations must be a non-empty list.')
+    if len(operations) > MAX_OPERATIONS:
+        raise CartOperationError(f'At most {MAX_OPERATIONS} operations per request.')
+    changes = {}
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+            raise CartOperationError(f'Each operation needs an op of {", ".join(OPERATIONS)}.')
+        product_id = _int(operation.get('product'), 'product', MAX_ID)
+        absolute, delta = changes.get(product_id, (None, 0))
+        if operation['op'] == 'add':
+            delta += _int(operation.get('quantity', 1), 'quantity', MAX_QUANTITY)
+            if abs((absolute or 0) + delta) > MAX_QUANTITY:
+                raise CartOperationError(f'quantity must be at most {MAX_QUANTITY}.')
+        elif operation['op'] == 'set':
+            quantity = _int(operation.get('quantity'), 'quantity', MAX_QUANTITY)
+            if quantity < 0:
+                raise CartOperationError('quantity cannot be negative.')
+            absolute, delta = quantity, 0
+        else:
+            absolute, delta = 0, 0
+        changes[product_id] = (absolute, delta)
+    return changes
+
+
+def apply_operations(cart, operations):
+    changes = reduce_operations(operations)
+    product_ids = list(changes)
+    with transaction.atomic():
+        known = set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+        unknown = sorted(set(product_ids) - known)
+        if unknown:
+            raise CartOperationError(f'Unknown product: {unknown[0]}.')
+
+        absolutes = {pk: max(absolute + delta, 0) for pk, (absolute, delta) in changes.items() if absolute is not None}
+        deltas = {pk: delta for pk, (absolute, delta) in changes.items() if absolute is None and delta}
+        grows = [pk for pk, quantity in absolutes.items() if quantity > 0] + [pk for pk, d in deltas.items() if d > 0]
+        if grows:
+            # Placeholder lines; ignore_conflicts leaves existing lines alone.
+            CartItem.objects.bulk_create(
+                [CartItem(cart=cart, product_id=pk, quantity=0) for pk in grows], ignore_conflicts=True,
+            )
+        items = CartItem.objects.filter(cart=cart)
+        if absolutes:
+            items.filter(product_id__in=absolutes).update(quantity=Case(
+                *[When(product_id=pk, then=Value(quantity)) for pk, quantity in absolutes.items()],
+                output_field=IntegerField(),
+            ))
+        if deltas:
+            items.filter(product_id__in=deltas).update(quantity=Least(Greatest(
+                F('quantity') + Case(
+                    *[When(product_id=pk, then=Value(delta)) for pk, delta in deltas.items()],
+                    output_field=IntegerField(),
+                ),
+                Value(0),
+            ), Value(MAX_QUANTITY)))
+        items.filter(product_id__in=product_ids, quantity=0).delete()
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now())
+
+
+def sync_cart(cart, quantities):
+    """Make the cart's lines exactly ``quantities`` ({product id: quantity})."""
+    with transaction.atomic():
+        CartItem.objects.filter(cart=cart).exclude(product_id__in=list(quantities)).delete()
+        if quantities:
+            CartItem.objects.bulk_create(
+                [CartItem(cart=cart, product_id=pk, quantity=quantity) for pk, quantity in quantities.items()],
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity'],
+            )
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now())
+
+
+def lines_state(lines, cart_id=None):
+    """Return (product, quantity) pairs as a JSON-serialisable cart dict."""
+    items = []
+    subtotal = Decimal('0.00')
+    for product, quantity in lines:
+        line_total = product.price * quantity
+        subtotal += line_total
+        items.append({
+            'product': product.pk,
+            'name': product.name,
+            'price': str(product.price),
+            'quantity': quantity,
+            'total': str(line_total),
+        })
+    return {
+        'cart': cart_id,
+        'items': items,
+        'count': sum(item['quantity'] for item in items),
+        'subtotal': str(subtotal),
+    }
+
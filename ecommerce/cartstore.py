@@ -0,0 +1,269 @@
+"""
+Cache-backed cart store with write-behind persistence.
+
+A signed-in shopper's active cart lives in the Django cache as
+``{'items': [[product id, quantity], ...], 'dirty': bool, ...}``; reads and
+changes are served from there, and the ``Cart``/``CartItem`` tables are only
+written when the cart is flushed:
+
+* at checkout, before the Stripe session is built from the tables;
+* on a timer: a change made ``FLUSH_INTERVAL`` seconds or more after the last
+  flush writes through, and ``manage.py flush_carts`` flushes every dirty cart;
+* on logout.
+
+Anonymous visitors keep their cart in the session; it is merged into the
+shopper's cart when they log in.
+
+The trade-off is durability: changes made since the last flush live only in
+the cache, so use a persistent shared cache in production and run
+``flush_carts`` from cron. Changes to one cart are serialised with a lock
+taken through ``cache.add``, which is only atomic between processes on
+memcached, Redis and the database cache; on the file-based cache two
+processes can both take it.
+"""
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .cart import MAX_QUANTITY, CartOperationError, lines_state, reduce_operations, sync_cart
+from .models import Cart, Customer, Product
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 30
+CART_TIMEOUT = 60 * 60 * 24 * 7
+LOCK_TIMEOUT = 5
+SESSION_KEY = 'cart'
+CART_KEY = 'cartstore:user:{}'
+# One marker per cart with unsaved changes, so marking needs no shared set.
+DIRTY_KEY = 'cartstore:dirty:{}'
+# Users whose markers are read per cache.get_many() call.
+SCAN_BATCH = 1000
+
+
+def _empty():
+    return {'items': [], 'dirty': False, 'flushed_at': time.time(), 'cart_id': None}
+
+
+class CartBusy(CartOperationError):
+    pass
+
+
+class _Lock:
+    """
+    Per-cart lock on cache.add. It expires after LOCK_TIMEOUT seconds, so a
+    crashed holder cannot block the cart; the owner token keeps a holder
+    whose lock expired from releasing the next holder's.
+    """
+
+    def __init__(self, key):
+        self.key = key + ':lock'
+        self.token = uuid.uuid4().hex
+
+    def __enter__(self):
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while not cache.add(self.key, self.token, LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                raise CartBusy('The cart is being changed elsewhere; try again.')
+            time.sleep(0.005)
+
+    def __exit__(self, *exc_info):
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+
+class CartStore:
+    def __init__(self, user=None, session=None):
+        self.user = user if user is not None and user.is_authenticated else None
+        self.session = session
+
+    @classmethod
+    def for_request(cls, request):
+        return cls(request.user, request.session)
+
+    @property
+    def key(self):
+        return CART_KEY.format(self.user.pk)
+
+    @property
+    def dirty_key(self):
+        return DIRTY_KEY.format(self.user.pk)
+
+    def _load(self):
+        if self.user is None:
+            return self.session.get(SESSION_KEY) or _empty()
+        state = cache.get(self.key)
+        if state is None:
+            rows = list(Cart.objects.filter(customer__user=self.user)
+                        .order_by('pk', 'items__pk').values_list('pk', 'items__product_id', 'items__quantity'))
+            state = _empty()
+            state['cart_id'] = rows[0][0] if rows else None
+            state['items'] = [[product_id, quantity] for cart_id, product_id, quantity in rows
+                              if cart_id == state['cart_id'] and product_id]
+            cache.set(self.key, state, CART_TIMEOUT)
+        return state
+
+    def _save(self, state):
+        if self.user is None:
+            self.session[SESSION_KEY] = state
+            return
+        cache.set(self.key, state, CART_TIMEOUT)
+        # Called with the cart lock held, so the marker matches the state.
+        if state['dirty']:
+            cache.set(self.dirty_key, 1, CART_TIMEOUT)
+        else:
+            cache.delete(self.dirty_key)
+
+    def quantities(self):
+        return dict(self._load()['items'])
+
+    def count(self):
+        return sum(self.quantities().values())
+
+    def lines(self):
+        """Return [(product, quantity)] in the order products were added."""
+        quantities = self.quantities()
+        products = Product.objects.in_bulk(list(quantities))
+        return [(products[pk], quantity) for pk, quantity in quantities.items() if pk in products]
+
+    def state(self):
+        return lines_state(self.lines(), self._load()['cart_id'])
+
+    def apply(self, operations):
+        """Apply cart operations (see ecommerce.cart) to the stored cart."""
+        changes = reduce_operations(operations)
+        known = set(Product.objects.filter(pk__in=list(changes)).values_list('pk', flat=True))
+        unknown = sorted(set(changes) - known)
+        if unknown:
+            raise CartOperationError(f'Unknown product: {unknown[0]}.')
+        if self.user is None:
+            self._apply(self._load(), changes)
+            return
+        with _Lock(self.key):
+            state = self._load()
+            self._apply(state, changes)
+            if time.time() - state['flushed_at'] >= FLUSH_INTERVAL:
+                self._flush(state)
+
+    def _apply(self, state, changes):
+        quantities = dict(state['items'])
+        for pk, (absolute, delta) in changes.items():
+            quantity = min(max((quantities.get(pk, 0) if absolute is None else absolute) + delta, 0), MAX_QUANTITY)
+            if quantity:
+                quantities[pk] = quantity
+            else:
+                quantities.pop(pk, None)
+        state['items'] = [[pk, quantity] for pk, quantity in quantities.items()]
+        state['dirty'] = True
+        self._save(state)
+
+    def _flush(self, state):
+        cart = None
+        if state['cart_id'] is not None:
+            cart = Cart.objects.filter(pk=state['cart_id']).first()
+        if cart is None:
+            customer, _ = Customer.objects.get_or_create(user=self.user)
+            cart, _ = Cart.objects.get_or_create(customer=customer)
+        quantities = dict(state['items'])
+        # Products deleted since they were added would break the foreign key.
+        existing = set(Product.objects.filter(pk__in=list(quantities)).values_list('pk', flat=True))
+        quantities = {pk: quantity for pk, quantity in quantities.items() if pk in existing}
+        sync_cart(cart, quantities)
+        state.update(items=[[pk, quantity] for pk, quantity in quantities.items()], dirty=False, flushed_at=time.time(), cart_id=cart.pk)
+        self._save(state)
+        return cart
+
+    def _flushed_cart(self):
+        state = self._load()
+        if state['dirty'] or state['cart_id'] is None:
+            return self._flush(state)
+        return Cart.objects.filter(pk=state['cart_id']).first() or self._flush(state)
+
+    def flush(self):
+        """Write the cart to the database if it has unsaved changes; return the Cart (None if anonymous)."""
+        if self.user is None:
+            return None
+        with _Lock(self.key):
+            return self._flushed_cart()
+
+    @contextmanager
+    def writing_through(self):
+        """
+        Change a signed-in shopper's cart in the tables, in one transaction
+        with the caller's other writes: yields the flushed Cart, and the
+        cached copy is dropped after the commit or rollback, with the lock
+        held throughout, so the next read loads what was committed. Do not
+        use it inside an outer transaction.
+        """
+        with _Lock(self.key):
+            cart = self._flushed_cart()
+            try:
+                with transaction.atomic():
+                    yield cart
+            finally:
+                self.reset()
+
+    def reset(self):
+        """Forget the cached cart, e.g. after an order emptied the cart table."""
+        if self.user is None:
+            self.session.pop(SESSION_KEY, None)
+        else:
+            cache.delete_many([self.key, self.dirty_key])
+
+    def merge_into(self, other):
+        """Add this (anonymous) cart's lines to another store and empty this one."""
+        quantities = self.quantities()
+        if quantities:
+            other.apply([{'op': 'add', 'product': pk, 'quantity': q} for pk, q in quantities.items()])
+        self.reset()
+
+
+def flush_dirty_carts():
+    """
+    Flush every cart marked dirty; return how many were written. Each flush
+    clears its own marker under the cart lock, so a cart changed meanwhile
+    stays marked for the next run.
+    """
+    from django.contrib.auth import get_user_model
+
+    users = get_user_model().objects.order_by('pk').values_list('pk', flat=True)
+    flushed = 0
+    batch = []
+    for pk in users.iterator(chunk_size=SCAN_BATCH):
+        batch.append(pk)
+        if len(batch) == SCAN_BATCH:
+            flushed += _flush_marked(batch)
+            batch = []
+    if batch:
+        flushed += _flush_marked(batch)
+    return flushed
+
+
+def _flush_marked(user_ids):
+    from django.contrib.auth import get_user_model
+
+    marked = cache.get_many([DIRTY_KEY.format(pk) for pk in user_ids])
+    marked = [pk for pk in user_ids if DIRTY_KEY.format(pk) in marked]
+    flushed = 0
+    for user in get_user_model().objects.filter(pk__in=marked):
+        store = CartStore(user)
+        try:
+            with _Lock(store.key):
+                state = store._load()
+                if state['dirty']:
+                    store._flush(state)
+                    flushed += 1
+                else:
+                    # The cart expired from the cache or was reset.
+                    cache.delete(store.dirty_key)
+        except CartBusy:
+            # Still marked, so the next run picks it up.
+            continue
+        except Exception:
+            # One cart that cannot be written must not hold up the others.
+            logger.exception('Cannot flush the cart of user %s', user.pk)
+    return flushed
@@ -0,0 +1,114 @@
+"""
+Catalogue version counters.
+
+Anything derived from the Product table (facet counts, cached fragments and
+pages) keys its cache entries on a version, and every Product change bumps
+the versions it affects, so stale entries are simply never read again instead
+of being hunted down. There is one catalogue-wide generation and one version
+per product. A bump also records when it happened, for ``Last-Modified``.
+"""
+import time
+
+from django.core.cache import cache
+
+GENERATION_KEY = 'catalogue:generation'
+PRODUCT_VERSION_KEY = 'catalogue:product:{}:version'
+MODIFIED_SUFFIX = ':modified'
+
+
+def _seed():
+    # If a counter is evicted it restarts from the clock rather than from 1,
+    # so keys built from an earlier version cannot be resurrected.
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _seed(), None)
+        version = cache.get(key, _seed())
+    return version
+
+
+def get_versions(keys):
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        seed = _seed()
+        for key in missing:
+            cache.add(key, seed, None)
+        versions.update(cache.get_many(missing))
+    return versions
+
+
+def bump_version(key):
+    cache.set(key + MODIFIED_SUFFIX, time.time(), None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, _seed(), None)
+        return get_version(key)
+
+
+def get_modified(key, fallback):
+    """
+    Unix time of the last bump of ``key``. If it is not known (never bumped
+    since the cache was emptied), ``fallback()`` supplies it: a datetime or
+    None.
+    """
+    modified = cache.get(key + MODIFIED_SUFFIX)
+    if modified is None:
+        latest = fallback()
+        if latest is None:
+            return None
+        modified = latest.timestamp()
+        cache.add(key + MODIFIED_SUFFIX, modified, None)
+    return modified
+
+
+def get_generation():
+    return get_version(GENERATION_KEY)
+
+
+def bump_generation():
+    return bump_version(GENERATION_KEY)
+
+
+def get_generation_modified(fallback):
+    return get_modified(GENERATION_KEY, fallback)
+
+
+def get_product_versions(product_ids):
+    """Return {product id: version}."""
+    keys = {PRODUCT_VERSION_KEY.format(pk): pk for pk in product_ids}
+    versions = get_versions(list(keys))
+    return {pk: versions.get(key, 0) for key, pk in keys.items()}
+
+
+def get_product_version(product_id):
+    return get_version(PRODUCT_VERSION_KEY.format(product_id))
+
+
+def bump_product_version(product_id):
+    return bump_version(PRODUCT_VERSION_KEY.format(product_id))
+
+
+def get_product_modified(product_id, fallback):
+    return get_modified(PRODUCT_VERSION_KEY.format(product_id), fallback)
+
+
+def bump_product_versions(product_ids):
+    """
+    Bump many product versions with two cache round trips instead of one per
+    product. Not atomic like ``bump_version``: a version is moved to at least
+    the clock, so a racing single bump cannot make it repeat an old value.
+    """
+    keys = {PRODUCT_VERSION_KEY.format(pk): pk for pk in product_ids}
+    if not keys:
+        return
+    now = time.time()
+    seed = _seed()
+    versions = cache.get_many(list(keys))
+    updates = {key: max(versions.get(key, 0) + 1, seed) for key in keys}
+    updates.update({key + MODIFIED_SUFFIX: now for key in keys})
+    cache.set_many(updates, None)
@@ -0,0 +1,33 @@
+"""
+SQLite connection tuning.
+
+``configure`` runs on ``connection_created`` and sets each PRAGMA in
+``ECOMMERCE_SQLITE_PRAGMAS`` on every new SQLite connection. The settings
+module pairs them with persistent, health-checked connections
+(``CONN_MAX_AGE``/``CONN_HEALTH_CHECKS``) and ``BEGIN IMMEDIATE``
+transactions. With deferred transactions, a reader that later writes can fail
+at once with "database is locked" whatever the busy timeout. The busy
+timeout itself is the database ``OPTIONS['timeout']``, not a PRAGMA here.
+
+``benchmarks.MixedLoadBenchmark`` (``manage.py benchmark_db_profile``)
+measures the difference under concurrent reads and writes.
+"""
+from django.conf import settings
+
+
+def configure(connection):
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in getattr(settings, 'ECOMMERCE_SQLITE_PRAGMAS', {}).items():
+        # Straight on the DB-API connection: nothing to log or instrument.
+        connection.connection.execute(f'PRAGMA {name} = {value}')
+
+
+def pragmas(connection, names=('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size')):
+    """Return {name: current value} for a connection, e.g. to check the profile is in effect."""
+    with connection.cursor() as cursor:
+        values = {}
+        for name in names:
+            cursor.execute(f'PRAGMA {name}')
+            values[name] = cursor.fetchone()[0]
+        return values
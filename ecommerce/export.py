@@ -0,0 +1,161 @@
+"""
+Catalogue export feed.
+
+``lines`` streams the Product table as JSON Lines or CSV, optionally with
+stock (units free to reserve) and rating columns and only the products
+changed since a given time. Rows come from one ``values_list().iterator()``
+in primary key order and are grouped into chunks of about ``CHUNK_BYTES``,
+and ``gzipped`` compresses a stream as it goes, so memory stays flat however
+large the catalogue is.
+
+An incremental export (``since``) has a ``deleted`` column. It starts with a
+row for each product deleted since then, from the ``ProductDeletion``
+tombstones, and then lists the products whose ``updated_at`` or, with stock,
+whose stock shards changed since then.
+
+Served at ``/export/catalogue/`` (staff, or a token from
+``ECOMMERCE_EXPORT_TOKENS``) and by ``manage.py export_catalogue``. Record
+``started_at()`` before an export and pass it as ``since`` next time to
+pick up everything changed meanwhile. It lies ``SINCE_OVERLAP`` in the past:
+timestamps are taken before their transaction commits, so a change can
+become visible after an export that started later than its timestamp.
+Consumers therefore see some rows twice, and must upsert by id.
+"""
+import csv
+import io
+import zlib
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Product, ProductDeletion, StockShard
+
+FORMATS = ('jsonl', 'csv')
+CONTENT_TYPES = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+FIELDS = ('id', 'name', 'brand', 'category', 'description', 'price', 'image', 'updated_at')
+STOCK_FIELDS = ('stock',)
+RATING_FIELDS = ('rating_count', 'rating_average')
+DELETED_FIELDS = ('deleted',)
+ITERATOR_CHUNK_SIZE = 2000
+CHUNK_BYTES = 64 * 1024
+# Longer than any transaction that writes products or stock.
+SINCE_OVERLAP = timedelta(minutes=5)
+
+
+def started_at():
+    """The ``since`` to pass to the next export."""
+    return timezone.now() - SINCE_OVERLAP
+
+
+def product_deleted(product):
+    ProductDeletion.objects.create(product_id=product.pk)
+
+
+def parse_since(value):
+    """An ISO date or datetime (naive means the current time zone) as an aware datetime."""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'{value!r} is not an ISO date or date and time.')
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def columns(stock=False, ratings=False, incremental=False):
+    return (FIELDS + (STOCK_FIELDS if stock else ()) + (RATING_FIELDS if ratings else ())
+            + (DELETED_FIELDS if incremental else ()))
+
+
+def _tombstones(since, width, using):
+    # Ids that exist again (SQLite may reuse the highest one) are listed with the products.
+    deletions = (ProductDeletion.objects.using(using).filter(deleted_at__gte=since)
+                 .exclude(product_id__in=Product.objects.using(using).values('pk'))
+                 .order_by('product_id', 'deleted_at').values_list('product_id', 'deleted_at'))
+    last = None
+    for pk, deleted_at in deletions.iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+        if pk != last:
+            yield (pk,) + (None,) * (len(FIELDS) - 2) + (deleted_at,) + (None,) * width + (True,)
+        last = pk
+
+
+def rows(since=None, stock=False, ratings=False, using=DEFAULT_DB_ALIAS):
+    """Yield one tuple per product (and, with ``since``, per deletion), in ``columns()`` order."""
+    products = Product.objects.using(using).order_by('pk')
+    lookups = list(FIELDS)
+    if stock:
+        shards = (StockShard.objects.filter(product=OuterRef('pk')).order_by()
+                  .values('product').annotate(total=Sum('available')).values('total'))
+        # Products without shards have not been reserved from; that is their stock.
+        products = products.annotate(available=Greatest(
+            Coalesce(Subquery(shards), 'stock', output_field=IntegerField()), Value(0)))
+        lookups.append('available')
+    if ratings:
+        lookups += ['rating__count', 'rating__total']
+    if since is not None:
+        changed = Q(updated_at__gte=since)
+        if stock:
+            changed |= Q(pk__in=StockShard.objects.using(using).filter(updated_at__gte=since).values('product_id'))
+        products = products.filter(changed)
+        yield from _tombstones(since, len(columns(stock, ratings)) - len(FIELDS), using)
+    for row in products.values_list(*lookups).iterator(chunk_size=ITERATOR_CHUNK_SIZE):
+        if ratings:
+            count, total = row[-2:]
+            count = count or 0
+            row = row[:-2] + (count, round(total / count, 2) if count else None)
+        yield row + ((False,) if since is not None else ())
+
+
+def _jsonl(header, records):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    for record in records:
+        yield encoder.encode(dict(zip(header, record))) + '\n'
+
+
+def _csv(header, records):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def lines(fmt='jsonl', since=None, stock=False, ratings=False, using=DEFAULT_DB_ALIAS):
+    """Yield the export as text chunks of roughly ``CHUNK_BYTES``."""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown export format {fmt!r}; use one of {", ".join(FORMATS)}.')
+    header = columns(stock, ratings, since is not None)
+    records = rows(since, stock, ratings, using)
+    # Products without an image have NULL there; export ''.
+    records = (tuple((value or '') if name == 'image' else value for name, value in zip(header, record))
+               for record in records)
+    encode = _jsonl if fmt == 'jsonl' else _csv
+    chunk, size = [], 0
+    for line in encode(header, records):
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def gzipped(chunks):
+    """Gzip a stream of text chunks on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
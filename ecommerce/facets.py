@@ -0,0 +1,168 @@
+"""
+Category and brand facet counts for the catalogue filters.
+
+Counts for the whole catalogue live in one cache counter per value, which
+Product signals move with ``cache.incr``/``cache.decr``, so the unfiltered
+catalogue page never touches the Product table to build its dropdowns. An
+index entry lists the values and names the current set of counters.
+
+The counters are only exact where incr/decr are atomic and shared, as on
+memcached and Redis. The file-based cache's incr is a get and a set, so
+racing writers can lose a change, and the local-memory cache keeps separate
+totals in each process. ``_recount`` repairs any drift: it counts the table
+into a fresh set of counters whenever the index expires (``TOTALS_TIMEOUT``),
+a counter is gone, a change names a value the index does not list, or
+``invalidate`` is called.
+
+Counts for a filter/search combination are computed once per catalogue
+generation and cached.
+
+Facets are disjunctive: the category counts honour the brand filter and the
+search but not the selected category, and vice versa, so the dropdowns always
+show what choosing another option would return.
+"""
+import hashlib
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from . import catalogue, search
+from .models import Product
+
+FACET_FIELDS = ('category', 'brand')
+TOTALS_KEY = 'catalogue:facets'
+# Totals are recounted at least this often, which bounds any drift.
+TOTALS_TIMEOUT = 60 * 60
+FILTERED_TIMEOUT = 60 * 15
+
+
+def _count(queryset, field):
+    rows = queryset.order_by().values_list(field).annotate(n=Count('pk'))
+    return dict(rows)
+
+
+def _counter_key(token, field, value):
+    return f'{TOTALS_KEY}:{token}:' + hashlib.md5(repr((field, value)).encode()).hexdigest()
+
+
+def _recount():
+    totals = {field: _count(Product.objects.all(), field) for field in FACET_FIELDS}
+    token = uuid.uuid4().hex
+    cache.set_many({_counter_key(token, field, value): count
+                    for field, counts in totals.items() for value, count in counts.items()}, TOTALS_TIMEOUT)
+    # The index goes last, so no reader sees it before its counters.
+    cache.set(TOTALS_KEY, {'token': token, 'values': {field: list(totals[field]) for field in FACET_FIELDS}},
+              TOTALS_TIMEOUT)
+    return totals
+
+
+def get_totals():
+    index = cache.get(TOTALS_KEY)
+    if index is None:
+        return _recount()
+    keys = {(field, value): _counter_key(index['token'], field, value)
+            for field, values in index['values'].items() for value in values}
+    found = cache.get_many(list(keys.values()))
+    if len(found) < len(keys):
+        return _recount()
+    totals = {field: {} for field in FACET_FIELDS}
+    for (field, value), key in keys.items():
+        if found[key] > 0:
+            totals[field][value] = found[key]
+    return totals
+
+
+def invalidate():
+    cache.delete(TOTALS_KEY)
+    catalogue.bump_generation()
+
+
+def _adjust(changes):
+    index = cache.get(TOTALS_KEY)
+    if index is None:
+        return
+    deltas = {}
+    for field, value, delta in changes:
+        deltas[field, value] = deltas.get((field, value), 0) + delta
+    for (field, value), delta in deltas.items():
+        if value not in index['values'][field]:
+            # A new value: adding it to the index would race; recount instead.
+            cache.delete(TOTALS_KEY)
+            return
+        key = _counter_key(index['token'], field, value)
+        try:
+            if delta > 0:
+                cache.incr(key, delta)
+            elif delta < 0:
+                cache.decr(key, -delta)
+        except ValueError:
+            cache.delete(TOTALS_KEY)
+            return
+
+
+def _after_commit(func):
+    # Cache state must not run ahead of a transaction that may roll back.
+    transaction.on_commit(func)
+
+
+def product_saved(product, created):
+    loaded = getattr(product, '_loaded_values', None)
+    if created:
+        changes = [(field, getattr(product, field), 1) for field in FACET_FIELDS]
+    elif loaded is None or any(field not in loaded for field in FACET_FIELDS):
+        # Saved without a known previous state: recount on next read.
+        _after_commit(invalidate)
+        return
+    else:
+        changes = []
+        for field in FACET_FIELDS:
+            old, new = loaded[field], getattr(product, field)
+            if old != new:
+                changes += [(field, old, -1), (field, new, 1)]
+    products_changed(changes)
+
+
+def products_changed(changes):
+    """Apply [(field, value, delta)] for any number of products once the transaction commits."""
+    _after_commit(lambda: _adjust(changes))
+    _after_commit(catalogue.bump_generation)
+
+
+def product_deleted(product):
+    changes = [(field, getattr(product, field), -1) for field in FACET_FIELDS]
+    _after_commit(lambda: _adjust(changes))
+    _after_commit(catalogue.bump_generation)
+
+
+def _sorted(counts):
+    return sorted(counts.items())
+
+
+def facet_counts(category='', brand='', search_query=''):
+    """Return {'category': [(value, count), ...], 'brand': [...]}."""
+    filters = {'category': category, 'brand': brand}
+    totals = None
+    result = {}
+    for field in FACET_FIELDS:
+        others = {name: value for name, value in filters.items() if name != field and value}
+        if not others and not search_query:
+            if totals is None:
+                totals = get_totals()
+            result[field] = _sorted(totals[field])
+            continue
+        key_source = repr((field, sorted(others.items()), search_query, catalogue.get_generation()))
+        key = 'catalogue:facets:' + hashlib.md5(key_source.encode()).hexdigest()
+        counts = cache.get(key)
+        if counts is None:
+            queryset = Product.objects.filter(**others)
+            if search_query:
+                queryset = queryset.filter(pk__in=search.get_backend().matching_ids(queryset, search_query, None))
+            counts = _count(queryset, field)
+            if search_query:
+                # Choosing a value lists at most RESULT_LIMIT matches.
+                counts = {value: min(count, search.RESULT_LIMIT) for value, count in counts.items()}
+            cache.set(key, counts, FILTERED_TIMEOUT)
+        result[field] = _sorted(counts)
+    return result
@@ -0,0 +1,161 @@
+"""
+Order fulfilment driven by Stripe webhooks.
+
+The webhook view verifies the signature, stores the event with
+``record_event`` and answers straight away; ``checkout.session.completed``
+events are then processed on a worker thread once the event is committed
+(``ECOMMERCE_FULFILMENT = 'background'``), or before the response
+(``'inline'``). Processing builds the order with ``orders.place_order`` from
+the ``CheckoutSnapshot`` of the reservation named in the session's metadata,
+i.e. the lines and prices Stripe charged for, whatever the cart holds by
+then. It also attaches the shipping details and takes the products out of
+the cart, so an order exists whether or not the shopper's browser ever
+reaches the success page. A session whose ``amount_total`` differs from the
+snapshot is left for a person to review. ``checkout.session.expired``
+events give the checkout's stock holds back.
+
+Events are stored under their Stripe id, so Stripe's retries are ignored, and
+an event whose processing failed stays unprocessed until
+``manage.py process_stripe_events`` retries it.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import reservations
+from .cartstore import CartStore
+from .models import CheckoutSnapshot, Customer, StripeEvent
+from .orders import EmptyCart, OutOfStock, place_order, snapshot_lines
+
+logger = logging.getLogger(__name__)
+
+FULFIL_EVENTS = ('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+# Checkouts that will never be paid give their stock holds back.
+RELEASE_EVENTS = ('checkout.session.expired', 'checkout.session.async_payment_failed')
+HANDLED_EVENTS = FULFIL_EVENTS + RELEASE_EVENTS
+MAX_ATTEMPTS = 5
+
+_executor = None
+
+
+def record_event(event, process=True):
+    """
+    Store a verified webhook event (a dict); returns (StripeEvent, created).
+
+    New events are processed right away or, in background mode, handed to the
+    worker pool after the commit, unless ``process`` is false.
+    """
+    session = event.get('data', {}).get('object', {})
+    with transaction.atomic():
+        stored, created = StripeEvent.objects.get_or_create(event_id=event['id'], defaults={
+            'type': event.get('type', ''),
+            'session_id': session.get('id', '') if session.get('object') == 'checkout.session' else '',
+            'payload': event,
+        })
+    if process and created and stored.type in HANDLED_EVENTS:
+        if settings.ECOMMERCE_FULFILMENT == 'inline':
+            process_event(stored.pk)
+        else:
+            transaction.on_commit(lambda: dispatch(stored.pk))
+    return stored, created
+
+
+def dispatch(event_pk):
+    """Process an event on the background worker pool."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='fulfilment')
+    _executor.submit(_process_in_thread, event_pk)
+
+
+def _process_in_thread(event_pk):
+    try:
+        process_event(event_pk)
+    finally:
+        connections.close_all()
+
+
+class _Permanent(Exception):
+    pass
+
+
+def fulfil_session(session):
+    """Create the order for a paid checkout session; returns the Order."""
+    if session.get('payment_status') != 'paid':
+        raise _Permanent(f"Session is {session.get('payment_status')}, not paid.")
+    metadata = session.get('metadata') or {}
+    customer = Customer.objects.select_related('user').filter(pk=metadata.get('customer_id')).first()
+    snapshot = CheckoutSnapshot.objects.filter(reservation=metadata.get('reservation') or '', customer=customer).first()
+    if customer is None or snapshot is None:
+        raise _Permanent('Session metadata does not name a customer and checkout.')
+    if session.get('amount_total') != snapshot.amount_total:
+        raise _Permanent(
+            f"Stripe charged {session.get('amount_total')} but the checkout came to {snapshot.amount_total}."
+        )
+    lines = snapshot_lines(snapshot)
+    if len(lines) != len(snapshot.lines):
+        raise _Permanent('A product in the checkout no longer exists.')
+    shipping = None
+    details = session.get('shipping_details')
+    if details:
+        address = details.get('address') or {}
+        shipping = {
+            'address': address.get('line1') or '',
+            'city': address.get('city') or '',
+            'postal_code': address.get('postal_code') or '',
+            'country': address.get('country') or '',
+            'phone': details.get('phone') or customer.phone,
+        }
+    try:
+        order, created = place_order(customer, snapshot.cart, session['id'], shipping, snapshot.reservation, lines)
+    except (EmptyCart, OutOfStock) as e:
+        # Paid but nothing to ship: needs a person (and probably a refund).
+        raise _Permanent(str(e) or 'The cart is empty.')
+    if created:
+        # Drop the ordered products from the cached cart too; other edits stay.
+        removals = [{'op': 'remove', 'product': product.pk} for product, _, _ in lines]
+        transaction.on_commit(lambda: CartStore(customer.user).apply(removals))
+    return order
+
+
+def release_session(session):
+    reservation = (session.get('metadata') or {}).get('reservation')
+    if reservation:
+        reservations.release(reservation)
+
+
+def process_event(event_pk):
+    """Process one stored event; returns True once it is done with."""
+    pending = StripeEvent.objects.filter(pk=event_pk, processed_at__isnull=True).update(attempts=F('attempts') + 1)
+    if not pending:
+        return True
+    event = StripeEvent.objects.get(pk=event_pk)
+    error = ''
+    try:
+        if event.type in FULFIL_EVENTS:
+            fulfil_session(event.payload['data']['object'])
+        elif event.type in RELEASE_EVENTS:
+            release_session(event.payload['data']['object'])
+    except _Permanent as e:
+        error = str(e)
+        logger.error('Stripe event %s cannot be fulfilled: %s', event.event_id, error)
+    except Exception as e:
+        logger.exception('Stripe event %s failed (attempt %s)', event.event_id, event.attempts)
+        done = event.attempts >= MAX_ATTEMPTS
+        StripeEvent.objects.filter(pk=event_pk).update(
+            error=repr(e), processed_at=timezone.now() if done else None,
+        )
+        return done
+    StripeEvent.objects.filter(pk=event_pk).update(processed_at=timezone.now(), error=error)
+    return True
+
+
+def process_pending(limit=None):
+    """Process unprocessed events, oldest first; returns how many are done."""
+    pending = StripeEvent.objects.filter(processed_at__isnull=True, type__in=HANDLED_EVENTS).order_by('pk')
+    pks = list(pending.values_list('pk', flat=True)[:limit] if limit else pending.values_list('pk', flat=True))
+    return sum(process_event(pk) for pk in pks)
@@ -0,0 +1,172 @@
+"""
+Product image variants.
+
+Cards and detail pages used to load each uploaded original at full size.
+``build`` resizes a product's image to each width in
+``ECOMMERCE_IMAGE_WIDTHS`` (never upscaling) and saves every size as JPEG
+and, when Pillow has WebP support, WebP. The file names contain a hash of
+the original plus the encoder settings, so a URL never changes content and
+can be cached forever, and unchanged images are not rebuilt. The result is
+stored on the product as ``image_variants``
+(``{format: [[width, height, name], ...]}``), which the ``product_image``
+template tag turns into ``srcset``.
+
+A product saved with a new image is built after the commit, on a worker
+pool (``ECOMMERCE_IMAGE_PROCESSING = 'background'``) or before the save
+returns (``'inline'``). ``manage.py build_product_images`` backfills
+existing products.
+
+``serve`` hands out ``MEDIA_ROOT`` when no web server sits in front of
+Django: variants cached for a year, anything else revalidated.
+"""
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.http import Http404
+from django.utils import timezone
+from django.views import static as static_views
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from . import assets, catalogue
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+VARIANT_DIR = 'products/variants/'
+# format: (extension, Pillow save options). Changing these changes the names.
+FORMATS = {'jpeg': ('jpg', {'quality': 82, 'optimize': True, 'progressive': True})}
+if features.check('webp'):
+    FORMATS['webp'] = ('webp', {'quality': 80, 'method': 4})
+ENCODER = repr(sorted(FORMATS.items()))
+
+_executor = None
+
+
+def digest(data):
+    """Content hash of an original, including the encoder settings."""
+    return hashlib.sha256(ENCODER.encode() + data).hexdigest()[:16]
+
+
+def _flatten(image):
+    # JPEG has no alpha channel: put transparent images on white.
+    if image.mode == 'RGB':
+        return image
+    if 'A' not in image.getbands():
+        return image.convert('RGB')
+    background = Image.new('RGB', image.size, 'white')
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def render(data, name_digest, storage):
+    """Write the variants of one original; returns the ``image_variants`` value."""
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    widths = sorted({min(width, image.width) for width in settings.ECOMMERCE_IMAGE_WIDTHS})
+    variants = {fmt: [] for fmt in FORMATS}
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        resized = image if width == image.width else image.resize((width, height), Image.Resampling.LANCZOS)
+        for fmt, (extension, options) in FORMATS.items():
+            name = f'{VARIANT_DIR}{name_digest}-{width}.{extension}'
+            if not storage.exists(name):
+                buffer = io.BytesIO()
+                (_flatten(resized) if fmt == 'jpeg' else resized).save(buffer, fmt.upper(), **options)
+                name = storage.save(name, ContentFile(buffer.getvalue()))
+            variants[fmt].append([width, height, name])
+    return variants
+
+
+def _bump(product_id):
+    catalogue.bump_product_version(product_id)
+    catalogue.bump_generation()
+
+
+def build(product_id, force=False):
+    """Build the variants of one product's image; returns True if they changed."""
+    product = Product.objects.filter(pk=product_id).only('image', 'image_digest').first()
+    if product is None or not product.image:
+        return False
+    try:
+        with product.image.open('rb') as original:
+            data = original.read()
+    except OSError:
+        logger.warning('Image of product %s is missing: %s', product_id, product.image.name)
+        return False
+    name_digest = digest(data)
+    if name_digest == product.image_digest and not force:
+        return False
+    try:
+        variants = render(data, name_digest, product.image.storage)
+    except (UnidentifiedImageError, OSError, ValueError):
+        logger.exception('Cannot resize the image of product %s', product_id)
+        return False
+    # Only if the image was not replaced meanwhile; the newer one has its own build.
+    updated = Product.objects.filter(pk=product_id, image=product.image.name).update(
+        image_digest=name_digest, image_variants=variants, updated_at=timezone.now(),
+    )
+    if updated:
+        transaction.on_commit(lambda: _bump(product_id))
+    return bool(updated)
+
+
+def _build_in_thread(product_id, force=False):
+    try:
+        return build(product_id, force)
+    finally:
+        connections.close_all()
+
+
+def build_many(product_ids, workers=4, force=False):
+    """Build variants on a pool of ``workers`` threads; returns how many products changed."""
+    # Pillow releases the GIL while decoding, resizing and encoding.
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images') as pool:
+        return sum(pool.map(lambda pk: _build_in_thread(pk, force), product_ids))
+
+
+def dispatch(product_id):
+    """Build a product's variants on the background worker pool."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='images')
+    _executor.submit(_build_in_thread, product_id)
+
+
+def product_saved(product, created):
+    loaded = getattr(product, '_loaded_values', None)
+    name = product.image.name if product.image else ''
+    if not created and loaded is not None and 'image' in loaded and (loaded['image'] or '') == name:
+        return
+    if not name:
+        if product.image_variants or product.image_digest:
+            Product.objects.filter(pk=product.pk).update(image_digest='', image_variants={})
+        return
+    pk = product.pk
+    if settings.ECOMMERCE_IMAGE_PROCESSING == 'inline':
+        transaction.on_commit(lambda: build(pk))
+    else:
+        transaction.on_commit(lambda: dispatch(pk))
+
+
+def smallest(product):
+    """Name of the smallest JPEG variant, else the original's; '' without an image."""
+    variants = (product.image_variants or {}).get('jpeg')
+    if variants:
+        return variants[0][2]
+    return product.image.name if product.image else ''
+
+
+def serve(request, path):
+    """Serve an uploaded file; variants never change content, so they are cached forever."""
+    if not settings.MEDIA_ROOT:
+        raise Http404('MEDIA_ROOT is not set.')
+    name = path.lstrip('/')
+    response = static_views.serve(request, name, document_root=settings.MEDIA_ROOT)
+    response['Cache-Control'] = assets.IMMUTABLE if name.startswith(VARIANT_DIR) else 'no-cache'
+    return response
@@ -0,0 +1,295 @@
+"""
+Bulk product import keyed on SKU.
+
+``import_products`` streams a CSV or JSON Lines file (optionally gzipped) of
+``FIELDS``. The main process only splits the input into raw records; worker
+processes parse (CSV against the header) and validate chunks of them while
+the main process upserts the valid rows in batches: one
+``bulk_create(update_conflicts=True)`` per batch on the unique ``sku``, so a
+re-run of the same feed updates products instead of duplicating them.
+
+``bulk_create`` sends no Product signals. What they maintain is done once per
+batch instead of once per row: the search index, stock shards for new or
+restocked products, the facet counts and the catalogue versions. Rejected
+records go to a side file as JSON lines with the line number and the reason.
+Run it with ``manage.py import_products``.
+"""
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from decimal import Decimal, InvalidOperation
+from multiprocessing import Pool
+
+from django.db import connections, transaction
+
+from . import catalogue, facets, reservations, search
+from .models import Product
+
+FIELDS = ('sku', 'name', 'brand', 'category', 'description', 'price', 'stock')
+REQUIRED = ('sku', 'name', 'brand', 'category', 'price', 'stock')
+UPDATE_FIELDS = ('name', 'brand', 'category', 'description', 'price', 'stock', 'updated_at')
+MAX_LENGTHS = {name: Product._meta.get_field(name).max_length for name in ('sku', 'name', 'brand', 'category')}
+PRICE_FIELD = Product._meta.get_field('price')
+MAX_PRICE = Decimal(10) ** (PRICE_FIELD.max_digits - PRICE_FIELD.decimal_places)
+CENT = Decimal('0.01')
+# Records per task handed to a worker process.
+CHUNK_SIZE = 2000
+# Keeps IN (...) lists well under SQLite's bound-parameter limit.
+LOOKUP_SLICE = 5000
+
+
+class ImportFailed(Exception):
+    pass
+
+
+class Rejected(ValueError):
+    pass
+
+
+@dataclass
+class ImportStats:
+    rows: int = 0
+    created: int = 0
+    updated: int = 0
+    rejected: int = 0
+    rejects_path: str = ''
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        return self.rows / max(self.seconds, 1e-9)
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    raise ImportFailed(f'Cannot tell the format of {path}; pass --format.')
+
+
+def _open(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_records(f, fmt):
+    """
+    Yield (first line number, raw text) for each non-blank record, left to
+    the workers to parse. A CSV record goes on while a quoted field is open,
+    which is told by an odd number of quotes so far; a stray quote inside an
+    unquoted field therefore joins lines, and parse() rejects the result.
+    """
+    if fmt != 'csv':
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield number, line
+        return
+    start, lines, quoted = None, [], False
+    for number, line in enumerate(f, 1):
+        if not lines:
+            start = number
+        lines.append(line)
+        if line.count('"') % 2:
+            quoted = not quoted
+        if not quoted:
+            text = ''.join(lines)
+            lines = []
+            if text.strip():
+                yield start, text
+    if lines:
+        yield start, ''.join(lines)
+
+
+def read_header(records):
+    """Take the CSV header off read_records(); returns its column names."""
+    _, text = next(records, (None, ''))
+    fieldnames = next(csv.reader(io.StringIO(text)), [])
+    missing = [name for name in REQUIRED if name not in fieldnames]
+    if missing:
+        raise ImportFailed(f'The CSV header lacks {", ".join(missing)}.')
+    return fieldnames
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _text(record, name):
+    value = record.get(name)
+    value = '' if value is None else str(value).strip()
+    if not value and name in REQUIRED:
+        raise Rejected(f'{name} is required.')
+    limit = MAX_LENGTHS.get(name)
+    if limit and len(value) > limit:
+        raise Rejected(f'{name} is longer than {limit} characters.')
+    return value
+
+
+def parse(text, fieldnames=None):
+    """Return one raw record as a dict: a CSV row of ``fieldnames``, or a JSON object without them."""
+    if fieldnames is not None:
+        try:
+            rows = list(csv.DictReader(io.StringIO(text), fieldnames))
+        except csv.Error as e:
+            raise Rejected(f'Invalid CSV: {e}')
+        if len(rows) != 1:
+            raise Rejected('Invalid CSV: unbalanced quotes.')
+        return rows[0]
+    try:
+        record = json.loads(text)
+    except ValueError as e:
+        raise Rejected(f'Invalid JSON: {e}')
+    if not isinstance(record, dict):
+        raise Rejected('Expected a JSON object.')
+    return record
+
+
+def validate(record):
+    """Return the FIELDS values of one parsed record, or raise Rejected."""
+    sku, name, brand, category, description = (
+        _text(record, key) for key in ('sku', 'name', 'brand', 'category', 'description')
+    )
+    try:
+        price = Decimal(str(record.get('price', '')).strip())
+    except InvalidOperation:
+        raise Rejected('price is not a number.')
+    if not price.is_finite() or price < 0 or price >= MAX_PRICE or price != price.quantize(CENT):
+        raise Rejected(f'price must be between 0 and {MAX_PRICE} with at most two decimals.')
+    try:
+        stock = int(str(record.get('stock', '')).strip())
+    except ValueError:
+        raise Rejected('stock is not a whole number.')
+    if stock < 0:
+        raise Rejected('stock cannot be negative.')
+    return sku, name, brand, category, description, price.quantize(CENT), stock
+
+
+def validate_chunk(chunk, fieldnames=None):
+    """Return ([(line, values)], [(line, record, reason)]) for a chunk of read_records()."""
+    valid, rejected = [], []
+    for line, record in chunk:
+        try:
+            record = parse(record, fieldnames)
+            valid.append((line, validate(record)))
+        except Rejected as e:
+            rejected.append((line, record, str(e)))
+    return valid, rejected
+
+
+def _existing(skus):
+    rows = {}
+    for start in range(0, len(skus), LOOKUP_SLICE):
+        rows.update(
+            (sku, (pk, category, brand, stock))
+            for sku, pk, category, brand, stock in Product.objects.filter(sku__in=skus[start:start + LOOKUP_SLICE])
+            .values_list('sku', 'pk', 'category', 'brand', 'stock')
+        )
+    return rows
+
+
+def upsert(rows):
+    """Insert or update products from FIELDS tuples; returns (created, updated)."""
+    # A SKU repeated within the batch: the last row wins.
+    rows = list({values[0]: values for values in rows}.values())
+    skus = [values[0] for values in rows]
+    with transaction.atomic():
+        existing = _existing(skus)
+        products = [Product(**dict(zip(FIELDS, values))) for values in rows]
+        Product.objects.bulk_create(products, batch_size=LOOKUP_SLICE, update_conflicts=True,
+                                    unique_fields=['sku'], update_fields=UPDATE_FIELDS)
+        ids = {sku: pk for sku, (pk, *_) in _existing(skus).items()}
+        changes, restocked, touched = [], [], []
+        for product in products:
+            product.pk = ids[product.sku]
+            old = existing.get(product.sku)
+            if old is None:
+                changes += [(name, getattr(product, name), 1) for name in facets.FACET_FIELDS]
+                restocked.append(product.pk)
+                continue
+            _, category, brand, stock = old
+            for name, value in (('category', category), ('brand', brand)):
+                if value != getattr(product, name):
+                    changes += [(name, value, -1), (name, getattr(product, name), 1)]
+            if stock != product.stock:
+                restocked.append(product.pk)
+            touched.append(product.pk)
+        search.index_products(products)
+        reservations.rebuild_shards(restocked)
+        facets.products_changed(changes)
+        transaction.on_commit(lambda: catalogue.bump_product_versions(touched))
+    return len(rows) - len(existing), len(existing)
+
+
+def run(path, fmt=None, workers=1, batch_size=5000, rejects_path=None, progress=None):
+    """
+    Import a file ('-' for stdin); returns ImportStats. ``progress(stats)`` is
+    called after each batch. Rejected records are written to ``rejects_path``
+    (default: next to the input) only if there are any.
+    """
+    fmt = fmt or detect_format(path)
+    if rejects_path is None:
+        rejects_path = 'rejects.jsonl' if path == '-' else f'{path}.rejects.jsonl'
+    stats = ImportStats(rejects_path=rejects_path)
+    rejects = None
+    pool = None
+    if workers > 1:
+        # Forked workers must not share the parent's database connection.
+        connections.close_all()
+        pool = Pool(workers)
+    try:
+        with _open(path) as f:
+            records = read_records(f, fmt)
+            task = partial(validate_chunk, fieldnames=read_header(records) if fmt == 'csv' else None)
+            chunks = _chunks(records, CHUNK_SIZE)
+            results = pool.imap(task, chunks) if pool else map(task, chunks)
+            batch = []
+            for valid, rejected in results:
+                stats.rows += len(valid) + len(rejected)
+                if rejected:
+                    if rejects is None:
+                        rejects = open(rejects_path, 'w', encoding='utf-8')
+                    for line, record, reason in rejected:
+                        rejects.write(json.dumps({'line': line, 'error': reason, 'record': record}) + '\n')
+                    stats.rejected += len(rejected)
+                batch += [values for _, values in valid]
+                while len(batch) >= batch_size:
+                    created, updated = upsert(batch[:batch_size])
+                    stats.created += created
+                    stats.updated += updated
+                    batch = batch[batch_size:]
+                    if progress:
+                        progress(stats)
+            if batch:
+                created, updated = upsert(batch)
+                stats.created += created
+                stats.updated += updated
+            if progress:
+                progress(stats)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if rejects is not None:
+            rejects.close()
+    return stats
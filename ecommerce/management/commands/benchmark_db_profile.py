@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ecommerce.benchmarks import MixedLoadBenchmark
+
+
+class Command(BaseCommand):
+    help = 'Compare the basic and production SQLite connection profiles under concurrent reads and writes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--operations', type=int, default=200, help='Operations per worker.')
+        parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of operations that place an order.')
+        parser.add_argument('--products', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The connection profiles only apply to SQLite.')
+        results = MixedLoadBenchmark(options['workers'], options['operations'], options['write_ratio'],
+                                     options['products']).run()
+
+        self.stdout.write(f'{"profile":<12}{"ops":>8}{"errors":>8}{"ops/s":>10}{"p95 ms":>10}')
+        for name, result in results.items():
+            self.stdout.write(f'{name:<12}{result["operations"]:>8}{result["errors"]:>8}'
+                              f'{result["ops_per_sec"]:>10}{result["p95_ms"]:>10}')
+        basic, production = results['basic'], results['production']
+        if basic['ops_per_sec']:
+            self.stdout.write(f'Speedup: {production["ops_per_sec"] / basic["ops_per_sec"]:.2f}x')
+        if production['errors']:
+            raise CommandError(f'{production["errors"]} operations failed with the production profile.')
+        self.stdout.write(self.style.SUCCESS('No lock errors with the production profile.'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce import images
+from ecommerce.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Build the resized JPEG and WebP variants of product images.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--force', action='store_true', help='Rebuild variants that are up to date.')
+
+    def handle(self, *args, **options):
+        product_ids = list(
+            Product.objects.exclude(image='').exclude(image__isnull=True).order_by('pk').values_list('pk', flat=True)
+        )
+        built = images.build_many(product_ids, options['workers'], options['force'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Built image variants for {built} of {len(product_ids)} products with images.'
+        ))
@@ -0,0 +1,35 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ecommerce import recommendations
+
+
+class Command(BaseCommand):
+    help = 'Rebuild "frequently bought together" recommendations from order history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=10, help='Recommendations stored per product.')
+        parser.add_argument('--half-life-days', type=float,
+                            help='Age at which an order counts half (default: ECOMMERCE_RECOMMENDATION_HALF_LIFE_DAYS).')
+        parser.add_argument('--since-days', type=int, help='Only read orders from the last N days.')
+        parser.add_argument('--min-weight', type=float, default=0.0,
+                            help='Drop pairs whose decayed co-purchase weight is below this.')
+
+    def handle(self, *args, **options):
+        if options['top_k'] < 1:
+            raise CommandError('--top-k must be positive.')
+        if options['half_life_days'] is not None and options['half_life_days'] <= 0:
+            raise CommandError('--half-life-days must be positive.')
+        now = timezone.now()
+        since = now - timedelta(days=options['since_days']) if options['since_days'] else None
+        started = time.monotonic()
+        stats = recommendations.build(options['top_k'], options['half_life_days'], since, options['min_weight'], now)
+        engine = 'numpy' if recommendations.numpy is not None else 'array'
+        self.stdout.write(self.style.SUCCESS(
+            f'Read {stats.orders:,} orders ({stats.pairs:,} product pairs, {engine}) in '
+            f'{time.monotonic() - started:.1f}s: recommendations for {stats.products:,} products, '
+            f'{stats.changed:,} changed.'
+        ))
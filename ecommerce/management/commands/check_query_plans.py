@@ -0,0 +1,53 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from ecommerce.benchmarks import StepFailed
+from ecommerce.queryplans import PlanAudit
+
+
+class Command(BaseCommand):
+    help = (
+        "Run every view once, EXPLAIN each statement it issues and fail if a filtering "
+        "query scans a whole table instead of using an index."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=20000,
+                            help='Products generated in the scratch database.')
+        parser.add_argument('--customers', type=int, default=2000)
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--use-existing-db', action='store_true',
+                            help='Run against the configured database instead of a generated scratch one.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = None
+        try:
+            if not options['use_existing_db']:
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+                self.stdout.write('Generating scratch dataset...')
+                call_command('generate_fake_data', stdout=StringIO(), products=options['products'],
+                             customers=options['customers'], orders=options['orders'])
+            audit = PlanAudit()
+            try:
+                problems = audit.run()
+            except StepFailed as e:
+                raise CommandError(str(e))
+            checked = sum(len(set(statements)) for statements in audit.statements.values())
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, statements in problems.items():
+            for sql, tables in statements:
+                self.stdout.write(f"{name}: full scan of {', '.join(tables)}\n    {sql}")
+        if problems:
+            raise CommandError(f'{len(problems)} views scan whole tables.')
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} statements from {len(audit.statements)} views; no full table scans.'
+        ))
@@ -0,0 +1,16 @@
+from django.contrib.staticfiles.management.commands import collectstatic
+from django.core.management.base import CommandError
+
+from ecommerce import assets
+
+
+class Command(collectstatic.Command):
+    def handle(self, **options):
+        missing, problems = assets.check_vendor_files()
+        if problems:
+            raise CommandError('Vendor files fail their pins:\n' + '\n'.join(
+                f'{path}: {problem}' for path, problem in problems
+            ))
+        if missing:
+            self.stderr.write(f'Not vendored yet, linked from the CDN: {", ".join(missing)}.')
+        return super().handle(**options)
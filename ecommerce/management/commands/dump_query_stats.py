@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ecommerce import querystats
+
+
+class Command(BaseCommand):
+    help = 'Print the per-view SQL statistics recorded by QueryInstrumentationMiddleware.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=querystats.WINDOW_MINUTES)
+        parser.add_argument('--json', action='store_true', help='Print raw JSON.')
+        parser.add_argument('--sort', default='requests',
+                            choices=['requests', 'avg_queries', 'avg_db_ms', 'avg_ms'])
+
+    def handle(self, *args, **options):
+        summary = querystats.collect(options['minutes'])
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        if not summary:
+            self.stdout.write('No requests recorded.')
+            return
+        header = f"{'view':<45}{'reqs':>8}{'avg q':>8}{'p95 q':>8}{'avg db ms':>11}{'p95 ms':>9}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        rows = sorted(summary.items(), key=lambda item: item[1][options['sort']], reverse=True)
+        for view, result in rows:
+            self.stdout.write(
+                f"{view:<45}{result['requests']:>8}{result['avg_queries']:>8}{str(result['p95_queries']):>8}"
+                f"{result['avg_db_ms']:>11}{str(result['p95_ms']):>9}"
+            )
+            for sql, count in result['repeated']:
+                self.stdout.write(self.style.WARNING(f'    repeated x{count}: {sql}'))
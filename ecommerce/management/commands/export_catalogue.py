@@ -0,0 +1,45 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce import export
+
+
+class Command(BaseCommand):
+    help = 'Stream the catalogue as JSON Lines or CSV, optionally only products changed since a time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=export.FORMATS, default='jsonl')
+        parser.add_argument('--since', help='ISO date or datetime; only products changed since then.')
+        parser.add_argument('--stock', action='store_true', help='Include stock levels.')
+        parser.add_argument('--ratings', action='store_true', help='Include review count and average rating.')
+        parser.add_argument('--output', default='-', help='File to write, or - for standard output.')
+        parser.add_argument('--gzip', action='store_true', help='Compress; implied by an --output ending in .gz.')
+
+    def handle(self, *args, **options):
+        try:
+            since = export.parse_since(options['since']) if options['since'] else None
+        except ValueError as e:
+            raise CommandError(str(e))
+        started = export.started_at()
+        chunks = export.lines(options['format'], since, options['stock'], options['ratings'])
+        compress = options['gzip'] or options['output'].endswith('.gz')
+        if compress:
+            chunks = export.gzipped(chunks)
+        elif options['output'] != '-':
+            chunks = (chunk.encode() for chunk in chunks)
+
+        if options['output'] == '-':
+            if compress:
+                for chunk in chunks:
+                    sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+            else:
+                for chunk in chunks:
+                    self.stdout.write(chunk, ending='')
+        else:
+            with open(options['output'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        # Pass this as --since next time to export what changed meanwhile.
+        self.stderr.write(f'Exported as of {started.isoformat()}')
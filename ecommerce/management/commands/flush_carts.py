@@ -0,0 +1,17 @@
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce import cartstore
+
+
+class Command(BaseCommand):
+    help = 'Write carts changed in the cache back to the Cart tables. Run it from cron.'
+
+    def handle(self, *args, **options):
+        if isinstance(caches['default'], LocMemCache):
+            # Each web process has its own carts; this one would see none of them.
+            raise CommandError('The default cache is per-process (LocMemCache); '
+                               'configure a shared cache before flushing carts.')
+        count = cartstore.flush_dirty_carts()
+        self.stdout.write(self.style.SUCCESS(f'Flushed {count} carts.'))
@@ -0,0 +1,284 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from multiprocessing import Pool
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from faker import Faker
+
+from ecommerce import facets, ratings, reservations, search
+from ecommerce.models import (
+    Cart, CartItem, Customer, Order, OrderItem, Product, Review, ShippingInfo, Wishlist, WishlistItem,
+)
+from ecommerce.orders import summarise
+
+# Rows generated per task handed to a worker process. Fixed, so a given seed
+# produces the same data whatever the number of workers.
+CHUNK_SIZE = 5000
+
+
+def _faker(seed, chunk):
+    fake = Faker()
+    fake.seed_instance(seed * 1_000_003 + chunk)
+    return fake
+
+
+def _product_rows(task):
+    seed, chunk, size, categories, brands = task
+    fake = _faker(seed, chunk)
+    rng = random.Random(f'products-{seed}-{chunk}')
+    rows = []
+    for i in range(size):
+        rows.append((
+            f'{fake.word().title()} {fake.word().title()} {chunk * CHUNK_SIZE + i + 1}',
+            rng.choice(brands),
+            rng.choice(categories),
+            fake.text(max_nb_chars=200),
+            str(Decimal(rng.randint(500, 50000)) / 100),
+            rng.randint(0, 500),
+        ))
+    return rows
+
+
+def _user_rows(task):
+    seed, chunk, size = task
+    fake = _faker(seed, chunk)
+    rows = []
+    for _ in range(size):
+        rows.append((
+            fake.first_name(), fake.last_name(), fake.street_address(), fake.city(),
+            fake.postcode(), fake.country_code(), fake.msisdn()[:20],
+        ))
+    return rows
+
+
+class Progress:
+    def __init__(self, stdout, label, total):
+        self.stdout = stdout
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+
+    def rate(self):
+        return self.done / max(time.monotonic() - self.started, 1e-9)
+
+    def advance(self, count):
+        self.done += count
+        self.stdout.write(f'\r{self.label}: {self.done:,}/{self.total:,} ({self.rate():,.0f} rows/s)', ending='')
+        self.stdout.flush()
+
+    def finish(self):
+        self.stdout.write('')
+
+
+class Command(BaseCommand):
+    help = 'Generate a deterministic synthetic dataset: products, customers, carts, wishlists, orders and reviews.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--customers', type=int, default=100)
+        parser.add_argument('--orders', type=int, default=500)
+        parser.add_argument('--max-order-items', type=int, default=5)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--brands', type=int, default=200)
+        parser.add_argument('--cart-ratio', type=float, default=0.5,
+                            help='Fraction of new customers given a non-empty cart.')
+        parser.add_argument('--wishlist-ratio', type=float, default=0.3,
+                            help='Fraction of new customers given a wishlist.')
+        parser.add_argument('--review-ratio', type=float, default=0.3,
+                            help='Fraction of new orders that get a review.')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Spread order dates over this many past days.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes used to generate product and customer rows.')
+
+    def handle(self, *args, **options):
+        if options['orders'] and not (options['products'] or Product.objects.exists()):
+            raise CommandError('Orders need products; pass --products.')
+        self.options = options
+        self.batch_size = options['batch_size']
+        self.rng = random.Random(options['seed'])
+        fake = _faker(options['seed'], -1)
+        categories = [fake.unique.word().title() for _ in range(options['categories'])]
+        brands = [fake.unique.company() for _ in range(options['brands'])]
+
+        started = time.monotonic()
+        pool = None
+        if options['workers'] > 1:
+            # Forked workers must not share the parent's database connection.
+            connections.close_all()
+            pool = Pool(options['workers'])
+        try:
+            self.products = self.create_products(pool, categories, brands)
+            self.customers = self.create_customers(pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if not self.products:
+            self.products = list(Product.objects.values_list('pk', 'price'))
+        if not self.customers:
+            self.customers = list(Customer.objects.values_list('pk', flat=True))
+        if self.customers and self.products:
+            self.create_carts()
+            self.create_wishlists()
+            self.create_orders()
+            self.stdout.write('Rebuilding rating summaries...')
+            ratings.rebuild()
+
+        if options['products']:
+            # bulk_create bypasses the Product signals that maintain these.
+            self.stdout.write('Rebuilding search index and stock shards...')
+            search.rebuild_index()
+            reservations.rebuild_shards()
+            facets.invalidate()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'Done in {elapsed:.1f}s.'))
+
+    def _tasks(self, total, *extra):
+        seed = self.options['seed']
+        for chunk, start in enumerate(range(0, total, CHUNK_SIZE)):
+            yield (seed, chunk, min(CHUNK_SIZE, total - start), *extra)
+
+    def _generate(self, pool, func, tasks):
+        return pool.imap(func, tasks) if pool else map(func, tasks)
+
+    def _bulk_create(self, model, objs):
+        with transaction.atomic():
+            return model.objects.bulk_create(objs, batch_size=self.batch_size)
+
+    def create_products(self, pool, categories, brands):
+        total = self.options['products']
+        if not total:
+            return []
+        progress = Progress(self.stdout, 'products', total)
+        created = []
+        for rows in self._generate(pool, _product_rows, self._tasks(total, categories, brands)):
+            objs = [
+                Product(name=name, brand=brand, category=category, description=description,
+                        price=Decimal(price), stock=stock)
+                for name, brand, category, description, price, stock in rows
+            ]
+            created += [(p.pk, p.price) for p in self._bulk_create(Product, objs)]
+            progress.advance(len(objs))
+        progress.finish()
+        return created
+
+    def create_customers(self, pool):
+        total = self.options['customers']
+        if not total:
+            return []
+        prefix = f'shopper{self.options["seed"]}_'
+        offset = User.objects.filter(username__startswith=prefix).count()
+        password = make_password('password')  # hashing once keeps this cheap
+        progress = Progress(self.stdout, 'customers', total)
+        customers = []
+        index = offset
+        for rows in self._generate(pool, _user_rows, self._tasks(total)):
+            users = []
+            for first, last, *_ in rows:
+                index += 1
+                users.append(User(username=f'{prefix}{index}', first_name=first, last_name=last,
+                                  email=f'{prefix}{index}@example.com', password=password))
+            users = self._bulk_create(User, users)
+            objs = [
+                Customer(user_id=user.pk, address=f'{street}, {city}', phone=phone)
+                for user, (_, _, street, city, _, _, phone) in zip(users, rows)
+            ]
+            created = self._bulk_create(Customer, objs)
+            self._bulk_create(ShippingInfo, [
+                ShippingInfo(customer_id=customer.pk, address=street, city=city, postal_code=postcode,
+                             country=country, phone=phone)
+                for customer, (_, _, street, city, postcode, country, phone) in zip(created, rows)
+            ])
+            customers += [customer.pk for customer in created]
+            progress.advance(len(objs))
+        progress.finish()
+        return customers
+
+    def _sample_products(self, count):
+        return self.rng.sample(self.products, min(count, len(self.products)))
+
+    def create_carts(self):
+        owners = [pk for pk in self.customers if self.rng.random() < self.options['cart_ratio']]
+        if not owners:
+            return
+        progress = Progress(self.stdout, 'carts', len(owners))
+        for start in range(0, len(owners), self.batch_size):
+            batch = owners[start:start + self.batch_size]
+            carts = self._bulk_create(Cart, [Cart(customer_id=pk) for pk in batch])
+            items = [
+                CartItem(cart_id=cart.pk, product_id=product_id, quantity=self.rng.randint(1, 3))
+                for cart in carts
+                for product_id, _ in self._sample_products(self.rng.randint(1, 5))
+            ]
+            self._bulk_create(CartItem, items)
+            progress.advance(len(batch))
+        progress.finish()
+
+    def create_wishlists(self):
+        owners = [pk for pk in self.customers if self.rng.random() < self.options['wishlist_ratio']]
+        if not owners:
+            return
+        progress = Progress(self.stdout, 'wishlists', len(owners))
+        for start in range(0, len(owners), self.batch_size):
+            batch = owners[start:start + self.batch_size]
+            wishlists = self._bulk_create(Wishlist, [Wishlist(customer_id=pk, name='Saved for later') for pk in batch])
+            items = [
+                WishlistItem(wishlist_id=wishlist.pk, product_id=product_id)
+                for wishlist in wishlists
+                for product_id, _ in self._sample_products(self.rng.randint(1, 20))
+            ]
+            self._bulk_create(WishlistItem, items)
+            progress.advance(len(batch))
+        progress.finish()
+
+    def create_orders(self):
+        total = self.options['orders']
+        if not total:
+            return
+        now = timezone.now()
+        seconds = self.options['days'] * 24 * 60 * 60
+        progress = Progress(self.stdout, 'orders', total)
+        for start in range(0, total, self.batch_size):
+            size = min(self.batch_size, total - start)
+            orders, lines = [], []
+            for _ in range(size):
+                picked = self._sample_products(self.rng.randint(1, self.options['max_order_items']))
+                quantities = [self.rng.randint(1, 3) for _ in picked]
+                total_price = sum(price * quantity for (_, price), quantity in zip(picked, quantities))
+                orders.append(Order(customer_id=self.rng.choice(self.customers), total=total_price, status='Paid'))
+                lines.append((picked, quantities))
+            orders = self._bulk_create(Order, orders)
+            # created_at is auto_now_add, so spread the dates in a second pass.
+            for order in orders:
+                order.created_at = now - timedelta(seconds=self.rng.randrange(seconds or 1))
+            with transaction.atomic():
+                Order.objects.bulk_update(orders, ['created_at'], batch_size=self.batch_size)
+            items, shipping, reviews = [], [], []
+            for order, (picked, quantities) in zip(orders, lines):
+                items += [
+                    OrderItem(order_id=order.pk, product_id=product_id, quantity=quantity, price=price)
+                    for (product_id, price), quantity in zip(picked, quantities)
+                ]
+                shipping.append(ShippingInfo(
+                    customer_id=order.customer_id, order_id=order.pk, address=f'{order.pk} Market Street',
+                    city='Springfield', postal_code='00000', country='US', phone='5550000',
+                ))
+                if self.rng.random() < self.options['review_ratio']:
+                    reviews.append(Review(order_id=order.pk, customer_id=order.customer_id,
+                                          rating=self.rng.randint(1, 5), comment='Generated review.'))
+            self._bulk_create(OrderItem, items)
+            self._bulk_create(ShippingInfo, shipping)
+            self._bulk_create(Review, reviews)
+            summarise([order.pk for order in orders])
+            progress.advance(size)
+        progress.finish()
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce import importing
+
+
+class Command(BaseCommand):
+    help = 'Create or update products from a CSV or JSON Lines feed, matched on SKU.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSON Lines file, optionally .gz, or - for standard input.')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Input format; by default taken from the file extension.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes used to parse and validate records.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows upserted per transaction.')
+        parser.add_argument('--rejects', help='Where to write rejected records (default: <path>.rejects.jsonl).')
+
+    def handle(self, *args, **options):
+        if options['path'] == '-' and not options['format']:
+            raise CommandError('Pass --format when reading standard input.')
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive.')
+
+        def progress(stats):
+            self.stdout.write(f'\rproducts: {stats.rows:,} ({stats.rate:,.0f} rows/s)', ending='')
+            self.stdout.flush()
+
+        try:
+            stats = importing.run(options['path'], options['format'], options['workers'], options['batch_size'],
+                                  options['rejects'], progress)
+        except (importing.ImportFailed, OSError) as e:
+            raise CommandError(str(e))
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f'{stats.rows:,} rows in {stats.seconds:.1f}s ({stats.rate:,.0f} rows/s): '
+            f'{stats.created:,} created, {stats.updated:,} updated, {stats.rejected:,} rejected.'
+        ))
+        if stats.rejected:
+            self.stderr.write(f'Rejected records written to {stats.rejects_path}')
@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce import fulfilment
+from ecommerce.models import StripeEvent
+
+
+class Command(BaseCommand):
+    help = (
+        'Process Stripe webhook events that are still pending (run it from cron), '
+        'replay a stored event, or feed in an event exported from Stripe.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None)
+        parser.add_argument('--replay', metavar='EVENT_ID', help='Process a stored event again.')
+        parser.add_argument('--file', help='Record and process a Stripe event from a JSON file (no signature check).')
+
+    def handle(self, *args, **options):
+        if options['file']:
+            with open(options['file']) as f:
+                event = json.load(f)
+            stored, created = fulfilment.record_event(event, process=False)
+            if not created:
+                self.stdout.write(f'Event {stored.event_id} was already recorded.')
+        if options['replay']:
+            updated = StripeEvent.objects.filter(event_id=options['replay']).update(processed_at=None, error='')
+            if not updated:
+                raise CommandError(f"No stored event {options['replay']}.")
+        done = fulfilment.process_pending(options['limit'])
+        left = StripeEvent.objects.filter(processed_at__isnull=True, type__in=fulfilment.HANDLED_EVENTS).count()
+        self.stdout.write(self.style.SUCCESS(f'Processed {done} events, {left} pending.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce import ratings
+
+
+class Command(BaseCommand):
+    help = 'Recompute every product rating summary from the Review table.'
+
+    def handle(self, *args, **options):
+        count = ratings.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt rating summaries for {count} products.'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search index from the Product table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        count = search.rebuild_index(chunk_size=options['chunk_size'])
+        backend = search.get_backend().name
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} products ({backend} backend).'))
@@ -0,0 +1,72 @@
+import json
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from ecommerce.benchmarks import FunnelBenchmark, StepFailed, compare
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the shopping funnel (browse to payment success) against a fake Stripe '
+        'and report p50/p95/p99 latency, queries and throughput per step.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--products', type=int, default=5000,
+                            help='Products generated in the scratch database.')
+        parser.add_argument('--customers', type=int, default=500)
+        parser.add_argument('--orders', type=int, default=2000)
+        parser.add_argument('--use-existing-db', action='store_true',
+                            help='Run against the configured database instead of a generated scratch one.')
+        parser.add_argument('--save-baseline', metavar='PATH')
+        parser.add_argument('--compare', metavar='PATH', help='Baseline JSON to compare against.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p95 slowdown as a fraction of the baseline.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = None
+        try:
+            if not options['use_existing_db']:
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+                self.stdout.write('Generating scratch dataset...')
+                call_command('generate_fake_data', stdout=StringIO(), products=options['products'],
+                             customers=options['customers'], orders=options['orders'])
+            benchmark = FunnelBenchmark(options['iterations'], options['warmup'])
+            try:
+                summary = benchmark.run()
+            except StepFailed as e:
+                raise CommandError(str(e))
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.report(summary)
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Baseline written to {options['save_baseline']}.")
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            regressions = compare(summary, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against baseline:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline.'))
+
+    def report(self, summary):
+        header = f"{'step':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'req/s':>10}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for name, result in summary.items():
+            self.stdout.write(
+                f"{name:<28}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+                f"{result['queries']:>9}{result['throughput']:>10.1f}"
+            )
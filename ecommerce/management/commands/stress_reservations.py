@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from ecommerce.benchmarks import ReservationStress
+
+
+class Command(BaseCommand):
+    help = 'Reserve one hot product from many threads at once and check that nothing oversells.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--attempts', type=int, default=50, help='Reservations per worker.')
+        parser.add_argument('--stock', type=int, default=200)
+        parser.add_argument('--quantity', type=int, default=1, help='Units per reservation.')
+        parser.add_argument('--use-existing-db', action='store_true',
+                            help='Run against the configured database instead of a scratch one.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = None
+        try:
+            if not options['use_existing_db']:
+                old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+            result = ReservationStress(options['workers'], options['attempts'], options['stock'],
+                                       options['quantity']).run()
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for key, value in result.items():
+            self.stdout.write(f'{key:<16}{value}')
+        if result['oversold'] or not result['consistent']:
+            raise CommandError('Stock reservations are inconsistent.')
+        self.stdout.write(self.style.SUCCESS('No overselling.'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce import reservations
+
+
+class Command(BaseCommand):
+    help = (
+        'Release expired checkout stock holds and fold paid ones into Product.stock. '
+        'Run it from cron every minute or so.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild-shards', action='store_true',
+                            help='Also recompute every stock shard from Product.stock.')
+
+    def handle(self, *args, **options):
+        released, folded = reservations.sweep()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired holds, folded {folded} sales.'))
+        if options['rebuild_shards']:
+            count = reservations.rebuild_shards()
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt stock shards for {count} products.'))
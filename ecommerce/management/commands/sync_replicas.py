@@ -0,0 +1,38 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ecommerce.routing import PRIMARY
+
+
+def _connect(settings_dict):
+    name = str(settings_dict['NAME'])
+    return sqlite3.connect(name, uri=name.startswith('file:'))
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the primary SQLite database into every replica in ECOMMERCE_DB_REPLICAS, '
+        'standing in for replication when trying read replicas locally.'
+    )
+
+    def handle(self, *args, **options):
+        primary = connections[PRIMARY].settings_dict
+        if primary['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('Only SQLite databases can be copied; use your database\'s own replication.')
+        if not settings.ECOMMERCE_DB_REPLICAS:
+            raise CommandError('No replicas configured; set DB_REPLICA or ECOMMERCE_DB_REPLICAS.')
+        source = _connect(primary)
+        try:
+            for alias in settings.ECOMMERCE_DB_REPLICAS:
+                connections[alias].close()
+                target = _connect(connections[alias].settings_dict)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(self.style.SUCCESS(f'Copied {PRIMARY} to {alias}.'))
+        finally:
+            source.close()
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce.assets import VENDOR_ASSETS, integrity
+
+STATIC_DIR = Path(__file__).resolve().parents[2] / 'static'
+
+
+class Command(BaseCommand):
+    help = 'Download the pinned Bootstrap and bootstrap-icons files into ecommerce/static/vendor/.'
+
+    def handle(self, *args, **options):
+        for path, (url, pinned) in VENDOR_ASSETS.items():
+            try:
+                response = requests.get(url, timeout=30)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                raise CommandError(f'Cannot download {url}: {e}')
+            body = response.content
+            actual = integrity(body, pinned.split('-', 1)[0] if pinned else 'sha384')
+            if pinned is None:
+                # Not written: a file is only trusted once its hash is in the code.
+                self.stderr.write(f'{path} skipped: no hash is pinned. Check {actual} against the release and '
+                                  f'add it to VENDOR_ASSETS; pages link the CDN copy until then.')
+                continue
+            if actual != pinned:
+                raise CommandError(f'{url} does not match its integrity hash.')
+            target = STATIC_DIR / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(body)
+            self.stdout.write(f'{path} ({len(body)} bytes)')
+        self.stdout.write(self.style.SUCCESS('Vendor assets downloaded; commit them and run collectstatic.'))
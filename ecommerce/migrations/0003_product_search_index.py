@@ -0,0 +1,40 @@
+from django.db import migrations
+
+FTS_TABLE = 'ecommerce_product_search'
+
+
+def fts5_available(connection):
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+def create_search_index(apps, schema_editor):
+    # Without FTS5 the app falls back to its in-process search index.
+    if not fts5_available(schema_editor.connection):
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "name, brand, category, description, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    schema_editor.execute(
+        f"INSERT INTO {FTS_TABLE}(rowid, name, brand, category, description) "
+        "SELECT id, name, brand, category, description FROM ecommerce_product"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('ecommerce', '0002_seed_products'),
+    ]
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
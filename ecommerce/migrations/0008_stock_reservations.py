@@ -0,0 +1,56 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+SHARDS = 8
+
+
+def create_shards(apps, schema_editor):
+    # Split each product's stock across its shards, as reservations.split does.
+    Product = apps.get_model('ecommerce', 'Product')
+    StockShard = apps.get_model('ecommerce', 'StockShard')
+    shards = []
+    for pk, stock in Product.objects.values_list('pk', 'stock').iterator():
+        base, extra = divmod(stock, SHARDS)
+        shards += [StockShard(product_id=pk, shard=shard, available=base + (1 if shard < extra else 0))
+                   for shard in range(SHARDS)]
+        if len(shards) >= 10000:
+            StockShard.objects.bulk_create(shards)
+            shards = []
+    StockShard.objects.bulk_create(shards)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0007_stripeevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reservation', models.CharField(db_index=True, max_length=64)),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('committed_at', models.DateTimeField(blank=True, null=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ecommerce.customer')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ecommerce.product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('available', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_shards', to='ecommerce.product')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('product', 'shard'), name='unique_product_shard')],
+            },
+        ),
+        migrations.RunPython(create_shards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:29
+
+from django.db import migrations, models
+
+
+def summarise_orders(apps, schema_editor):
+    # Same summary as orders.summarise, for orders placed before this migration.
+    Order = apps.get_model('ecommerce', 'Order')
+    OrderItem = apps.get_model('ecommerce', 'OrderItem')
+    last_pk = 0
+    while True:
+        ids = list(Order.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:2000])
+        if not ids:
+            return
+        orders = {pk: Order(pk=pk, item_count=0, first_product_name='', thumbnail='') for pk in ids}
+        rows = (OrderItem.objects.filter(order_id__in=ids).order_by('order_id', 'pk')
+                .values_list('order_id', 'quantity', 'product__name', 'product__image'))
+        for order_id, quantity, name, image in rows:
+            order = orders[order_id]
+            order.item_count += quantity
+            order.first_product_name = order.first_product_name or name
+            order.thumbnail = order.thumbnail or image or ''
+        Order.objects.bulk_update(orders.values(), ['item_count', 'first_product_name', 'thumbnail'])
+        last_pk = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0009_product_ratings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='first_product_name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='thumbnail',
+            field=models.ImageField(blank=True, upload_to='products/'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', 'created_at', 'id'], name='order_customer_created_idx'),
+        ),
+        migrations.RunPython(summarise_orders, migrations.RunPython.noop),
+    ]
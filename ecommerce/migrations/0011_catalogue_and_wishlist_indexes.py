@@ -0,0 +1,39 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:31
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_wishlist_items(apps, schema_editor):
+    # add_to_wishlist checked for a duplicate before inserting, which races.
+    WishlistItem = apps.get_model('ecommerce', 'WishlistItem')
+    duplicates = (
+        WishlistItem.objects.values('wishlist', 'product')
+        .annotate(lines=Count('id'), keep=Min('id'))
+        .filter(lines__gt=1)
+    )
+    for row in duplicates:
+        WishlistItem.objects.filter(wishlist=row['wishlist'], product=row['product']).exclude(pk=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0010_order_history_summary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'id'], name='product_category_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['brand', 'id'], name='product_brand_id_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_wishlist_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='wishlistitem',
+            constraint=models.UniqueConstraint(fields=('wishlist', 'product'), name='unique_wishlist_product'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.5 on 2026-10-18 19:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0014_product_sku'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRecommendation',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='recommendation', serialize=False, to='ecommerce.product')),
+                ('related', models.JSONField(default=list)),
+                ('built_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-18 19:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0015_productrecommendation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckoutSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reservation', models.CharField(max_length=64, unique=True)),
+                ('lines', models.JSONField()),
+                ('amount_total', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('cart', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='ecommerce.cart')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ecommerce.customer')),
+            ],
+        ),
+    ]
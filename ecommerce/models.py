@@ -11,6 +11,8 @@ class Customer(models.Model):
 
 
 class Product(models.Model):
+	# Supplier stock-keeping unit: the key manage.py import_products upserts on.
+	sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
 	name = models.CharField(max_length=100)
 	brand = models.CharField(max_length=50)
 	category = models.CharField(max_length=50)
@@ -18,9 +20,33 @@ class Product(models.Model):
 	price = models.DecimalField(max_digits=10, decimal_places=2)
 	stock = models.PositiveIntegerField()
 	image = models.ImageField(upload_to='products/', blank=True, null=True)
+	# Resized copies of image, written by ecommerce.images.
+	image_digest = models.CharField(max_length=16, blank=True)
+	image_variants = models.JSONField(default=dict, blank=True)
+	# When anything shown on the product page last changed; code that
+	# changes it with update() sets this too. Drives Last-Modified.
+	updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+	class Meta:
+		# Keyset pagination seeks on these; see ecommerce.pagination. The
+		# category and brand ones also serve the catalogue filters and facets.
+		indexes = [
+			models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+			models.Index(fields=['name', 'id'], name='product_name_id_idx'),
+			models.Index(fields=['category', 'id'], name='product_category_id_idx'),
+			models.Index(fields=['brand', 'id'], name='product_brand_id_idx'),
+		]
+
 	def __str__(self):
 		return self.name
 
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		# Remember the loaded state so signal handlers can tell what changed.
+		instance = super().from_db(db, field_names, values)
+		instance._loaded_values = dict(zip(field_names, values))
+		return instance
+
 
 class Cart(models.Model):
 	customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
@@ -34,6 +60,12 @@ class CartItem(models.Model):
 	cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
 	product = models.ForeignKey(Product, on_delete=models.CASCADE)
 	quantity = models.PositiveIntegerField(default=1)
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+		]
+
 	def __str__(self):
 		return f"{self.quantity} x {self.product.name}"
 
@@ -43,6 +75,19 @@ class Order(models.Model):
 	created_at = models.DateTimeField(auto_now_add=True)
 	total = models.DecimalField(max_digits=10, decimal_places=2)
 	status = models.CharField(max_length=20, default='Pending')
+	# Idempotency key: one order per Stripe checkout session.
+	stripe_session_id = models.CharField(max_length=255, unique=True, blank=True, null=True)
+	# Summary for order history, written with the order (see ecommerce.orders).
+	item_count = models.PositiveIntegerField(default=0)
+	first_product_name = models.CharField(max_length=100, blank=True)
+	thumbnail = models.ImageField(upload_to='products/', blank=True)
+
+	class Meta:
+		# Order history seeks on this; see ecommerce.pagination.
+		indexes = [
+			models.Index(fields=['customer', 'created_at', 'id'], name='order_customer_created_idx'),
+		]
+
 	def __str__(self):
 		return f"Order {self.id} by {self.customer.user.username}"
 
@@ -68,6 +113,12 @@ class WishlistItem(models.Model):
 	wishlist = models.ForeignKey(Wishlist, on_delete=models.CASCADE, related_name='items')
 	product = models.ForeignKey(Product, on_delete=models.CASCADE)
 	added_at = models.DateTimeField(auto_now_add=True)
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['wishlist', 'product'], name='unique_wishlist_product'),
+		]
+
 	def __str__(self):
 		return self.product.name
 
@@ -94,3 +145,111 @@ class Review(models.Model):
 	created_at = models.DateTimeField(auto_now_add=True)
 	def __str__(self):
 		return f"{self.rating} stars by {self.customer.user.username} for Order {self.order.id}"
+
+
+class ProductRating(models.Model):
+	# Review totals per product, kept up to date by ecommerce.ratings so the
+	# catalogue never aggregates Review -> Order -> OrderItem on a request.
+	product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='rating')
+	count = models.PositiveIntegerField(default=0)
+	total = models.PositiveIntegerField(default=0)
+	stars_1 = models.PositiveIntegerField(default=0)
+	stars_2 = models.PositiveIntegerField(default=0)
+	stars_3 = models.PositiveIntegerField(default=0)
+	stars_4 = models.PositiveIntegerField(default=0)
+	stars_5 = models.PositiveIntegerField(default=0)
+
+	@property
+	def average(self):
+		return round(self.total / self.count, 1) if self.count else None
+
+	@property
+	def histogram(self):
+		"""[(stars, count, percent)] from 5 stars down to 1."""
+		return [
+			(stars, getattr(self, f'stars_{stars}'), round(100 * getattr(self, f'stars_{stars}') / self.count) if self.count else 0)
+			for stars in range(5, 0, -1)
+		]
+
+	def __str__(self):
+		return f"{self.average} stars from {self.count} reviews for {self.product}"
+
+
+class CheckoutSnapshot(models.Model):
+	# The lines and prices a Stripe checkout session was created from; the
+	# webhook builds the order from these, not from the cart as it is by then.
+	reservation = models.CharField(max_length=64, unique=True)
+	customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
+	cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, blank=True, null=True)
+	# [[product id, quantity, unit price], ...] in cart order.
+	lines = models.JSONField()
+	# What Stripe should charge, in cents.
+	amount_total = models.PositiveIntegerField()
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	def __str__(self):
+		return f"Checkout {self.reservation} for {self.amount_total} cents"
+
+
+class ProductDeletion(models.Model):
+	# A deleted product's tombstone, so incremental exports can report it.
+	product_id = models.BigIntegerField()
+	deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+	def __str__(self):
+		return f"Product {self.product_id} deleted at {self.deleted_at}"
+
+
+class StripeEvent(models.Model):
+	# Webhook events as received; ecommerce.fulfilment works through them.
+	event_id = models.CharField(max_length=255, unique=True)
+	type = models.CharField(max_length=100)
+	session_id = models.CharField(max_length=255, blank=True, db_index=True)
+	payload = models.JSONField()
+	received_at = models.DateTimeField(auto_now_add=True)
+	processed_at = models.DateTimeField(blank=True, null=True)
+	attempts = models.PositiveIntegerField(default=0)
+	error = models.TextField(blank=True)
+	def __str__(self):
+		return f"{self.type} {self.event_id}"
+
+
+class StockShard(models.Model):
+	# A slice of a product's unreserved stock; see ecommerce.reservations.
+	product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_shards')
+	shard = models.PositiveSmallIntegerField()
+	available = models.IntegerField(default=0)
+	# Set by every update too, so incremental exports see stock moves.
+	updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['product', 'shard'], name='unique_product_shard'),
+		]
+
+	def __str__(self):
+		return f"{self.product_id}/{self.shard}: {self.available}"
+
+
+class StockHold(models.Model):
+	# Units held for a checkout until it is paid (committed_at set) or expires.
+	reservation = models.CharField(max_length=64, db_index=True)
+	customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
+	product = models.ForeignKey(Product, on_delete=models.CASCADE)
+	quantity = models.PositiveIntegerField()
+	expires_at = models.DateTimeField(db_index=True)
+	committed_at = models.DateTimeField(blank=True, null=True)
+
+	def __str__(self):
+		return f"{self.quantity} x {self.product_id} for {self.reservation}"
+
+
+class ProductRecommendation(models.Model):
+	# "Frequently bought together" for a product, best first, rebuilt from
+	# order history by ecommerce.recommendations (manage.py build_recommendations).
+	product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='recommendation')
+	related = models.JSONField(default=list)
+	built_at = models.DateTimeField()
+
+	def __str__(self):
+		return f"{len(self.related)} recommendations for {self.product}"
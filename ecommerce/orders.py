@@ -0,0 +1,131 @@
+"""
+Turning a paid cart into an order.
+
+``place_order`` does all of it in one transaction with a fixed number of
+statements, however many lines the cart has: the order row, committing the
+stock held for the checkout (see ``ecommerce.reservations``), one
+``bulk_create`` for the order items, the shipping row and the cart clean-up.
+If any product is short the whole transaction rolls back and ``OutOfStock``
+says which.
+
+The Stripe checkout session id is stored on the order under a unique
+constraint, so replaying the success page, or two requests racing on it,
+returns the order that already exists instead of charging stock twice.
+
+A checkout records a ``CheckoutSnapshot`` of the lines and prices Stripe
+was asked to charge (``record_checkout``). The webhook places the order from
+that snapshot, so a cart edited after checkout started cannot change what
+the paid order contains.
+
+Each order also stores a summary for order history (unit count, first
+product name and a thumbnail, the smallest variant from ecommerce.images), so
+listing orders never touches their items.
+"""
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+
+from . import images, reservations
+from .models import CartItem, CheckoutSnapshot, Order, OrderItem, Product, ShippingInfo
+from .reservations import OutOfStock
+
+
+class EmptyCart(Exception):
+    pass
+
+
+def unit_amount(price):
+    """A price in the smallest currency unit, as sent to Stripe."""
+    return int(price * 100)
+
+
+def record_checkout(customer, cart, reservation, items):
+    """Snapshot the CartItems a checkout session is created from; returns the CheckoutSnapshot."""
+    return CheckoutSnapshot.objects.create(
+        reservation=reservation, customer=customer, cart=cart,
+        lines=[[item.product_id, item.quantity, str(item.product.price)] for item in items],
+        amount_total=sum(unit_amount(item.product.price) * item.quantity for item in items),
+    )
+
+
+def snapshot_lines(snapshot):
+    """Return [(product, quantity, unit price)] of a snapshot; products deleted since are left out."""
+    products = Product.objects.in_bulk([product_id for product_id, _, _ in snapshot.lines])
+    return [(products[product_id], quantity, Decimal(price))
+            for product_id, quantity, price in snapshot.lines if product_id in products]
+
+
+SUMMARY_FIELDS = ('item_count', 'first_product_name', 'thumbnail')
+
+
+def summary(lines):
+    """Order summary fields from [(product, quantity)] in line order."""
+    lines = list(lines)
+    thumbnail = next((images.smallest(product) for product, _ in lines if product.image), '')
+    return {
+        'item_count': sum(quantity for _, quantity in lines),
+        'first_product_name': lines[0][0].name if lines else '',
+        'thumbnail': thumbnail,
+    }
+
+
+def summarise(order_ids):
+    """Recompute the stored summary of orders written without place_order, e.g. by bulk_create."""
+    orders = {pk: Order(pk=pk, **summary([])) for pk in order_ids}
+    items = OrderItem.objects.filter(order_id__in=list(orders)).select_related('product').order_by('order_id', 'pk')
+    lines = {}
+    for item in items:
+        lines.setdefault(item.order_id, []).append((item.product, item.quantity))
+    for pk, order_lines in lines.items():
+        for field, value in summary(order_lines).items():
+            setattr(orders[pk], field, value)
+    Order.objects.bulk_update(orders.values(), SUMMARY_FIELDS, batch_size=1000)
+
+
+def place_order(customer, cart, session_id=None, shipping=None, reservation=None, lines=None):
+    """
+    Create a paid order and take its products out of ``cart``.
+
+    The order holds ``lines``, [(product, quantity, unit price)] as from
+    ``snapshot_lines``, or else the cart's items at their current prices.
+
+    ``shipping`` holds ShippingInfo field values, or None. Stock comes from
+    the checkout's ``reservation`` when there is one (see
+    ecommerce.reservations). Returns ``(order, created)``; ``created`` is
+    False when an order for ``session_id`` already exists. Raises EmptyCart
+    or OutOfStock, leaving everything unchanged.
+    """
+    if session_id:
+        existing = Order.objects.filter(stripe_session_id=session_id).first()
+        if existing:
+            return existing, False
+    try:
+        with transaction.atomic():
+            if lines is None:
+                items = CartItem.objects.filter(cart=cart).select_related('product').order_by('pk')
+                lines = [(item.product, item.quantity, item.product.price) for item in items]
+            if not lines:
+                raise EmptyCart()
+            quantities = {product.pk: quantity for product, quantity, _ in lines}
+            total = sum(price * quantity for _, quantity, price in lines)
+            order = Order.objects.create(customer=customer, total=total, status='Paid',
+                                         stripe_session_id=session_id or None,
+                                         **summary((product, quantity) for product, quantity, _ in lines))
+            short = reservations.commit(reservation, customer, quantities)
+            if short:
+                raise OutOfStock([product for product, _, _ in lines if product.pk in short])
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, quantity=quantity, price=price)
+                for product, quantity, price in lines
+            ])
+            if shipping:
+                ShippingInfo.objects.create(customer=customer, order=order, **shipping)
+            if cart is not None:
+                CartItem.objects.filter(cart=cart, product_id__in=list(quantities)).delete()
+    except IntegrityError:
+        # Another request placed the order for this session first.
+        existing = Order.objects.filter(stripe_session_id=session_id).first() if session_id else None
+        if existing is None:
+            raise
+        return existing, False
+    return order, True
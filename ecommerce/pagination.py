@@ -0,0 +1,95 @@
+"""
+Keyset (cursor) pagination.
+
+Instead of ``OFFSET`` and ``COUNT(*)``, each page is fetched with a ``WHERE``
+clause that continues from the last row of the previous page, so page 5000
+costs the same index seek as page 1. The position is carried in an opaque,
+signed cursor token; the ordering must end in a unique key (the primary key)
+for positions to be unambiguous.
+"""
+from django.core import signing
+from django.db.models import Q
+
+CURSOR_SALT = 'ecommerce.pagination.cursor'
+
+
+def _flip(field):
+    return field[1:] if field.startswith('-') else '-' + field
+
+
+class CursorPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, estimated_total=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.estimated_total = estimated_total
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    def __init__(self, queryset, per_page, ordering=('pk',)):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = list(ordering)
+
+    def encode_cursor(self, direction, obj):
+        values = [getattr(obj, field.lstrip('-')) for field in self.ordering]
+        values = [value if isinstance(value, (int, float)) else str(value) for value in values]
+        return signing.dumps([direction, self.ordering, values], salt=CURSOR_SALT, compress=True)
+
+    def decode_cursor(self, cursor):
+        """Return (direction, values); a missing, tampered or foreign cursor means the first page."""
+        if not cursor:
+            return 'next', None
+        try:
+            direction, ordering, values = signing.loads(cursor, salt=CURSOR_SALT)
+        except (signing.BadSignature, ValueError, TypeError):
+            return 'next', None
+        if direction not in ('next', 'previous') or ordering != self.ordering:
+            return 'next', None
+        return direction, values
+
+    def _after(self, ordering, values):
+        # (a, b, c) > (x, y, z)  ==  a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        condition = Q()
+        for i, field in enumerate(ordering):
+            term = Q(**{f.lstrip('-'): v for f, v in zip(ordering[:i], values[:i])})
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            term &= Q(**{f'{field.lstrip("-")}__{lookup}': values[i]})
+            condition |= term
+        return condition
+
+    def get_page(self, cursor=None, estimated_total=None):
+        direction, values = self.decode_cursor(cursor)
+        ordering = self.ordering if direction == 'next' else [_flip(field) for field in self.ordering]
+        queryset = self.queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self._after(ordering, values))
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == 'previous':
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = self.encode_cursor('next', rows[-1])
+        if rows and has_previous:
+            previous_cursor = self.encode_cursor('previous', rows[0])
+        return CursorPage(rows, next_cursor, previous_cursor, estimated_total)
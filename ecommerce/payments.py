@@ -0,0 +1,98 @@
+"""
+Stripe API calls made while a shopper waits.
+
+They go through one ``stripe.StripeClient`` per process, built from
+``ECOMMERCE_STRIPE_CLIENT`` (see ``DEFAULTS``) on the SDK's own
+``RequestsClient``:
+
+* one ``requests`` session keeps connections to Stripe alive across
+  requests, at most ``MAX_CONNECTIONS`` of them; callers beyond that wait
+  for a free connection;
+* connecting is bounded by ``CONNECT_TIMEOUT`` seconds and every read by
+  ``TIMEOUT`` seconds;
+* the SDK retries connection errors, timeouts, 409s and 5xx responses up to
+  ``MAX_RETRIES`` times with jittered backoff, under one ``Idempotency-Key``
+  so Stripe never acts on a request twice.
+
+The SDK blocks, so the async API runs it on a worker thread of its own
+(``thread_sensitive=False``) and an ASGI event loop keeps serving other
+requests meanwhile. The session is closed at exit and when the settings
+change. Tests point ``API_BASE`` at ``ecommerce.stripe_stub.FakeStripeServer``.
+"""
+import atexit
+import threading
+
+import requests
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+DEFAULTS = {
+    'API_BASE': stripe.DEFAULT_API_BASE,
+    'CONNECT_TIMEOUT': 3.0,
+    'TIMEOUT': 10.0,
+    'MAX_RETRIES': 2,
+    'MAX_CONNECTIONS': 20,
+}
+
+_client = None
+_session = None
+_lock = threading.Lock()
+
+
+class PaymentError(Exception):
+    def __init__(self, message, status=None, body=None):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+
+
+def get_client():
+    """The process's StripeClient, built on first use."""
+    global _client, _session
+    with _lock:
+        if _client is None:
+            options = {**DEFAULTS, **getattr(settings, 'ECOMMERCE_STRIPE_CLIENT', {})}
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=options['MAX_CONNECTIONS'], pool_block=True,
+            )
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            http_client = stripe.RequestsClient(
+                timeout=(options['CONNECT_TIMEOUT'], options['TIMEOUT']), session=_session,
+            )
+            _client = stripe.StripeClient(
+                settings.STRIPE_SECRET_KEY, base_addresses={'api': options['API_BASE']},
+                max_network_retries=options['MAX_RETRIES'], http_client=http_client,
+            )
+        return _client
+
+
+@atexit.register
+def reset_clients():
+    """Close the pooled connections; the next call builds a new client."""
+    global _client, _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _client = _session = None
+
+
+@receiver(setting_changed)
+def _settings_changed(setting, **kwargs):
+    if setting in ('ECOMMERCE_STRIPE_CLIENT', 'STRIPE_SECRET_KEY'):
+        reset_clients()
+
+
+def _create_checkout_session(params):
+    try:
+        return get_client().checkout.sessions.create(params=params)
+    except stripe.error.StripeError as e:
+        raise PaymentError(f'Stripe error: {e.user_message or e}', e.http_status, e.json_body)
+
+
+async def create_checkout_session(**params):
+    return await sync_to_async(_create_checkout_session, thread_sensitive=False)(params)
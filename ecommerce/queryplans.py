@@ -0,0 +1,105 @@
+"""
+Query-plan regression checks.
+
+``PlanAudit`` walks the shopping funnel of ``ecommerce.benchmarks`` plus the
+account pages (order history and detail, reviews, wishlists, addresses) once
+with a cold cache, captures every statement each view runs and asks SQLite
+for its ``EXPLAIN QUERY PLAN``. A statement that filters rows (has a
+``WHERE``) but reads a table with a plain ``SCAN`` has lost its index. The
+cost of that grows with the table, so it shows up only in production. Unfiltered
+reads such as the first catalogue page, which stops after one page, are left
+alone.
+
+Run it with ``python manage.py check_query_plans`` on a generated dataset;
+the test suite runs it on a smaller one.
+"""
+import re
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .benchmarks import FunnelBenchmark, StepFailed
+from .models import Order, ShippingInfo, Wishlist, WishlistItem
+
+SCAN = re.compile(r'^SCAN (\w+)(.*)$')
+# Subqueries (e.g. the window a sliced prefetch filters on) are scanned by name too.
+SUBQUERY = re.compile(r'^(?:CO-ROUTINE|MATERIALIZE) (\w+)')
+WHERE = re.compile(r'\bWHERE\b', re.IGNORECASE)
+EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE')
+
+
+def explain(sql):
+    """Return the detail lines of SQLite's EXPLAIN QUERY PLAN for a statement."""
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def full_scans(plan):
+    """Tables a plan reads in full, without an index."""
+    subqueries = {match.group(1) for match in map(SUBQUERY.match, plan) if match}
+    tables = []
+    for detail in plan:
+        match = SCAN.match(detail)
+        if match is None or 'INDEX' in match.group(2) or match.group(1) in subqueries | {'CONSTANT'}:
+            continue
+        tables.append(match.group(1))
+    return tables
+
+
+def check_statement(sql):
+    """Return the tables a filtering statement scans in full, or []."""
+    if not sql.lstrip().upper().startswith(EXPLAINABLE) or not WHERE.search(sql):
+        return []
+    return full_scans(explain(sql))
+
+
+class PlanAudit(FunnelBenchmark):
+    def __init__(self):
+        super().__init__(iterations=1, warmup=0)
+        self.statements = {}
+
+    def measure(self, name, request, expected_status=(200,)):
+        with CaptureQueriesContext(connection) as queries:
+            response = super().measure(name, request, expected_status)
+        self.statements.setdefault(name, []).extend(query['sql'] for query in queries.captured_queries)
+        return response
+
+    def iteration(self, i, fake_stripe):
+        super().iteration(i, fake_stripe)
+        pk = self.products[0][0]
+        wishlist, _ = Wishlist.objects.get_or_create(customer=self.customer, name='Plan audit')
+        ShippingInfo.objects.get_or_create(customer=self.customer, order=None, defaults={
+            'address': '1 Audit Road', 'city': 'Springfield', 'postal_code': '1', 'country': 'US', 'phone': '1',
+        })
+        order = Order.objects.filter(customer=self.customer).latest('pk')
+        get = self.shopper.get
+        self.measure('order_history', lambda: get(reverse('ecommerce:order_history')))
+        self.measure('order_detail', lambda: get(reverse('ecommerce:order_detail', args=[order.pk])))
+        self.measure('leave_review', lambda: get(reverse('ecommerce:leave_review', args=[order.pk])))
+        self.measure('product_reviews', lambda: get(reverse('ecommerce:product_reviews', args=[pk])))
+        self.measure('add_to_wishlist', lambda: self.shopper.post(
+            reverse('ecommerce:add_to_wishlist', args=[pk]), {'wishlist_id': wishlist.pk}), (302,))
+        self.measure('wishlist_list', lambda: get(reverse('ecommerce:wishlist_list')))
+        self.measure('wishlist_detail', lambda: get(reverse('ecommerce:wishlist_detail', args=[wishlist.pk])))
+        item = WishlistItem.objects.get(wishlist=wishlist, product_id=pk)
+        self.measure('wishlist_add_to_cart', lambda: self.shopper.post(
+            reverse('ecommerce:wishlist_add_to_cart', args=[wishlist.pk, item.pk])), (302,))
+        WishlistItem.objects.get_or_create(wishlist=wishlist, product_id=pk)
+        self.measure('wishlist_move_to_cart', lambda: self.shopper.post(
+            reverse('ecommerce:wishlist_move_to_cart', args=[wishlist.pk]), {'all': '1'}), (302,))
+        self.measure('shipping_address_list', lambda: get(reverse('ecommerce:shipping_address_list')))
+
+    def run(self):
+        """Return {step: [(sql, [tables scanned in full])]} for the statements that lost their index."""
+        if connection.vendor != 'sqlite':
+            raise StepFailed('Query plans are only checked on SQLite.')
+        super().run()
+        problems = {}
+        for name, statements in self.statements.items():
+            for sql in dict.fromkeys(statements):
+                tables = check_statement(sql)
+                if tables:
+                    problems.setdefault(name, []).append((sql, tables))
+        return problems
@@ -0,0 +1,196 @@
+"""
+Per-view SQL statistics collected by ``QueryInstrumentationMiddleware``.
+
+Each worker process aggregates requests into one-minute windows of fixed
+bucket histograms (latency, DB time, query count) plus the SQL fingerprints
+that repeated within a single request, the usual sign of an N+1 loop. Windows
+older than ``WINDOW_MINUTES`` are dropped, so the numbers describe recent
+traffic. Processes publish their windows to the Django cache every
+``FLUSH_INTERVAL`` seconds, and ``collect`` merges every process's windows,
+which is what the stats endpoint and ``dump_query_stats`` report.
+"""
+import copy
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+
+from django.core.cache import cache
+
+WINDOW_MINUTES = 15
+FLUSH_INTERVAL = 10
+# A fingerprint executed this many times in one request counts as repeated.
+REPEAT_THRESHOLD = 5
+TOP_REPEATED = 10
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+PROCESSES_KEY = 'querystats:processes'
+PROCESS_KEY = 'querystats:process:{}'
+
+_SELECT_LIST_RE = re.compile(r'^SELECT (?:DISTINCT )?.*? FROM ', re.S)
+_IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+_NUMBER_RE = re.compile(r'\b\d+\b')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+
+
+def fingerprint(sql):
+    """Reduce a statement to its shape, so one query run per row collapses to one entry."""
+    sql = _SELECT_LIST_RE.sub('SELECT ... FROM ', sql)
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    return _IN_LIST_RE.sub('IN (...)', sql)[:300]
+
+
+def _bucket(bounds, value):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+def _new_view_stats():
+    return {
+        'requests': 0,
+        'queries': 0,
+        'db_ms': 0.0,
+        'total_ms': 0.0,
+        'latency': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        'db': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        'query_count': [0] * (len(QUERY_BUCKETS) + 1),
+        'repeated': {},
+    }
+
+
+def _merge_view_stats(into, stats):
+    for field in ('requests', 'queries', 'db_ms', 'total_ms'):
+        into[field] += stats[field]
+    for field in ('latency', 'db', 'query_count'):
+        into[field] = [a + b for a, b in zip(into[field], stats[field])]
+    for sql, count in stats['repeated'].items():
+        into['repeated'][sql] = into['repeated'].get(sql, 0) + count
+
+
+class RequestQueries:
+    """Collects the queries of one request; used as a connection execute wrapper."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.fingerprints[sql] += 1
+
+    def repeated(self):
+        repeated = Counter()
+        for sql, count in self.fingerprints.items():
+            if count >= REPEAT_THRESHOLD:
+                repeated[fingerprint(sql)] += count
+        return repeated
+
+
+class QueryStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = deque(maxlen=WINDOW_MINUTES)  # (minute, {view: stats})
+        self.last_flush = 0.0
+
+    def record(self, view_name, queries, total_seconds):
+        minute = int(time.time() // 60)
+        db_ms = queries.duration * 1000
+        total_ms = total_seconds * 1000
+        repeated = queries.repeated()
+        with self.lock:
+            if not self.windows or self.windows[-1][0] != minute:
+                self.windows.append((minute, {}))
+            stats = self.windows[-1][1].setdefault(view_name, _new_view_stats())
+            stats['requests'] += 1
+            stats['queries'] += queries.count
+            stats['db_ms'] += db_ms
+            stats['total_ms'] += total_ms
+            stats['latency'][_bucket(LATENCY_BUCKETS_MS, total_ms)] += 1
+            stats['db'][_bucket(LATENCY_BUCKETS_MS, db_ms)] += 1
+            stats['query_count'][_bucket(QUERY_BUCKETS, queries.count)] += 1
+            for sql, count in repeated.items():
+                stats['repeated'][sql] = stats['repeated'].get(sql, 0) + count
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return copy.deepcopy(list(self.windows))
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        key = PROCESS_KEY.format(os.getpid())
+        cache.set(key, self.snapshot(), WINDOW_MINUTES * 60)
+        processes = cache.get(PROCESSES_KEY) or set()
+        if key not in processes:
+            processes.add(key)
+            cache.set(PROCESSES_KEY, processes, None)
+
+    def reset(self):
+        with self.lock:
+            self.windows.clear()
+
+
+stats = QueryStats()
+
+
+def _percentile(histogram, bounds, fraction):
+    total = sum(histogram)
+    if not total:
+        return 0
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= total * fraction:
+            return bounds[i] if i < len(bounds) else None
+    return None
+
+
+def collect(minutes=WINDOW_MINUTES):
+    """
+    Merge the recent windows of every process into {view: summary}.
+
+    Percentiles are bucket upper bounds, None past the last bucket.
+    ``repeated`` lists the fingerprints that ran at least ``REPEAT_THRESHOLD``
+    times within one request, with the total number of executions.
+    """
+    stats.flush()
+    processes = cache.get(PROCESSES_KEY) or set()
+    snapshots = cache.get_many(list(processes))
+    if len(snapshots) < len(processes):
+        cache.set(PROCESSES_KEY, set(snapshots), None)
+    oldest = int(time.time() // 60) - minutes + 1
+    merged = {}
+    for windows in snapshots.values():
+        for minute, views in windows:
+            if minute < oldest:
+                continue
+            for view, view_stats in views.items():
+                _merge_view_stats(merged.setdefault(view, _new_view_stats()), view_stats)
+    summary = {}
+    for view, view_stats in sorted(merged.items()):
+        requests = view_stats['requests']
+        summary[view] = {
+            'requests': requests,
+            'avg_queries': round(view_stats['queries'] / requests, 1),
+            'avg_db_ms': round(view_stats['db_ms'] / requests, 2),
+            'avg_ms': round(view_stats['total_ms'] / requests, 2),
+            'p50_ms': _percentile(view_stats['latency'], LATENCY_BUCKETS_MS, 0.5),
+            'p95_ms': _percentile(view_stats['latency'], LATENCY_BUCKETS_MS, 0.95),
+            'p95_db_ms': _percentile(view_stats['db'], LATENCY_BUCKETS_MS, 0.95),
+            'p95_queries': _percentile(view_stats['query_count'], QUERY_BUCKETS, 0.95),
+            'repeated': Counter(view_stats['repeated']).most_common(TOP_REPEATED),
+        }
+    return summary
@@ -0,0 +1,114 @@
+"""
+Per-product rating summaries.
+
+A ``Review`` belongs to an order, so it rates every product on that order.
+Averaging those per product means joining Review -> Order -> OrderItem on
+every page, so instead each product has a ``ProductRating`` row (review
+count, star total and a 1-5 star histogram) that Review signals adjust in
+place with one ``UPDATE`` per review. The catalogue reads it with
+``select_related('rating')``, which adds a join and no queries.
+
+A review bumps the versions of the products it rates, which renews their
+cards and detail pages, and ``VERSION_KEY``, which the anonymous catalogue
+pages key on because their cards show ratings. The catalogue generation is
+left alone, so facet counts and filter fragments survive a new review.
+
+``rebuild`` recomputes the rows from the Review table, for data written
+without signals (``bulk_create``, raw SQL) or to correct drift; run it with
+``manage.py rebuild_ratings``.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from . import catalogue
+from .models import OrderItem, Product, ProductRating, Review
+
+STARS = range(1, 6)
+VERSION_KEY = 'ratings:version'
+
+
+def bucket(rating):
+    """The histogram column a rating counts towards; out-of-range ratings are clamped."""
+    return f'stars_{min(max(rating, STARS[0]), STARS[-1])}'
+
+
+def _touch(product_ids):
+    # The detail page shows the rating, so its Last-Modified moves too.
+    Product.objects.filter(pk__in=list(product_ids)).update(updated_at=timezone.now())
+
+
+def _bump_versions(product_ids):
+    catalogue.bump_product_versions(product_ids)
+    catalogue.bump_version(VERSION_KEY)
+
+
+def _order_products(order_id):
+    return list(OrderItem.objects.filter(order_id=order_id).values_list('product_id', flat=True).distinct())
+
+
+def _adjust(review, product_ids, sign):
+    if not product_ids:
+        return
+    if sign > 0:
+        ProductRating.objects.bulk_create([ProductRating(product_id=pk) for pk in product_ids], ignore_conflicts=True)
+    ratings = ProductRating.objects.filter(product_id__in=product_ids)
+    if sign < 0:
+        ratings = ratings.filter(count__gt=0)
+    star = bucket(review.rating)
+    ratings.update(
+        count=F('count') + sign,
+        total=F('total') + sign * review.rating,
+        **{star: F(star) + sign},
+    )
+    _touch(product_ids)
+    transaction.on_commit(lambda: _bump_versions(product_ids))
+
+
+def review_saved(review, created):
+    product_ids = _order_products(review.order_id)
+    if created:
+        _adjust(review, product_ids, 1)
+    else:
+        # The old rating is not known; recount the few products involved.
+        rebuild(product_ids)
+
+
+def review_deleted(review):
+    """Call before the review is deleted, while its order's items still exist."""
+    _adjust(review, _order_products(review.order_id), -1)
+
+
+def rebuild(product_ids=None):
+    """Recompute rating summaries from the Review table; returns how many products have reviews."""
+    reviews = Review.objects.all()
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        reviews = reviews.filter(order__items__product_id__in=product_ids)
+    rows = (
+        reviews.order_by().values_list('order__items__product_id')
+        .annotate(
+            count=Count('pk'),
+            total=Sum('rating'),
+            stars_1=Count('pk', filter=Q(rating__lte=1)),
+            stars_2=Count('pk', filter=Q(rating=2)),
+            stars_3=Count('pk', filter=Q(rating=3)),
+            stars_4=Count('pk', filter=Q(rating=4)),
+            stars_5=Count('pk', filter=Q(rating__gte=5)),
+        )
+    )
+    summaries = [
+        ProductRating(product_id=pk, count=count, total=total, stars_1=s1, stars_2=s2, stars_3=s3, stars_4=s4,
+                      stars_5=s5)
+        for pk, count, total, s1, s2, s3, s4, s5 in rows if pk is not None
+    ]
+    with transaction.atomic():
+        stale = ProductRating.objects.all()
+        if product_ids is not None:
+            stale = stale.filter(product_id__in=product_ids)
+        changed = set(stale.values_list('product_id', flat=True)) | {s.product_id for s in summaries}
+        stale.delete()
+        ProductRating.objects.bulk_create(summaries, batch_size=2000)
+        _touch(changed)
+        transaction.on_commit(lambda: _bump_versions(changed))
+    return len(summaries)
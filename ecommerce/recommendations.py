@@ -0,0 +1,285 @@
+"""
+"Frequently bought together" recommendations.
+
+``build`` (``manage.py build_recommendations``) streams every order line in
+order id order. It reads them with a chunked iterator, so memory does not
+grow with the order history. Each order becomes a basket whose product pairs
+count ``0.5 ** (age / half-life)``, so recent buying habits outweigh old
+ones. The pair weights are summed in a sparse co-occurrence matrix: packed
+``(product << 32 | other)`` keys in ``array`` buffers, folded into totals
+every ``FOLD_PAIRS`` pairs. With ``numpy`` (in requirements.txt) the folding
+and the top-k selection are vectorised, which is what makes tens of
+millions of order lines practical on one machine. Without it the totals are
+per-product dicts capped at ``MAX_PARTNERS`` entries: a product that goes
+over drops its lighter half, so memory stays bounded and only products with
+that many partners get approximate top lists.
+
+The best ``top_k`` products for each product are stored as one
+``ProductRecommendation`` row (a JSON list of ids). Pages read it with a
+primary key lookup, and ``related_ids`` keeps rows in a per-process LRU that
+is dropped when a new build is published. Products whose recommendations
+changed get their catalogue version bumped, so cached pages are rebuilt.
+"""
+import heapq
+import itertools
+import threading
+from array import array
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import catalogue
+from .models import OrderItem, Product, ProductRecommendation
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VERSION_KEY = 'recommendations:version'
+SHIFT = 32
+LOW_MASK = (1 << SHIFT) - 1
+# Products per basket that are paired; larger orders are truncated, as they
+# add n^2 pairs and say little about what goes together.
+MAX_BASKET = 50
+# Pairs buffered before they are folded into the totals.
+FOLD_PAIRS = 2_000_000
+# Folded numpy parts kept before they are merged.
+MAX_PARTS = 8
+# Pairs per product kept by the pure Python fold.
+MAX_PARTNERS = 1000
+ITERATOR_CHUNK_SIZE = 10_000
+WRITE_BATCH = 2000
+CACHE_SIZE = 10_000
+
+_cache = OrderedDict()
+_cache_version = None
+_cache_lock = threading.Lock()
+
+
+def baskets(since=None, chunk_size=ITERATOR_CHUNK_SIZE):
+    """Yield (order created_at, [product ids]) for each order, reading lines in chunks."""
+    lines = OrderItem.objects.order_by('order_id').values_list('order_id', 'order__created_at', 'product_id')
+    if since is not None:
+        lines = lines.filter(order__created_at__gte=since)
+    current, created_at, products = None, None, []
+    for order_id, order_created_at, product_id in lines.iterator(chunk_size=chunk_size):
+        if order_id != current:
+            if products:
+                yield created_at, products
+            current, created_at, products = order_id, order_created_at, []
+        products.append(product_id)
+    if products:
+        yield created_at, products
+
+
+def decay(created_at, now, half_life_days):
+    age = max((now - created_at).total_seconds(), 0) / 86400
+    return 0.5 ** (age / half_life_days)
+
+
+class CoOccurrence:
+    """Sparse, weighted product pair counts."""
+
+    def __init__(self):
+        self.keys = array('q')
+        self.weights = array('d')
+        self.totals = defaultdict(dict)
+        self.parts = []
+
+    def add(self, products, weight):
+        products = list(dict.fromkeys(products))[:MAX_BASKET]
+        if len(products) < 2:
+            return
+        keys, weights = self.keys, self.weights
+        for product in products:
+            high = product << SHIFT
+            for other in products:
+                if other != product:
+                    keys.append(high | other)
+                    weights.append(weight)
+        if len(keys) >= FOLD_PAIRS:
+            self.fold()
+
+    def fold(self):
+        keys, weights = self.keys, self.weights
+        self.keys, self.weights = array('q'), array('d')
+        if not keys:
+            return
+        if numpy is not None:
+            self.parts.append(_reduce(numpy.frombuffer(keys, numpy.int64), numpy.frombuffer(weights, numpy.float64)))
+            if len(self.parts) > MAX_PARTS:
+                self.parts = [self._merged()]
+            return
+        totals = self.totals
+        touched = set()
+        for key, weight in zip(keys, weights):
+            product, other = key >> SHIFT, key & LOW_MASK
+            others = totals[product]
+            others[other] = others.get(other, 0.0) + weight
+            touched.add(product)
+        for product in touched:
+            others = totals[product]
+            if len(others) > MAX_PARTNERS:
+                kept = heapq.nlargest(MAX_PARTNERS // 2, others.items(), key=lambda item: (item[1], -item[0]))
+                totals[product] = dict(kept)
+
+    def _merged(self):
+        if not self.parts:
+            return numpy.empty(0, numpy.int64), numpy.empty(0, numpy.float64)
+        return _reduce(numpy.concatenate([keys for keys, _ in self.parts]),
+                       numpy.concatenate([weights for _, weights in self.parts]))
+
+    def __len__(self):
+        """Distinct pairs (after fold())."""
+        if numpy is not None:
+            return sum(len(keys) for keys, _ in self.parts)
+        return sum(len(others) for others in self.totals.values())
+
+    def top(self, k, min_weight=0.0):
+        """Yield (product, [(other, weight)]) with the ``k`` heaviest pairs, by product id."""
+        self.fold()
+        if numpy is not None:
+            yield from self._top_numpy(k, min_weight)
+            return
+        for product in sorted(self.totals):
+            best = heapq.nsmallest(k, ((-weight, other) for other, weight in self.totals[product].items()
+                                       if weight >= min_weight))
+            if best:
+                yield product, [(other, -weight) for weight, other in best]
+
+    def _top_numpy(self, k, min_weight):
+        keys, weights = self._merged()
+        self.parts = [(keys, weights)]
+        products, others = keys >> SHIFT, keys & LOW_MASK
+        # By product, then heaviest first, then lowest id, like the pure Python path.
+        order = numpy.lexsort((others, -weights, products))
+        products, others, weights = products[order], others[order], weights[order]
+        starts = numpy.flatnonzero(numpy.r_[True, products[1:] != products[:-1]])
+        lengths = numpy.diff(numpy.r_[starts, len(products)])
+        rank = numpy.arange(len(products)) - numpy.repeat(starts, lengths)
+        keep = (rank < k) & (weights >= min_weight)
+        rows = zip(products[keep].tolist(), others[keep].tolist(), weights[keep].tolist())
+        for product, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield product, [(other, weight) for _, other, weight in group]
+
+
+def _reduce(keys, weights):
+    unique, inverse = numpy.unique(keys, return_inverse=True)
+    return unique, numpy.bincount(inverse.ravel(), weights=weights, minlength=len(unique))
+
+
+@dataclass
+class BuildStats:
+    orders: int = 0
+    pairs: int = 0
+    products: int = 0
+    changed: int = 0
+
+
+def build(top_k=10, half_life_days=None, since=None, min_weight=0.0, now=None):
+    """Rebuild every product's recommendations from order history; returns BuildStats."""
+    half_life_days = half_life_days or settings.ECOMMERCE_RECOMMENDATION_HALF_LIFE_DAYS
+    now = now or timezone.now()
+    stats = BuildStats()
+    matrix = CoOccurrence()
+    for created_at, products in baskets(since):
+        stats.orders += 1
+        matrix.add(products, decay(created_at, now, half_life_days))
+    matrix.fold()
+    stats.pairs = len(matrix)
+    existing = set(Product.objects.values_list('pk', flat=True).iterator(chunk_size=ITERATOR_CHUNK_SIZE))
+    related = {}
+    for product, best in matrix.top(top_k, min_weight):
+        if product in existing:
+            ids = [other for other, _ in best if other in existing]
+            if ids:
+                related[product] = ids
+    stats.products = len(related)
+    stats.changed = publish(related, now)
+    return stats
+
+
+def publish(related, built_at):
+    """Replace the stored recommendations with {product id: [ids]}; returns how many products changed."""
+    with transaction.atomic():
+        previous = dict(ProductRecommendation.objects.values_list('product_id', 'related')
+                        .iterator(chunk_size=ITERATOR_CHUNK_SIZE))
+        stale = [product for product in previous if product not in related]
+        rows = [ProductRecommendation(product_id=product, related=ids, built_at=built_at)
+                for product, ids in related.items() if previous.get(product) != ids]
+        for start in range(0, len(stale), WRITE_BATCH):
+            ProductRecommendation.objects.filter(product_id__in=stale[start:start + WRITE_BATCH]).delete()
+        ProductRecommendation.objects.bulk_create(rows, batch_size=WRITE_BATCH, update_conflicts=True,
+                                                  unique_fields=['product'], update_fields=['related', 'built_at'])
+        changed = stale + [row.product_id for row in rows]
+
+        def bump():
+            catalogue.bump_version(VERSION_KEY)
+            catalogue.bump_product_versions(changed)
+
+        transaction.on_commit(bump)
+    return len(changed)
+
+
+def reset_cache():
+    global _cache_version
+    with _cache_lock:
+        _cache.clear()
+        _cache_version = None
+
+
+def related_many(product_ids):
+    """Return {product id: (recommended ids, best first)}, from this process's LRU where possible."""
+    global _cache_version
+    version = catalogue.get_version(VERSION_KEY)
+    product_ids = list(dict.fromkeys(product_ids))
+    with _cache_lock:
+        if version != _cache_version:
+            _cache.clear()
+            _cache_version = version
+        found = {pk: _cache[pk] for pk in product_ids if pk in _cache}
+        for pk in found:
+            _cache.move_to_end(pk)
+    missing = [pk for pk in product_ids if pk not in found]
+    if missing:
+        loaded = dict(ProductRecommendation.objects.filter(pk__in=missing).values_list('pk', 'related'))
+        loaded = {pk: tuple(loaded.get(pk, ())) for pk in missing}
+        with _cache_lock:
+            if version == _cache_version:
+                _cache.update(loaded)
+                while len(_cache) > CACHE_SIZE:
+                    _cache.popitem(last=False)
+        found.update(loaded)
+    return found
+
+
+def related_ids(product_id):
+    return related_many([product_id])[product_id]
+
+
+def _products(ids, limit):
+    ids = list(ids)[:limit]
+    products = Product.objects.select_related('rating').in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
+
+
+def for_product(product_id, limit=None):
+    """Products frequently bought with one product."""
+    return _products(related_ids(product_id), limit or settings.ECOMMERCE_RECOMMENDATIONS_SHOWN)
+
+
+def for_cart(product_ids, limit=None):
+    """Products frequently bought with a cart's products, not already in it, best first."""
+    product_ids = list(product_ids)
+    scores = defaultdict(float)
+    for ids in related_many(product_ids).values():
+        for rank, other in enumerate(ids):
+            scores[other] += 1 / (rank + 1)
+    for pk in product_ids:
+        scores.pop(pk, None)
+    best = sorted(scores, key=lambda pk: (-scores[pk], pk))
+    return _products(best, limit or settings.ECOMMERCE_RECOMMENDATIONS_SHOWN)
@@ -0,0 +1,283 @@
+"""
+Stock reservations for checkout.
+
+A product's unreserved stock is split across ``SHARDS`` ``StockShard`` rows.
+Taking stock decrements one randomly chosen shard with a conditional
+``UPDATE ... WHERE available >= n``, so concurrent checkouts of a best seller
+mostly land on different rows instead of queueing on one. A whole cart is
+taken with one statement; only when a chosen shard runs short does it fall
+back to trying the product's other shards, and finally to draining several.
+
+``reserve`` takes the stock for a checkout and records it as ``StockHold``
+rows that expire after ``ECOMMERCE_RESERVATION_TTL`` seconds. ``release``
+(payment cancelled, Stripe session expired, or ``sweep`` after expiry) gives
+the units back. ``commit`` turns holds into sales when the order is placed.
+
+``Product.stock`` stays the on-hand figure shown to shoppers. Sales are not
+written to it one by one; ``sweep`` folds committed holds into it in batches,
+so a busy product row is written once per sweep rather than once per order.
+Run ``manage.py sweep_reservations`` every minute or so.
+"""
+import random
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import catalogue
+from .models import Product, StockHold, StockShard
+
+SHARDS = 8
+
+
+class OutOfStock(Exception):
+    def __init__(self, products):
+        self.products = list(products)
+        super().__init__('Not enough stock for ' + ', '.join(product.name for product in self.products))
+
+
+def hold_ttl():
+    return timedelta(seconds=settings.ECOMMERCE_RESERVATION_TTL)
+
+
+def split(total, shards=SHARDS):
+    base, extra = divmod(max(total, 0), shards)
+    return [base + (1 if shard < extra else 0) for shard in range(shards)]
+
+
+def _outstanding(product_ids):
+    """Units held or sold but not yet folded into Product.stock, per product."""
+    rows = (StockHold.objects.filter(product_id__in=product_ids)
+            .values_list('product_id').annotate(total=Sum('quantity')))
+    return dict(rows)
+
+
+def rebuild_shards(product_ids=None, chunk_size=2000):
+    """Recreate shards from Product.stock minus outstanding holds; returns products done."""
+    products = Product.objects.order_by('pk')
+    if product_ids is not None:
+        products = products.filter(pk__in=list(product_ids))
+    done = 0
+    last_pk = 0
+    while True:
+        chunk = list(products.filter(pk__gt=last_pk).values_list('pk', 'stock')[:chunk_size])
+        if not chunk:
+            return done
+        ids = [pk for pk, _ in chunk]
+        outstanding = _outstanding(ids)
+        with transaction.atomic():
+            StockShard.objects.filter(product_id__in=ids).delete()
+            StockShard.objects.bulk_create([
+                StockShard(product_id=pk, shard=shard, available=available)
+                for pk, stock in chunk
+                for shard, available in enumerate(split(stock - outstanding.get(pk, 0)))
+            ])
+        done += len(chunk)
+        last_pk = ids[-1]
+
+
+def _ensure_shards(product_id):
+    if not StockShard.objects.filter(product_id=product_id).exists():
+        rebuild_shards([product_id])
+
+
+def _case(quantities):
+    return Case(
+        *[When(product_id=pk, then=Value(q)) for pk, q in quantities.items()],
+        output_field=IntegerField(),
+    )
+
+
+def _pick(quantities):
+    """Match one randomly chosen shard of each product."""
+    condition = Q()
+    for pk in quantities:
+        condition |= Q(product_id=pk, shard=random.randrange(SHARDS))
+    return condition
+
+
+def _take_one(product_id, quantity):
+    first = random.randrange(SHARDS)
+    for offset in range(SHARDS):
+        shard = (first + offset) % SHARDS
+        if StockShard.objects.filter(product_id=product_id, shard=shard, available__gte=quantity).update(
+                available=F('available') - quantity, updated_at=timezone.now()):
+            return True
+    # No single shard holds enough: drain several, with the rows locked.
+    shards = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by('shard'))
+    if not shards:
+        _ensure_shards(product_id)
+        shards = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by('shard'))
+    if sum(max(s.available, 0) for s in shards) < quantity:
+        return False
+    for s in shards:
+        taken = min(max(s.available, 0), quantity)
+        if taken:
+            StockShard.objects.filter(pk=s.pk).update(available=F('available') - taken, updated_at=timezone.now())
+            quantity -= taken
+    return True
+
+
+def take(quantities):
+    """
+    Take {product id: quantity} from the shards; returns the product ids that
+    were short. Must run inside a transaction, which the caller rolls back if
+    anything was short.
+    """
+    quantities = {pk: q for pk, q in quantities.items() if q > 0}
+    if not quantities:
+        return []
+    savepoint = transaction.savepoint()
+    taken = (
+        StockShard.objects.filter(_pick(quantities), available__gte=_case(quantities))
+        .update(available=F('available') - _case(quantities), updated_at=timezone.now())
+    )
+    if taken == len(quantities):
+        transaction.savepoint_commit(savepoint)
+        return []
+    transaction.savepoint_rollback(savepoint)
+    return [pk for pk, quantity in quantities.items() if not _take_one(pk, quantity)]
+
+
+def give_back(quantities):
+    """Return {product id: quantity} to one shard of each product, in one statement."""
+    quantities = {pk: q for pk, q in quantities.items() if q}
+    if quantities:
+        StockShard.objects.filter(_pick(quantities)).update(available=F('available') + _case(quantities),
+                                                            updated_at=timezone.now())
+
+
+def available(product_ids):
+    """Return {product id: units free to reserve}; products without shards report their stock."""
+    product_ids = list(product_ids)
+    totals = dict(
+        StockShard.objects.filter(product_id__in=product_ids)
+        .values_list('product_id').annotate(total=Sum('available'))
+    )
+    missing = [pk for pk in product_ids if pk not in totals]
+    if missing:
+        totals.update(Product.objects.filter(pk__in=missing).values_list('pk', 'stock'))
+    return {pk: max(totals.get(pk, 0), 0) for pk in product_ids}
+
+
+def reserve(customer, quantities, ttl=None):
+    """Hold {product id: quantity} for a checkout; returns the reservation key or raises OutOfStock."""
+    reservation = uuid.uuid4().hex
+    expires_at = timezone.now() + (ttl or hold_ttl())
+    with transaction.atomic():
+        short = take(quantities)
+        if short:
+            raise OutOfStock(Product.objects.filter(pk__in=short).order_by('pk'))
+        StockHold.objects.bulk_create([
+            StockHold(reservation=reservation, customer=customer, product_id=pk, quantity=quantity,
+                      expires_at=expires_at)
+            for pk, quantity in quantities.items() if quantity > 0
+        ])
+    return reservation
+
+
+def _release(holds):
+    with transaction.atomic():
+        rows = list(holds.filter(committed_at__isnull=True).values_list('pk', 'product_id', 'quantity'))
+        if not rows:
+            return 0
+        StockHold.objects.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+        quantities = {}
+        for _, product_id, quantity in rows:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        give_back(quantities)
+    return len(rows)
+
+
+def release(reservation, customer=None):
+    """Give back a reservation's uncommitted holds; returns how many were released."""
+    holds = StockHold.objects.filter(reservation=reservation)
+    if customer is not None:
+        holds = holds.filter(customer=customer)
+    return _release(holds)
+
+
+def commit(reservation, customer, quantities):
+    """
+    Record {product id: quantity} as sold against a reservation.
+
+    Held units cover what they can; any shortfall is taken from the shards and
+    any surplus given back. Returns the product ids that were short. Must run
+    inside the order's transaction.
+    """
+    holds = StockHold.objects.filter(reservation=reservation, committed_at__isnull=True) if reservation else None
+    held = {}
+    if holds is not None:
+        for product_id, quantity in holds.values_list('product_id', 'quantity'):
+            held[product_id] = held.get(product_id, 0) + quantity
+    extra = {pk: q - held.get(pk, 0) for pk, q in quantities.items() if q > held.get(pk, 0)}
+    surplus = {pk: h - quantities.get(pk, 0) for pk, h in held.items() if h > quantities.get(pk, 0)}
+    short = take(extra)
+    if short:
+        return short
+    give_back(surplus)
+    if held:
+        holds.delete()
+    now = timezone.now()
+    StockHold.objects.bulk_create([
+        StockHold(reservation=reservation or '', customer=customer, product_id=pk, quantity=quantity,
+                  expires_at=now, committed_at=now)
+        for pk, quantity in quantities.items()
+    ])
+    return []
+
+
+def _bump_versions(product_ids):
+    for pk in product_ids:
+        catalogue.bump_product_version(pk)
+
+
+def sweep(now=None, batch_size=5000):
+    """
+    Release expired holds and fold committed ones into Product.stock.
+
+    Returns (holds released, sales folded).
+    """
+    now = now or timezone.now()
+    released = _release(StockHold.objects.filter(committed_at__isnull=True, expires_at__lt=now))
+    folded = 0
+    while True:
+        with transaction.atomic():
+            rows = list(StockHold.objects.filter(committed_at__isnull=False)
+                        .order_by('pk').values_list('pk', 'product_id', 'quantity')[:batch_size])
+            if not rows:
+                break
+            sold = {}
+            for _, product_id, quantity in rows:
+                sold[product_id] = sold.get(product_id, 0) + quantity
+            StockHold.objects.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+            Product.objects.filter(pk__in=list(sold)).update(stock=Greatest(
+                F('stock') - Case(*[When(pk=pk, then=Value(q)) for pk, q in sold.items()],
+                                  output_field=IntegerField()),
+                Value(0),
+            ), updated_at=timezone.now())
+            transaction.on_commit(lambda sold=sold: _bump_versions(sold))
+        folded += len(rows)
+    return released, folded
+
+
+def product_saved(product, created):
+    """Keep shards in step with stock edited on the Product itself, e.g. a restock."""
+    if created:
+        StockShard.objects.bulk_create([
+            StockShard(product=product, shard=shard, available=units)
+            for shard, units in enumerate(split(product.stock))
+        ], ignore_conflicts=True)
+        return
+    loaded = getattr(product, '_loaded_values', None)
+    if loaded is None or 'stock' not in loaded:
+        rebuild_shards([product.pk])
+        return
+    delta = product.stock - loaded['stock']
+    if delta:
+        _ensure_shards(product.pk)
+        give_back({product.pk: delta})
@@ -0,0 +1,226 @@
+"""
+Read/write splitting between the primary database and read replicas.
+
+``ReplicaRouter`` sends every write to ``default``, and every read it is not
+sure about as well. A read goes to a replica (an alias listed in
+``ECOMMERCE_DB_REPLICAS``) only when all of these hold:
+
+* it runs in a GET or HEAD request, which ``ReplicaMiddleware`` marks;
+  commands, webhooks, background threads and form posts read the primary;
+* the model is in ``REPLICA_MODELS``: the catalogue and order history;
+* no transaction is open on the primary;
+* the browser has not written anything in the last
+  ``ECOMMERCE_PRIMARY_STICKY_SECONDS``. A request that writes sets a
+  short-lived cookie, so shoppers always see their own changes;
+* the replica passed its last health check, which runs at most every
+  ``HEALTH_INTERVAL`` seconds;
+* it is not rendering a page that is cached or ETagged under a catalogue
+  version (see ``ecommerce.caching``). A lagging replica would otherwise
+  store old content under the new version; those views read inside
+  ``primary_reads()``, which costs the primary one render per cache miss.
+
+A request picks one healthy replica and keeps it. If a replica fails during a
+GET, it is marked unhealthy and the request is served again from the
+primary.
+
+Replication happens outside Django. To try this with two local SQLite files,
+set ``DB_REPLICA`` and refresh the copy with ``manage.py sync_replicas``.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.http import HttpResponse
+
+PRIMARY = 'default'
+REPLICA_MODELS = {
+    'ecommerce.product',
+    'ecommerce.productrating',
+    'ecommerce.review',
+    'ecommerce.order',
+    'ecommerce.orderitem',
+    'ecommerce.shippinginfo',
+}
+# Writes to these do not pin a browser to the primary.
+UNTRACKED_APPS = {'sessions'}
+PIN_COOKIE = 'db_primary_until'
+HEALTH_INTERVAL = 10
+SAFE_METHODS = ('GET', 'HEAD')
+
+_health = {}
+
+
+def replicas():
+    return list(getattr(settings, 'ECOMMERCE_DB_REPLICAS', []))
+
+
+def check(alias):
+    """Return True if the replica answers and has the schema."""
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT 1 FROM django_migrations LIMIT 1')
+        return True
+    except DatabaseError:
+        connections[alias].close()
+        return False
+
+
+def is_healthy(alias):
+    now = time.monotonic()
+    healthy, checked_at = _health.get(alias, (None, 0))
+    if healthy is None or now - checked_at >= HEALTH_INTERVAL:
+        healthy = check(alias)
+        _health[alias] = (healthy, now)
+    return healthy
+
+
+def mark_unhealthy(alias):
+    _health[alias] = (False, time.monotonic())
+    connections[alias].close()
+
+
+def reset_health():
+    _health.clear()
+
+
+class _Route:
+    """Routing state of one request."""
+
+    def __init__(self, use_replicas):
+        self.use_replicas = use_replicas
+        self.replica = None
+        self.wrote = False
+
+    def pick(self):
+        if self.replica is None and self.use_replicas:
+            healthy = [alias for alias in replicas() if is_healthy(alias)]
+            if healthy:
+                self.replica = random.choice(healthy)
+            else:
+                self.use_replicas = False
+        return self.replica
+
+
+_route = ContextVar('ecommerce_db_route', default=None)
+
+
+@contextmanager
+def primary_reads():
+    """Send the current request's reads to the primary inside the block."""
+    route = _route.get()
+    if route is None or not route.use_replicas:
+        yield
+        return
+    route.use_replicas = False
+    try:
+        yield
+    finally:
+        route.use_replicas = True
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # Always answer: with no answer Django would follow the instance the
+        # query came from, which may have been loaded from a replica.
+        route = _route.get()
+        if (route is None or not route.use_replicas
+                or model._meta.label_lower not in REPLICA_MODELS
+                or connections[PRIMARY].in_atomic_block):
+            return PRIMARY
+        return route.pick() or PRIMARY
+
+    def db_for_write(self, model, **hints):
+        route = _route.get()
+        if route is not None and model._meta.app_label not in UNTRACKED_APPS:
+            route.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary, with the data.
+        if db in replicas():
+            return False
+        return None
+
+
+def _pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def _use_replicas(request):
+    return bool(replicas()) and request.method in SAFE_METHODS and not _pinned(request)
+
+
+def _retry_on_primary(request, route):
+    mark_unhealthy(route.replica)
+    route = _Route(False)
+    _route.set(route)
+    request._replica_failed = False
+    return route
+
+
+class ReplicaMiddleware:
+    """Let safe requests read from replicas, and pin browsers that write to the primary."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        route = _Route(_use_replicas(request))
+        token = _route.set(route)
+        try:
+            response = self.get_response(request)
+            if getattr(request, '_replica_failed', False):
+                route = _retry_on_primary(request, route)
+                response = self.get_response(request)
+        finally:
+            _route.reset(token)
+        return self._finish(response, route)
+
+    async def __acall__(self, request):
+        # The route is a context variable, which sync_to_async carries into
+        # the threads that run the ORM.
+        route = _Route(_use_replicas(request))
+        token = _route.set(route)
+        try:
+            response = await self.get_response(request)
+            if getattr(request, '_replica_failed', False):
+                route = _retry_on_primary(request, route)
+                response = await self.get_response(request)
+        finally:
+            _route.reset(token)
+        return self._finish(response, route)
+
+    def _finish(self, response, route):
+        if route.wrote:
+            window = settings.ECOMMERCE_PRIMARY_STICKY_SECONDS
+            response.set_cookie(PIN_COOKIE, str(time.time() + window), max_age=window, httponly=True,
+                                samesite='Lax')
+        return response
+
+    def process_exception(self, request, exception):
+        route = _route.get()
+        if isinstance(exception, DatabaseError) and route is not None and route.replica is not None:
+            # Handled here so Django does not log a 500; __call__ retries.
+            request._replica_failed = True
+            return HttpResponse(status=503)
+        return None
@@ -0,0 +1,289 @@
+"""
+Product search.
+
+Products are indexed on name, brand, category and description. On SQLite the
+index is an FTS5 virtual table (created by migration 0003) so lookups go
+through the inverted index instead of scanning ``ecommerce_product``. Other
+backends, or SQLite builds without FTS5, fall back to an in-process inverted
+index that is loaded lazily and kept current by the Product signals.
+
+Every query term is matched as a prefix ("lap" finds "laptop") and all terms
+must match. Results are ranked by relevance, name matches weighing the most,
+and cut to the best ``RESULT_LIMIT`` after the queryset's own filters, so a
+category or brand filter never hides matches ranked below the cut.
+"""
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from collections import defaultdict
+from math import log
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, F, FloatField, Func, IntegerField, Value, When
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+FTS_TABLE = 'ecommerce_product_search'
+
+# Relevance weight of a hit in each indexed column.
+FIELD_WEIGHTS = {
+    'name': 10.0,
+    'brand': 5.0,
+    'category': 3.0,
+    'description': 1.0,
+}
+
+# Only the best matches are paginated; nobody pages past this many hits.
+RESULT_LIMIT = 1000
+# Ranked ids checked against the queryset's filters per query.
+LOOKUP_SLICE = 500
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _no_results(queryset):
+    # Keep the annotation so callers can still order by search_rank.
+    return queryset.annotate(search_rank=Value(0)).none()
+
+
+class FTS5Backend:
+    name = 'fts5'
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    def _bm25(self):
+        weights = ', '.join(str(w) for w in FIELD_WEIGHTS.values())
+        return f'bm25({FTS_TABLE}, {weights})'
+
+    def _match_expression(self, query):
+        tokens = tokenize(query)
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    def index(self, products):
+        rows = [(p.pk, p.name, p.brand, p.category, p.description) for p in products]
+        if not rows:
+            return
+        with connections[self.using].cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(row[0],) for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE}(rowid, name, brand, category, description) VALUES (%s, %s, %s, %s, %s)',
+                rows,
+            )
+
+    def remove(self, product_ids):
+        with connections[self.using].cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in product_ids])
+
+    def clear(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+    def search_ids(self, query, limit=RESULT_LIMIT):
+        match = self._match_expression(query)
+        if not match:
+            return []
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY {self._bm25()} LIMIT %s',
+                [match, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def _rank(self, match):
+        # Correlated on the product id through an expression, so it also
+        # works where the product table is aliased, inside a subquery.
+        return Func(Value(match), F('pk'), arg_joiner=' AND rowid = ', output_field=FloatField(),
+                    template=f'(SELECT {self._bm25()} FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %(expressions)s)')
+
+    def matching_ids(self, queryset, query, limit=RESULT_LIMIT):
+        """The ``limit`` (None: all) best matches within ``queryset``, as an id subquery."""
+        match = self._match_expression(query)
+        if not match:
+            return []
+        matches = queryset.filter(pk__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', (match,)))
+        if limit is None:
+            return matches.values('pk')
+        return matches.annotate(search_rank=self._rank(match)).order_by('search_rank', 'pk').values('pk')[:limit]
+
+    def filter_queryset(self, queryset, query, limit=RESULT_LIMIT):
+        match = self._match_expression(query)
+        if not match:
+            return _no_results(queryset)
+        return (queryset.filter(pk__in=self.matching_ids(queryset, query, limit))
+                .annotate(search_rank=self._rank(match)).order_by('search_rank', 'pk'))
+
+
+class PythonBackend:
+    """
+    In-memory index for one process. It only sees the Product changes made
+    in that process (signals and imports), so run a single worker with it,
+    or restart the others after catalogue changes; use FTS5 otherwise.
+    """
+    name = 'python'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._postings = defaultdict(dict)  # token -> {product id: weight}
+        self._documents = {}  # product id -> set of tokens
+        self._vocabulary = []  # sorted tokens, for prefix lookups
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                self.index(Product.objects.only(*FIELD_WEIGHTS).iterator(chunk_size=2000))
+
+    def _add(self, product):
+        weights = defaultdict(float)
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(getattr(product, field)):
+                weights[token] += weight
+        for token, weight in weights.items():
+            if token not in self._postings:
+                insort(self._vocabulary, token)
+            self._postings[token][product.pk] = weight
+        self._documents[product.pk] = set(weights)
+
+    def _discard(self, product_id):
+        for token in self._documents.pop(product_id, ()):
+            postings = self._postings[token]
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect_left(self._vocabulary, token)]
+
+    def index(self, products):
+        with self._lock:
+            for product in products:
+                self._discard(product.pk)
+                self._add(product)
+
+    def remove(self, product_ids):
+        with self._lock:
+            for pk in product_ids:
+                self._discard(pk)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._vocabulary.clear()
+            self._loaded = True
+
+    def _expand(self, prefix):
+        start = bisect_left(self._vocabulary, prefix)
+        for token in self._vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            yield token
+
+    def search_ids(self, query, limit=RESULT_LIMIT):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        self._ensure_loaded()
+        with self._lock:
+            total = len(self._documents) or 1
+            scores = None
+            for prefix in tokens:
+                term_scores = defaultdict(float)
+                for token in self._expand(prefix):
+                    postings = self._postings[token]
+                    idf = log(1 + total / len(postings))
+                    for pk, weight in postings.items():
+                        term_scores[pk] += weight * idf
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {pk: score + term_scores[pk] for pk, score in scores.items() if pk in term_scores}
+                if not scores:
+                    return []
+        ranked = sorted(scores.items(), key=lambda hit: (-hit[1], hit[0]))
+        return [pk for pk, _ in ranked[:limit]]
+
+    def matching_ids(self, queryset, query, limit=RESULT_LIMIT):
+        """The ``limit`` (None: all) best matches within ``queryset``, best first."""
+        ranked = self.search_ids(query, limit=None)
+        ids = []
+        for start in range(0, len(ranked), LOOKUP_SLICE):
+            chunk = ranked[start:start + LOOKUP_SLICE]
+            allowed = set(queryset.filter(pk__in=chunk).values_list('pk', flat=True))
+            ids += [pk for pk in chunk if pk in allowed]
+            if limit is not None and len(ids) >= limit:
+                break
+        return ids[:limit]
+
+    def filter_queryset(self, queryset, query, limit=RESULT_LIMIT):
+        ids = self.matching_ids(queryset, query, limit)
+        if not ids:
+            return _no_results(queryset)
+        rank = Case(*[When(pk=pk, then=Value(i)) for i, pk in enumerate(ids)], output_field=IntegerField())
+        return queryset.filter(pk__in=ids).annotate(search_rank=rank).order_by('search_rank')
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def fts5_table_exists(using='default'):
+    connection = connections[using]
+    return connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                choice = getattr(settings, 'ECOMMERCE_SEARCH_BACKEND', 'auto')
+                if choice == 'fts5' or (choice == 'auto' and fts5_table_exists()):
+                    _backend = FTS5Backend()
+                else:
+                    _backend = PythonBackend()
+    return _backend
+
+
+def reset_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def index_products(products):
+    get_backend().index(products)
+
+
+def remove_products(product_ids):
+    get_backend().remove(product_ids)
+
+
+def rebuild_index(chunk_size=2000):
+    backend = get_backend()
+    backend.clear()
+    batch = []
+    count = 0
+    for product in Product.objects.only(*FIELD_WEIGHTS).iterator(chunk_size=chunk_size):
+        batch.append(product)
+        if len(batch) >= chunk_size:
+            backend.index(batch)
+            count += len(batch)
+            batch = []
+    backend.index(batch)
+    return count + len(batch)
+
+
+def search_products(queryset, query):
+    return get_backend().filter_queryset(queryset, query)
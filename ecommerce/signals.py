@@ -0,0 +1,64 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import catalogue, dbprofile, export, facets, images, ratings, reservations, search
+from .cartstore import CartStore
+from .models import Product, Review
+
+
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    dbprofile.configure(connection)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    search.index_products([instance])
+    facets.product_saved(instance, created)
+    reservations.product_saved(instance, created)
+    images.product_saved(instance, created)
+    transaction.on_commit(lambda: catalogue.bump_product_version(instance.pk))
+    instance._loaded_values = {
+        field.attname: instance.__dict__[field.attname]
+        for field in instance._meta.concrete_fields
+        if field.attname in instance.__dict__
+    }
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+    facets.product_deleted(instance)
+    export.product_deleted(instance)
+    pk = instance.pk
+    transaction.on_commit(lambda: catalogue.bump_product_version(pk))
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        ratings.review_saved(instance, created)
+
+
+@receiver(pre_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    # pre_delete: when a whole order is deleted its items go in the same pass.
+    ratings.review_deleted(instance)
+
+
+@receiver(user_logged_in)
+def merge_session_cart(sender, request, user, **kwargs):
+    if request is None or not hasattr(request, 'session'):
+        return
+    CartStore(session=request.session).merge_into(CartStore(user))
+
+
+@receiver(user_logged_out)
+def flush_cart_on_logout(sender, request, user, **kwargs):
+    if user is not None:
+        CartStore(user).flush()
@@ -0,0 +1,254 @@
+"""
+In-memory stand-in for the Stripe Checkout API.
+
+``FakeStripe`` patches ``stripe.checkout.Session.create`` and ``retrieve`` so
+the checkout views run without network access or API keys. Sessions are real
+``stripe.checkout.Session`` objects built from dicts, so views see the same
+attribute and ``.get`` access as with the live SDK.
+
+    with FakeStripe() as fake:
+        client.post(reverse('ecommerce:create_checkout_session'))
+        session = fake.last_session
+
+``send_webhook`` plays Stripe's side of the webhook: it builds the event for a
+session, signs it the way Stripe does and posts it to the webhook view.
+
+``FakeStripeServer`` serves the same sessions over local HTTP for
+``ecommerce.payments``, with injectable delays and failures:
+
+    with FakeStripeServer() as server, override_settings(
+            ECOMMERCE_STRIPE_CLIENT={'API_BASE': server.url}):
+        ...
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from urllib.parse import parse_qsl
+from unittest import mock
+
+import stripe
+from django.urls import reverse
+
+DEFAULT_SHIPPING = {
+    'name': 'Test Shopper',
+    'phone': '5550100',
+    'address': {
+        'line1': '1 Test Street',
+        'city': 'Testville',
+        'postal_code': '12345',
+        'country': 'US',
+    },
+}
+
+
+class FakeStripe:
+    def __init__(self, shipping_details=DEFAULT_SHIPPING):
+        self.shipping_details = shipping_details
+        self.sessions = {}
+        self.calls = []
+        self._patches = []
+
+    def create(self, **params):
+        self.calls.append(('create', params))
+        session_id = f'cs_test_{uuid.uuid4().hex}'
+        amount = sum(
+            item['price_data']['unit_amount'] * item['quantity'] for item in params.get('line_items', [])
+        )
+        values = {
+            'id': session_id,
+            'object': 'checkout.session',
+            'url': f'https://checkout.stripe.test/pay/{session_id}',
+            'mode': params.get('mode'),
+            'status': 'open',
+            'payment_status': 'unpaid',
+            'amount_total': amount,
+            'currency': 'usd',
+            'success_url': params.get('success_url'),
+            'cancel_url': params.get('cancel_url'),
+            'client_reference_id': params.get('client_reference_id'),
+            'metadata': params.get('metadata', {}),
+            'shipping_details': self.shipping_details,
+        }
+        self.sessions[session_id] = values
+        return stripe.checkout.Session.construct_from(values, 'sk_test_fake')
+
+    def retrieve(self, session_id, **params):
+        self.calls.append(('retrieve', session_id))
+        if session_id not in self.sessions:
+            raise stripe.error.InvalidRequestError(f'No such checkout.session: {session_id}', 'id')
+        return stripe.checkout.Session.construct_from(self.sessions[session_id], 'sk_test_fake')
+
+    def complete(self, session_id):
+        """Mark a session as paid, as Stripe does when the customer pays."""
+        self.sessions[session_id].update(status='complete', payment_status='paid')
+        return self.sessions[session_id]
+
+    def expire(self, session_id):
+        """Mark a session as expired, as Stripe does once ``expires_at`` passes unpaid."""
+        self.sessions[session_id].update(status='expired')
+        return self.sessions[session_id]
+
+    def event(self, session_id, type='checkout.session.completed'):
+        return {
+            'id': f'evt_test_{uuid.uuid4().hex}',
+            'object': 'event',
+            'type': type,
+            'created': int(time.time()),
+            'data': {'object': dict(self.sessions[session_id])},
+        }
+
+    def send_webhook(self, client, session_id, secret, type='checkout.session.completed', event=None):
+        """Post a signed event for the session to the webhook view; returns the response."""
+        payload = json.dumps(event or self.event(session_id, type))
+        return client.post(reverse('ecommerce:stripe_webhook'), payload, content_type='application/json',
+                           HTTP_STRIPE_SIGNATURE=sign_payload(payload, secret))
+
+    @property
+    def last_session(self):
+        return next(reversed(self.sessions.values()), None)
+
+    async def create_async(self, **params):
+        return self.create(**params)
+
+    def __enter__(self):
+        self._patches = [
+            mock.patch.object(stripe.checkout.Session, 'create', self.create),
+            mock.patch.object(stripe.checkout.Session, 'retrieve', self.retrieve),
+            mock.patch('ecommerce.payments.create_checkout_session', self.create_async),
+        ]
+        for patch in self._patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for patch in reversed(self._patches):
+            patch.stop()
+        self._patches = []
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Return a Stripe-Signature header for ``payload``."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+_KEY_PART_RE = re.compile(r'\[([^\]]*)\]')
+
+
+def decode_form(body):
+    """Rebuild the nested params that Stripe's form encoding (``a[b][0][c]=v``) flattened."""
+    params = {}
+    for name, value in parse_qsl(body, keep_blank_values=True):
+        keys = [name.split('[', 1)[0]] + _KEY_PART_RE.findall(name)
+        value = int(value) if value.isdigit() else value
+        node = params
+        for key, next_key in zip(keys, keys[1:]):
+            child = [] if next_key.isdigit() else {}
+            if isinstance(node, list):
+                # List items arrive in order, so a new index is the next one.
+                if int(key) == len(node):
+                    node.append(child)
+                node = node[int(key)]
+            else:
+                node = node.setdefault(key, child)
+        if isinstance(node, list):
+            node.append(value)
+        else:
+            node[keys[-1]] = value
+    return params
+
+
+class FakeStripeServer:
+    """
+    A local HTTP server for the Checkout Session endpoints.
+
+    ``delay`` (seconds) slows every response; ``fail(status, times)`` makes the
+    next responses fail. ``connections`` counts TCP connections accepted and
+    ``requests`` records (method, path, Idempotency-Key) per request.
+    """
+
+    def __init__(self, stripe=None):
+        self.stripe = stripe or FakeStripe()
+        self.delay = 0
+        self.failures = deque()
+        self.connections = 0
+        self.requests = []
+        self.url = None
+        self._loop = None
+        self._thread = None
+
+    def fail(self, status=500, times=1):
+        self.failures.extend([status] * times)
+
+    def _handle(self, method, path, body):
+        if method == 'POST' and path == '/v1/checkout/sessions':
+            return 200, self.stripe.sessions[self.stripe.create(**decode_form(body)).id]
+        match = re.fullmatch(r'/v1/checkout/sessions/([\w-]+)', path)
+        if method == 'GET' and match and match.group(1) in self.stripe.sessions:
+            return 200, self.stripe.sessions[match.group(1)]
+        return 404, {'error': {'message': f'Unrecognized request URL ({method}: {path}).'}}
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b''):
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = (await reader.readexactly(int(headers.get('content-length', 0)))).decode()
+                self.requests.append((method, path, headers.get('idempotency-key')))
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                if self.failures:
+                    status, data = self.failures.popleft(), {'error': {'message': 'Injected failure.'}}
+                else:
+                    status, data = self._handle(method, path, body)
+                payload = json.dumps(data).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Client hung up, or the server is shutting down.
+            pass
+        finally:
+            writer.close()
+
+    def __enter__(self):
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            server = self._loop.run_until_complete(asyncio.start_server(self._serve, '127.0.0.1', 0))
+            self.url = f'http://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+            started.set()
+            self._loop.run_forever()
+            server.close()
+            connections = asyncio.all_tasks(self._loop)
+            for task in connections:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*connections, return_exceptions=True))
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -0,0 +1,34 @@
+from django import template
+from django.core.files.storage import default_storage
+
+register = template.Library()
+
+
+def _srcset(storage, variants):
+    return ', '.join(f'{storage.url(name)} {width}w' for width, _, name in variants)
+
+
+@register.inclusion_tag('ecommerce/includes/product_image.html')
+def product_image(product, sizes='100vw', css_class='', lazy=True):
+    """
+    A product's image as ``<picture>`` with WebP and JPEG ``srcset``, falling
+    back to the original until ecommerce.images has built the variants.
+    """
+    context = {'alt': product.name, 'css_class': css_class, 'sizes': sizes, 'lazy': lazy}
+    if not product.image:
+        return context
+    variants = product.image_variants or {}
+    jpeg = variants.get('jpeg')
+    if not jpeg:
+        context['src'] = product.image.url
+        return context
+    storage = getattr(product.image, 'storage', default_storage)
+    width, height, name = jpeg[-1]
+    context.update({
+        'src': storage.url(name),
+        'srcset': _srcset(storage, jpeg),
+        'webp_srcset': _srcset(storage, variants.get('webp') or []),
+        'width': width,
+        'height': height,
+    })
+    return context
@@ -0,0 +1,42 @@
+from django import template
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+from ecommerce import assets
+
+register = template.Library()
+
+
+def _integrity(integrity):
+    if not integrity:
+        return ''
+    return format_html(' integrity="{}" crossorigin="anonymous"', integrity)
+
+
+@register.simple_tag
+def stylesheet(path, deferred=False):
+    """
+    ``<link>`` to a stylesheet. ``deferred`` loads it without blocking first
+    paint, for pages that inline their critical CSS.
+    """
+    url, integrity = assets.asset(path)
+    if not deferred:
+        return format_html('<link rel="stylesheet" href="{}"{}>', url, _integrity(integrity))
+    return format_html(
+        '<link rel="preload" href="{0}" as="style"{1} onload="this.onload=null;this.rel=\'stylesheet\'">'
+        '<noscript><link rel="stylesheet" href="{0}"{1}></noscript>',
+        url, _integrity(integrity),
+    )
+
+
+@register.simple_tag
+def script(path):
+    url, integrity = assets.asset(path)
+    return format_html('<script src="{}"{} defer></script>', url, _integrity(integrity))
+
+
+@register.simple_tag
+def inline_css(path):
+    """A static stylesheet of our own, inlined as ``<style>``."""
+    css = assets.read_text(path)
+    return mark_safe(f'<style>{css}</style>') if css else ''
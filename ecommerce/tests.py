@@ -1,3 +1,2007 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import re
+import shutil
+import sqlite3
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIHandler
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.utils import timezone
+from django.utils.http import parse_http_date
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.templatetags.static import static
+from django.urls import reverse
+
+from . import (
+    assets, benchmarks, caching, cart, cartstore, catalogue, dbprofile, export, facets, fulfilment, images, importing,
+    payments, queryplans, querystats, ratings, recommendations, reservations, routing, search, wishlists,
+)
+from .cart import CartOperationError, apply_operations
+from .cartstore import CartStore
+from .models import (
+    Cart, CartItem, Customer, Order, OrderItem, Product, ProductRating, ProductRecommendation, Review, ShippingInfo,
+    StockHold, StockShard, StripeEvent, Wishlist, WishlistItem,
+)
+from .orders import OutOfStock, place_order, summarise
+from .pagination import CursorPaginator
+from .stripe_stub import FakeStripe, FakeStripeServer, sign_payload
+
+
+def make_product(**kwargs):
+    fields = {
+        'name': 'Widget',
+        'brand': 'Acme',
+        'category': 'Tools',
+        'description': 'A useful widget.',
+        'price': '9.99',
+        'stock': 10,
+    }
+    fields.update(kwargs)
+    return Product.objects.create(**fields)
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        search.reset_backend()
+        self.laptop = make_product(name='Zephyrion Laptop', brand='Quolt', category='Computers')
+        self.bag = make_product(name='Carry Bag', brand='Zephyrion', category='Luggage',
+                                description='Fits any laptop.')
+        self.mouse = make_product(name='Quiet Mouse', brand='Quolt', category='Computers')
+
+    def tearDown(self):
+        search.reset_backend()
+
+    def test_uses_fts5_on_sqlite(self):
+        self.assertEqual(search.get_backend().name, 'fts5')
+
+    def test_prefix_match_across_fields(self):
+        results = list(search.search_products(Product.objects.all(), 'zephyr'))
+        self.assertEqual(results, [self.laptop, self.bag])
+
+    def test_all_terms_must_match(self):
+        results = list(search.search_products(Product.objects.all(), 'quolt mou'))
+        self.assertEqual(results, [self.mouse])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.mouse.name = 'Silent Trackball'
+        self.mouse.save()
+        self.assertEqual(list(search.search_products(Product.objects.all(), 'trackball')), [self.mouse])
+        self.assertFalse(search.search_products(Product.objects.all(), 'quiet').exists())
+        self.laptop.delete()
+        self.assertEqual(list(search.search_products(Product.objects.all(), 'zephyrion')), [self.bag])
+
+    def test_python_backend_matches_fts5(self):
+        with self.settings(ECOMMERCE_SEARCH_BACKEND='python'):
+            search.reset_backend()
+            self.assertEqual(search.get_backend().name, 'python')
+            results = list(search.search_products(Product.objects.all(), 'zephyr'))
+            self.assertEqual(results, [self.laptop, self.bag])
+            self.bag.delete()
+            self.assertEqual(search.get_backend().search_ids('zephyrion'), [self.laptop.pk])
+
+    def test_limit_applies_after_the_queryset_filters(self):
+        luggage = Product.objects.filter(category='Luggage')
+        for choice in ('fts5', 'python'):
+            with self.subTest(choice), self.settings(ECOMMERCE_SEARCH_BACKEND=choice):
+                search.reset_backend()
+                # The laptop ranks first, so a limit taken before the filter leaves nothing.
+                self.assertEqual(list(search.get_backend().filter_queryset(luggage, 'zephyr', limit=1)), [self.bag])
+                counts = facets.facet_counts(search_query='zephyr')
+                self.assertEqual(counts['category'], [('Computers', 1), ('Luggage', 1)])
+
+    def test_product_list_search(self):
+        response = self.client.get(reverse('ecommerce:product_list'), {'search': 'quolt', 'category': 'Computers'})
+        self.assertEqual(list(response.context['page_obj']), [self.laptop, self.mouse])
+        response = self.client.get(reverse('ecommerce:product_list'), {'search': '???'})
+        self.assertEqual(len(response.context['page_obj']), 0)
+
+
+class FacetCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        search.reset_backend()
+        Product.objects.all().delete()
+        make_product(name='Red Kettle', brand='Acme', category='Kitchen')
+        make_product(name='Blue Kettle', brand='Acme', category='Kitchen')
+        make_product(name='Hammer', brand='Forge', category='Tools')
+
+    def test_totals_are_adjusted_without_recounting(self):
+        self.assertEqual(facets.facet_counts()['brand'], [('Acme', 2), ('Forge', 1)])
+        with self.captureOnCommitCallbacks(execute=True):
+            hammer = Product.objects.get(name='Hammer')
+            hammer.brand = 'Acme'
+            hammer.save()
+            make_product(name='Saw', brand='Forge', category='Tools')
+        with self.assertNumQueries(0):
+            counts = facets.facet_counts()
+        self.assertEqual(counts['brand'], [('Acme', 3), ('Forge', 1)])
+        self.assertEqual(counts['category'], [('Kitchen', 2), ('Tools', 2)])
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(name='Saw').delete()
+        self.assertEqual(facets.facet_counts()['brand'], [('Acme', 3)])
+
+    def test_totals_survive_interleaved_writers(self):
+        facets.get_totals()
+        index = cache.get(facets.TOTALS_KEY)
+        # Both writers read the totals before either writes back.
+        with mock.patch.object(facets.cache, 'get', return_value=index):
+            facets._adjust([('brand', 'Acme', 1)])
+            facets._adjust([('brand', 'Acme', 1), ('brand', 'Forge', -1)])
+        self.assertEqual(facets.get_totals()['brand'], {'Acme': 4})
+
+    def test_recount_repairs_drifted_totals(self):
+        facets.get_totals()
+        # A change lost by a non-atomic backend, and one applied twice.
+        Product.objects.filter(name='Hammer').update(brand='Acme')
+        index = cache.get(facets.TOTALS_KEY)
+        cache.incr(facets._counter_key(index['token'], 'category', 'Tools'))
+        self.assertEqual(facets.get_totals()['brand'], {'Acme': 2, 'Forge': 1})
+        expected = {'brand': {'Acme': 3}, 'category': {'Kitchen': 2, 'Tools': 1}}
+        self.assertEqual(facets._recount(), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(facets.get_totals(), expected)
+
+    def test_new_values_and_lost_counters_recount(self):
+        facets.get_totals()
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(name='Drill', brand='Bolt', category='Tools')
+        self.assertEqual(facets.facet_counts()['brand'], [('Acme', 2), ('Bolt', 1), ('Forge', 1)])
+        index = cache.get(facets.TOTALS_KEY)
+        cache.delete(facets._counter_key(index['token'], 'brand', 'Bolt'))
+        with self.assertNumQueries(2):
+            self.assertEqual(facets.facet_counts()['brand'], [('Acme', 2), ('Bolt', 1), ('Forge', 1)])
+
+    def test_filtered_counts_are_disjunctive_and_cached(self):
+        counts = facets.facet_counts(category='Kitchen', search_query='kettle')
+        self.assertEqual(counts['brand'], [('Acme', 2)])
+        self.assertEqual(counts['category'], [('Kitchen', 2)])
+        with self.assertNumQueries(0):
+            facets.facet_counts(category='Kitchen', search_query='kettle')
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(name='Green Kettle', brand='Forge', category='Kitchen')
+        counts = facets.facet_counts(category='Kitchen', search_query='kettle')
+        self.assertEqual(counts['brand'], [('Acme', 2), ('Forge', 1)])
+
+    def test_product_list_renders_counts(self):
+        response = self.client.get(reverse('ecommerce:product_list'))
+        self.assertContains(response, 'Acme (2)')
+        self.assertContains(response, 'Tools (1)')
+
+
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Product.objects.all().delete()
+        for i in range(25):
+            make_product(name=f'Item {i:02d}', price=f'{i % 5}.00')
+
+    def walk(self, ordering):
+        paginator = CursorPaginator(Product.objects.all(), 10, ordering)
+        page = paginator.get_page()
+        pages = [page]
+        while page.has_next():
+            page = paginator.get_page(page.next_cursor)
+            pages.append(page)
+        return paginator, pages
+
+    def test_forward_walk_visits_every_row_once(self):
+        _, pages = self.walk(('-price', '-pk'))
+        seen = [p.pk for page in pages for p in page]
+        expected = list(Product.objects.order_by('-price', '-pk').values_list('pk', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertFalse(pages[0].has_previous())
+
+    def test_previous_cursor_returns_preceding_page(self):
+        paginator, pages = self.walk(('price', 'pk'))
+        back = paginator.get_page(pages[2].previous_cursor)
+        self.assertEqual(list(back), list(pages[1]))
+        back = paginator.get_page(back.previous_cursor)
+        self.assertEqual(list(back), list(pages[0]))
+        self.assertFalse(back.has_previous())
+
+    def test_deep_page_query_does_not_count_or_offset(self):
+        paginator, pages = self.walk(('pk',))
+        with self.assertNumQueries(1) as queries:
+            paginator.get_page(pages[1].next_cursor)
+        sql = queries.captured_queries[0]['sql']
+        self.assertNotIn('OFFSET', sql)
+        self.assertNotIn('COUNT', sql)
+
+    def test_tampered_cursor_falls_back_to_first_page(self):
+        paginator, pages = self.walk(('pk',))
+        page = paginator.get_page(pages[0].next_cursor + 'x')
+        self.assertEqual(list(page), list(pages[0]))
+
+    def test_product_list_cursor_links(self):
+        url = reverse('ecommerce:product_list')
+        response = self.client.get(url, {'sort': 'name'})
+        page = response.context['page_obj']
+        self.assertEqual(response.context['total'], 25)
+        response = self.client.get(url, {'sort': 'name', 'cursor': page.next_cursor})
+        names = [p.name for p in response.context['page_obj']]
+        self.assertEqual(names[0], 'Item 10')
+
+    def test_search_results_page_by_relevance(self):
+        url = reverse('ecommerce:product_list')
+        response = self.client.get(url, {'search': 'item'})
+        first = list(response.context['page_obj'])
+        response = self.client.get(url, {'search': 'item', 'cursor': response.context['page_obj'].next_cursor})
+        second = list(response.context['page_obj'])
+        self.assertEqual(len(first + second), 20)
+        self.assertFalse(set(first) & set(second))
+
+    def test_numbered_pagination_mode(self):
+        with self.settings(ECOMMERCE_CATALOGUE_PAGINATION='page'):
+            response = self.client.get(reverse('ecommerce:product_list'), {'page': 3})
+        self.assertEqual(len(response.context['page_obj']), 5)
+
+
+class CatalogueCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caching.reset_stats()
+        self.product = make_product(name='Cached Lamp')
+
+    def test_anonymous_pages_are_cached_until_the_product_changes(self):
+        url = reverse('ecommerce:product_detail', args=[self.product.pk])
+        self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertContains(response, 'Cached Lamp')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Renamed Lamp'
+            self.product.save()
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertContains(response, 'Renamed Lamp')
+        self.assertEqual(caching.get_stats()['page'], {'hits': 1, 'misses': 2})
+
+    def test_catalogue_page_invalidated_by_generation(self):
+        url = reverse('ecommerce:product_list')
+        self.client.get(url)
+        self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(name='Another Lamp')
+        self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+
+    def test_unread_query_parameters_share_the_cached_page(self):
+        url = reverse('ecommerce:product_list')
+        self.client.get(url, {'category': 'Lighting'})
+        response = self.client.get(url, {'category': 'Lighting', 'utm_source': 'mail', 'brand': ''})
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertNotContains(response, 'utm_source')
+        self.assertEqual(self.client.get(url, {'nonce': '1'})['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(url, {'nonce': '2'})['X-Cache'], 'HIT')
+
+    def test_cached_pages_keep_their_headers(self):
+        def view(request):
+            response = HttpResponse('<p>Lamp</p>', content_type='text/html; charset=utf-8')
+            response['Content-Language'] = 'en'
+            response.set_cookie('seen', '1')
+            return response
+
+        cached_view = caching.cache_anonymous_page(lambda request: 1)(view)
+        request = RequestFactory().get('/lamp/')
+        request.user = AnonymousUser()
+        request._messages = []
+        cached_view(request)
+        response = cached_view(request)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response['Content-Language'], 'en')
+        self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+        self.assertNotIn('seen', response.cookies)
+
+    def test_authenticated_pages_reuse_cards_and_filters(self):
+        self.client.force_login(User.objects.create_user('shopper', password='pw'))
+        url = reverse('ecommerce:product_list')
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('X-Cache'))
+        self.client.get(url)
+        stats = caching.get_stats()
+        self.assertEqual(stats['catalogue_filters'], {'hits': 1, 'misses': 1})
+        self.assertEqual(stats['product_card']['hits'], stats['product_card']['misses'])
+
+    def test_file_based_backend(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as location:
+            caches = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                  'LOCATION': location}}
+            with self.settings(CACHES=caches):
+                url = reverse('ecommerce:product_detail', args=[self.product.pk])
+                self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+                self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caching.reset_stats()
+        self.product = make_product(name='Conditional Lamp')
+        self.url = reverse('ecommerce:product_detail', args=[self.product.pk])
+
+    def test_anonymous_pages_carry_validators_and_shared_cache_headers(self):
+        first = self.client.get(self.url)
+        # The first visit sets this visitor's CSRF cookie, so it is private.
+        self.assertIn('private', first['Cache-Control'])
+        response = self.client.get(self.url)
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        self.assertEqual(parse_http_date(response['Last-Modified']), int(self.product.updated_at.timestamp()))
+        for directive in ('public', 'max-age=0', 'must-revalidate', 's-maxage=60'):
+            self.assertIn(directive, response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+
+    def test_matching_validators_get_304_without_queries(self):
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], first['ETag'])
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(caching.get_stats()['conditional'], {'hits': 2, 'misses': 1})
+        # The 304s never reached the page cache.
+        self.assertEqual(caching.get_stats()['page'], {'hits': 0, 'misses': 1})
+
+    def test_changes_invalidate_the_etag(self):
+        first = self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = '12.00'
+            self.product.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertContains(response, '12.00')
+
+        listing = reverse('ecommerce:product_list')
+        first = self.client.get(listing)
+        self.assertEqual(self.client.get(listing, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(name='Newer Lamp')
+        self.assertEqual(self.client.get(listing, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+    def test_last_modified_survives_an_empty_cache(self):
+        first = self.client.get(self.url)
+        cache.clear()
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_updates_outside_save_move_last_modified(self):
+        Product.objects.filter(pk=self.product.pk).update(updated_at=timezone.now() - timedelta(days=1))
+        customer = Customer.objects.create(user=User.objects.create_user('shopper', password='pw'))
+        order = Order.objects.create(customer=customer, total='9.99', status='Paid')
+        OrderItem.objects.create(order=order, product=self.product, quantity=1, price='9.99')
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(customer=customer, order=order, rating=4, comment='Bright.')
+        self.product.refresh_from_db()
+        self.assertGreater(self.product.updated_at, timezone.now() - timedelta(minutes=1))
+
+    def test_anonymous_visitors_add_to_cart_from_a_cached_page(self):
+        self.client.get(self.url)
+        for _ in range(2):
+            visitor = Client(enforce_csrf_checks=True)
+            response = visitor.get(self.url)
+            self.assertEqual(response['X-Cache'], 'HIT')
+            token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', response.content.decode())[1]
+            response = visitor.post(reverse('ecommerce:add_to_cart', args=[self.product.pk]),
+                                    {'csrfmiddlewaretoken': token})
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(CartStore.for_request(response.wsgi_request).quantities(), {self.product.pk: 1})
+
+    def test_signed_in_pages_are_private(self):
+        self.client.force_login(User.objects.create_user('shopper', password='pw'))
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotIn('public', response['Cache-Control'])
+
+
+class GenerateFakeDataTests(TestCase):
+    def generate(self, **options):
+        call_command('generate_fake_data', stdout=StringIO(), products=30, customers=5, orders=20, **options)
+
+    def test_generates_related_rows_and_indexes_them(self):
+        cache.clear()
+        search.reset_backend()
+        before = Product.objects.count()
+        self.generate(seed=7, review_ratio=1.0)
+        self.assertEqual(Product.objects.count(), before + 30)
+        self.assertEqual(Customer.objects.count(), 5)
+        self.assertEqual(Order.objects.count(), 20)
+        self.assertEqual(Review.objects.count(), 20)
+        for order in Order.objects.prefetch_related('items'):
+            self.assertEqual(order.total, sum(item.price * item.quantity for item in order.items.all()))
+        product = Product.objects.latest('pk')
+        self.assertIn(product.pk, search.get_backend().search_ids(product.name))
+        self.assertTrue(ProductRating.objects.exists())
+        self.assertFalse(Order.objects.filter(item_count=0).exists())
+
+    def test_same_seed_gives_same_catalogue(self):
+        self.generate(seed=3)
+        first = list(Product.objects.order_by('-pk').values_list('name', 'brand', 'price')[:30])
+        self.generate(seed=3)
+        second = list(Product.objects.order_by('-pk').values_list('name', 'brand', 'price')[:30])
+        self.assertEqual(first, second)
+        self.assertEqual(Customer.objects.count(), 10)
+
+
+class FunnelBenchmarkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_runs_every_step_against_fake_stripe(self):
+        summary = benchmarks.FunnelBenchmark(iterations=3, warmup=1).run()
+        self.assertIn('payment_success', summary)
+        self.assertEqual(Order.objects.filter(customer__user__username=benchmarks.BENCHMARK_USERNAME).count(), 4)
+        for result in summary.values():
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_compare_flags_slower_or_chattier_steps(self):
+        baseline = {'view_cart': {'p95_ms': 10.0, 'queries': 4}}
+        self.assertEqual(benchmarks.compare({'view_cart': {'p95_ms': 11.0, 'queries': 4}}, baseline), [])
+        regressions = benchmarks.compare({'view_cart': {'p95_ms': 13.0, 'queries': 5}}, baseline)
+        self.assertEqual(len(regressions), 2)
+
+
+class QueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('generate_fake_data', stdout=StringIO(), products=2000, customers=50, orders=300, seed=5)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_no_view_scans_a_whole_table(self):
+        audit = queryplans.PlanAudit()
+        self.assertEqual(audit.run(), {})
+        self.assertIn('order_detail', audit.statements)
+
+    def test_missing_index_is_reported(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP INDEX product_category_id_idx')
+            cursor.execute('DROP INDEX product_brand_id_idx')
+        problems = queryplans.PlanAudit().run()
+        self.assertEqual(list(problems), ['product_list (filter)'])
+        self.assertEqual(problems['product_list (filter)'][0][1], ['ecommerce_product'])
+
+    def test_full_scans_ignores_index_and_virtual_table_reads(self):
+        plan = [
+            'SEARCH ecommerce_order USING INDEX order_customer_created_idx (customer_id=?)',
+            'SCAN ecommerce_product USING INDEX product_name_id_idx',
+            'SCAN ecommerce_product_fts VIRTUAL TABLE INDEX 0:M3',
+            'SCAN CONSTANT ROW',
+            'CO-ROUTINE qualify',
+            'SCAN qualify',
+            'SCAN ecommerce_review',
+        ]
+        self.assertEqual(queryplans.full_scans(plan), ['ecommerce_review'])
+
+
+class QueryInstrumentationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        querystats.stats.reset()
+
+    def test_server_timing_and_per_view_stats(self):
+        response = self.client.get(reverse('ecommerce:product_list'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+$')
+        summary = querystats.collect()
+        self.assertEqual(summary['ecommerce:product_list']['requests'], 1)
+
+    def test_middleware_runs_natively_under_asgi(self):
+        handler = ASGIHandler.__new__(ASGIHandler)
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            handler.load_middleware(is_async=True)
+
+    async def test_server_timing_on_async_requests(self):
+        response = await self.async_client.get(reverse('ecommerce:product_list'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="[1-9]\d* queries"')
+
+    def test_repeated_queries_are_fingerprinted(self):
+        queries = querystats.RequestQueries()
+        products = [make_product(name=f'Part {i}') for i in range(6)]
+        with connection.execute_wrapper(queries):
+            for product in products:
+                Product.objects.get(pk=product.pk)
+        [(sql, count)] = queries.repeated().items()
+        self.assertEqual(count, 6)
+        self.assertIn('WHERE "ecommerce_product"."id" = %s', sql)
+
+    def test_stats_endpoint_is_staff_only(self):
+        url = reverse('ecommerce:query_stats')
+        self.client.force_login(User.objects.create_user('shopper'))
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        self.client.get(reverse('ecommerce:product_list'))
+        data = self.client.get(url).json()
+        self.assertIn('ecommerce:product_list', data['views'])
+        self.assertIn('cache', data)
+
+    def test_dump_command(self):
+        self.client.get(reverse('ecommerce:product_list'))
+        out = StringIO()
+        call_command('dump_query_stats', stdout=out)
+        self.assertIn('ecommerce:product_list', out.getvalue())
+
+
+class CartOperationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user)
+        self.cart = Cart.objects.create(customer=self.customer)
+        self.products = [make_product(name=f'Gadget {i}', price='2.50') for i in range(10)]
+        self.client.force_login(self.user)
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_batch_is_applied_in_order(self):
+        a, b, c = self.products[:3]
+        apply_operations(self.cart, [{'op': 'add', 'product': c.pk}])
+        apply_operations(self.cart, [
+            {'op': 'add', 'product': a.pk, 'quantity': 2},
+            {'op': 'add', 'product': a.pk},
+            {'op': 'set', 'product': b.pk, 'quantity': 4},
+            {'op': 'add', 'product': b.pk, 'quantity': -1},
+            {'op': 'remove', 'product': c.pk},
+        ])
+        self.assertEqual(self.quantities(), {a.pk: 3, b.pk: 3})
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        apply_operations(self.cart, [{'op': 'add', 'product': self.products[0].pk}])
+        with self.assertNumQueries(8) as small:
+            apply_operations(self.cart, [
+                {'op': 'add', 'product': self.products[1].pk},
+                {'op': 'set', 'product': self.products[2].pk, 'quantity': 1},
+            ])
+        operations = [{'op': 'add', 'product': p.pk, 'quantity': 2} for p in self.products]
+        operations += [{'op': 'set', 'product': self.products[0].pk, 'quantity': 0}]
+        with self.assertNumQueries(len(small)):
+            apply_operations(self.cart, operations)
+        self.assertEqual(len(self.quantities()), 9)
+
+    def test_increments_are_not_lost_by_stale_reads(self):
+        product = self.products[0]
+        apply_operations(self.cart, [{'op': 'add', 'product': product.pk}])
+        url = reverse('ecommerce:increment_cart_item', args=[product.pk])
+        self.client.post(url)
+        self.client.post(url)
+        CartStore(self.user).flush()
+        self.assertEqual(self.quantities(), {product.pk: 3})
+
+    def test_invalid_operations_change_nothing(self):
+        with self.assertRaises(CartOperationError):
+            apply_operations(self.cart, [
+                {'op': 'add', 'product': self.products[0].pk},
+                {'op': 'add', 'product': 0},
+            ])
+        with self.assertRaises(CartOperationError):
+            apply_operations(self.cart, [{'op': 'set', 'product': self.products[0].pk, 'quantity': -2}])
+        self.assertEqual(self.quantities(), {})
+
+    def test_quantities_are_capped(self):
+        pk = self.products[0].pk
+        for operations in ([{'op': 'add', 'product': pk, 'quantity': 10 ** 30}],
+                           [{'op': 'set', 'product': pk, 'quantity': cart.MAX_QUANTITY + 1}],
+                           [{'op': 'add', 'product': pk, 'quantity': cart.MAX_QUANTITY}, {'op': 'add', 'product': pk}],
+                           [{'op': 'add', 'product': 2 ** 70}]):
+            with self.assertRaises(CartOperationError):
+                apply_operations(self.cart, operations)
+        apply_operations(self.cart, [{'op': 'set', 'product': pk, 'quantity': cart.MAX_QUANTITY}])
+        apply_operations(self.cart, [{'op': 'add', 'product': pk}])
+        self.assertEqual(self.quantities(), {pk: cart.MAX_QUANTITY})
+
+        response = self.client.post(reverse('ecommerce:update_cart'),
+                                    json.dumps({'operations': [{'op': 'add', 'product': pk, 'quantity': 10 ** 30}]}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_endpoint_returns_cart_state(self):
+        url = reverse('ecommerce:update_cart')
+        operations = [{'op': 'add', 'product': self.products[0].pk, 'quantity': 2}]
+        response = self.client.post(url, json.dumps({'operations': operations}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['subtotal'], '5.00')
+        self.assertEqual(data, CartStore(self.user).state())
+        CartStore(self.user).flush()
+        self.assertEqual(self.quantities(), {self.products[0].pk: 2})
+        response = self.client.post(url, '{"operations": [{"op": "explode"}]}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        response = self.client.post(url, json.dumps({'operations': operations}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['cart'], None)
+        self.assertEqual(response.json()['count'], 2)
+
+    def test_decrement_to_zero_removes_line(self):
+        product = self.products[0]
+        apply_operations(self.cart, [{'op': 'add', 'product': product.pk}])
+        self.client.post(reverse('ecommerce:decrement_cart_item', args=[product.pk]))
+        CartStore(self.user).flush()
+        self.assertEqual(self.quantities(), {})
+
+    def test_wishlist_add_to_cart_moves_item(self):
+        wishlist = Wishlist.objects.create(customer=self.customer, name='Later')
+        item = WishlistItem.objects.create(wishlist=wishlist, product=self.products[0])
+        self.client.post(reverse('ecommerce:wishlist_add_to_cart', args=[wishlist.pk, item.pk]))
+        self.assertFalse(WishlistItem.objects.exists())
+        CartStore(self.user).flush()
+        self.assertEqual(self.quantities(), {self.products[0].pk: 1})
+
+
+class WishlistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user)
+        self.products = [make_product(name=f'Trinket {i}', stock=5) for i in range(40)]
+        self.client.force_login(self.user)
+
+    def make_wishlist(self, name, products):
+        wishlist = Wishlist.objects.create(customer=self.customer, name=name)
+        WishlistItem.objects.bulk_create(WishlistItem(wishlist=wishlist, product=p) for p in products)
+        return wishlist
+
+    def cart_quantities(self):
+        return dict(CartItem.objects.filter(cart=CartStore(self.user).flush()).values_list('product_id', 'quantity'))
+
+    def test_list_shows_counts_and_previews_in_fixed_queries(self):
+        self.make_wishlist('Birthday', self.products[:6])
+        url = reverse('ecommerce:wishlist_list')
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(url)
+        self.assertContains(response, '6 items')
+        self.assertEqual(len(response.context['wishlists'][0].preview_items), wishlists.PREVIEW_ITEMS)
+        for i in range(8):
+            self.make_wishlist(f'List {i}', self.products[i * 4:i * 4 + 5])
+        with self.assertNumQueries(len(few)):
+            response = self.client.get(url)
+        self.assertContains(response, '5 items', count=8)
+
+    def test_move_all_skips_products_without_stock(self):
+        wishlist = self.make_wishlist('Later', self.products[:30])
+        Product.objects.filter(pk=self.products[0].pk).update(stock=0)
+        reservations.rebuild_shards([self.products[0].pk])
+        CartStore(self.user).apply([{'op': 'add', 'product': self.products[1].pk, 'quantity': 5}])
+        with mock.patch('ecommerce.cart.MAX_OPERATIONS', 8):
+            response = self.client.post(reverse('ecommerce:wishlist_move_to_cart', args=[wishlist.pk]), {'all': '1'})
+        self.assertRedirects(response, reverse('ecommerce:wishlist_detail', args=[wishlist.pk]))
+        self.assertEqual(sorted(wishlist.items.values_list('product_id', flat=True)),
+                         [self.products[0].pk, self.products[1].pk])
+        quantities = self.cart_quantities()
+        self.assertEqual(len(quantities), 29)
+        self.assertEqual(quantities[self.products[1].pk], 5)
+        self.assertEqual(quantities[self.products[2].pk], 1)
+
+    def test_move_selected_in_fixed_queries(self):
+        wishlist = self.make_wishlist('Later', self.products)
+        store = CartStore(self.user)
+        items = list(wishlist.items.order_by('pk').values_list('pk', flat=True))
+        store.flush()
+        with CaptureQueriesContext(connection) as few:
+            moved, skipped = wishlists.move_to_cart(wishlist, store, items[:2])
+        self.assertEqual((len(moved), skipped), (2, []))
+        store.quantities()
+        with self.assertNumQueries(len(few)):
+            moved, skipped = wishlists.move_to_cart(wishlist, store, items[2:30])
+        self.assertEqual(len(moved), 28)
+        self.assertEqual(wishlist.items.count(), 10)
+        self.assertEqual(len(self.cart_quantities()), 30)
+
+    def test_failed_cart_change_keeps_the_wishlist_and_the_cart(self):
+        wishlist = self.make_wishlist('Later', self.products[:3])
+        store = CartStore(self.user)
+        store.apply([{'op': 'add', 'product': self.products[5].pk}])
+
+        def apply_then_fail(cart, operations):
+            apply_operations(cart, operations)
+            raise DatabaseError('disk full')
+
+        with mock.patch('ecommerce.cart.apply_operations', apply_then_fail):
+            with self.assertRaises(DatabaseError):
+                wishlists.move_to_cart(wishlist, store)
+        self.assertEqual(wishlist.items.count(), 3)
+        self.assertEqual(store.quantities(), {self.products[5].pk: 1})
+        self.assertEqual(self.cart_quantities(), {self.products[5].pk: 1})
+
+    def test_move_requires_a_selection(self):
+        wishlist = self.make_wishlist('Later', self.products[:2])
+        self.client.post(reverse('ecommerce:wishlist_move_to_cart', args=[wishlist.pk]))
+        self.assertEqual(wishlist.items.count(), 2)
+        other = User.objects.create_user('other', password='pw')
+        self.client.force_login(other)
+        response = self.client.post(reverse('ecommerce:wishlist_move_to_cart', args=[wishlist.pk]), {'all': '1'})
+        self.assertEqual(response.status_code, 404)
+
+
+class CartStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.products = [make_product(name=f'Widget {i}', price='3.00') for i in range(3)]
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart__customer__user=self.user).values_list('product_id', 'quantity'))
+
+    def test_changes_are_served_from_cache_until_flushed(self):
+        self.client.force_login(self.user)
+        product = self.products[0]
+        self.client.post(reverse('ecommerce:add_to_cart', args=[product.pk]))
+        with self.assertNumQueries(1):
+            CartStore(self.user).apply([{'op': 'add', 'product': product.pk}])
+        self.assertEqual(self.quantities(), {})
+        response = self.client.get(reverse('ecommerce:view_cart'))
+        self.assertEqual([(item.product, item.quantity) for item in response.context['items']], [(product, 2)])
+        self.assertEqual(cartstore.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {product.pk: 2})
+        self.assertEqual(cartstore.flush_dirty_carts(), 0)
+
+    def test_flush_command_needs_a_shared_cache(self):
+        with self.assertRaisesMessage(CommandError, 'per-process'):
+            call_command('flush_carts', stdout=StringIO())
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory}}
+        with self.settings(CACHES=shared):
+            CartStore(self.user).apply([{'op': 'add', 'product': self.products[0].pk}])
+            out = StringIO()
+            call_command('flush_carts', stdout=out)
+        self.assertIn('Flushed 1 carts.', out.getvalue())
+        self.assertEqual(self.quantities(), {self.products[0].pk: 1})
+
+    def test_cart_changed_during_a_flush_stays_marked(self):
+        CartStore(self.user).apply([{'op': 'add', 'product': self.products[0].pk}])
+        real_flush = CartStore._flush
+        added = self.products[1].pk
+
+        def flush_then_change(store, state):
+            cart = real_flush(store, state)
+            # Another request changes the cart right after this flush.
+            store._apply(store._load(), {added: (None, 1)})
+            return cart
+
+        with mock.patch.object(CartStore, '_flush', flush_then_change):
+            cartstore.flush_dirty_carts()
+        self.assertEqual(cartstore.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {self.products[0].pk: 1, self.products[1].pk: 1})
+
+    def test_lock_times_out_and_only_its_owner_releases_it(self):
+        store = CartStore(self.user)
+        holder = cartstore._Lock(store.key)
+        holder.__enter__()
+        with mock.patch.object(cartstore, 'LOCK_TIMEOUT', 0.05):
+            with self.assertRaises(cartstore.CartBusy):
+                store.apply([{'op': 'add', 'product': self.products[0].pk}])
+        # The holder's lock expired and someone else took it.
+        cache.set(holder.key, 'someone else')
+        holder.__exit__(None, None, None)
+        self.assertEqual(cache.get(holder.key), 'someone else')
+
+    def test_stale_cart_writes_through(self):
+        store = CartStore(self.user)
+        store.apply([{'op': 'add', 'product': self.products[0].pk}])
+        state = cache.get(store.key)
+        state['flushed_at'] -= cartstore.FLUSH_INTERVAL
+        cache.set(store.key, state)
+        store.apply([{'op': 'add', 'product': self.products[1].pk}])
+        self.assertEqual(self.quantities(), {self.products[0].pk: 1, self.products[1].pk: 1})
+
+    def test_cold_cache_loads_the_database_cart(self):
+        store = CartStore(self.user)
+        store.apply([{'op': 'set', 'product': self.products[0].pk, 'quantity': 4}])
+        store.flush()
+        cache.clear()
+        self.assertEqual(CartStore(self.user).quantities(), {self.products[0].pk: 4})
+
+    def test_anonymous_cart_is_merged_on_login(self):
+        a, b = self.products[:2]
+        CartStore(self.user).apply([{'op': 'add', 'product': a.pk}])
+        self.client.post(reverse('ecommerce:add_to_cart', args=[a.pk]))
+        self.client.post(reverse('ecommerce:add_to_cart', args=[b.pk]))
+        response = self.client.get(reverse('ecommerce:view_cart'))
+        self.assertEqual(len(response.context['items']), 2)
+        self.client.post(reverse('ecommerce:login'), {'username': 'shopper', 'password': 'pw'})
+        self.assertEqual(CartStore(self.user).quantities(), {a.pk: 2, b.pk: 1})
+        self.assertNotIn(cartstore.SESSION_KEY, self.client.session)
+
+    def test_logout_flushes(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('ecommerce:add_to_cart', args=[self.products[0].pk]))
+        self.client.get(reverse('ecommerce:logout'))
+        self.assertEqual(self.quantities(), {self.products[0].pk: 1})
+
+    def test_checkout_is_priced_from_the_flushed_cart(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('ecommerce:add_to_cart', args=[self.products[0].pk]))
+        with FakeStripe() as fake_stripe:
+            self.client.post(reverse('ecommerce:create_checkout_session'))
+            session = fake_stripe.complete(fake_stripe.last_session['id'])
+            self.assertEqual(session['amount_total'], 300)
+            with self.settings(STRIPE_WEBHOOK_SECRET='whsec_test', ECOMMERCE_FULFILMENT='inline'), \
+                    self.captureOnCommitCallbacks(execute=True):
+                fake_stripe.send_webhook(self.client, session['id'], 'whsec_test')
+        self.assertEqual(self.quantities(), {})
+        self.assertEqual(CartStore(self.user).quantities(), {})
+
+    def test_one_failing_cart_does_not_stop_the_others(self):
+        other = User.objects.create_user('other', password='pw')
+        for user in (self.user, other):
+            CartStore(user).apply([{'op': 'add', 'product': self.products[0].pk}])
+        real_sync = cartstore.sync_cart
+
+        def sync(cart, quantities):
+            if cart.customer.user_id == self.user.pk:
+                raise DatabaseError('FOREIGN KEY constraint failed')
+            return real_sync(cart, quantities)
+
+        with mock.patch('ecommerce.cartstore.sync_cart', sync), self.assertLogs('ecommerce.cartstore', 'ERROR'):
+            self.assertEqual(cartstore.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {})
+        self.assertEqual(CartItem.objects.filter(cart__customer__user=other).count(), 1)
+        # Still marked, so the next run retries it.
+        self.assertEqual(cartstore.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {self.products[0].pk: 1})
+
+
+class CartStoreDeletedProductTests(TransactionTestCase):
+    # Foreign keys are only checked when a transaction commits.
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.kept, self.gone = make_product(name='Kept'), make_product(name='Gone')
+
+    def test_deleted_product_is_dropped_when_the_cart_is_flushed(self):
+        store = CartStore(self.user)
+        store.apply([{'op': 'add', 'product': self.kept.pk}, {'op': 'add', 'product': self.gone.pk, 'quantity': 2}])
+        self.gone.delete()
+        cart = store.flush()
+        self.assertEqual(dict(cart.items.values_list('product_id', 'quantity')), {self.kept.pk: 1})
+        self.assertEqual(store.quantities(), {self.kept.pk: 1})
+
+
+class OrderPlacementTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user, phone='5550199')
+        self.cart = Cart.objects.create(customer=self.customer)
+        self.products = [make_product(name=f'Gizmo {i}', price='4.00', stock=5) for i in range(10)]
+
+    def fill_cart(self, products, quantity=2):
+        CartItem.objects.bulk_create([CartItem(cart=self.cart, product=p, quantity=quantity) for p in products])
+
+    def test_order_takes_stock_and_empties_cart(self):
+        self.fill_cart(self.products[:2])
+        shipping = {'address': '1 Road', 'city': 'Town', 'postal_code': '1', 'country': 'US', 'phone': '1'}
+        order, created = place_order(self.customer, self.cart, 'cs_test_1', shipping)
+        self.assertTrue(created)
+        self.assertEqual(str(order.total), '16.00')
+        self.assertEqual(order.items.count(), 2)
+        self.assertEqual(order.shippinginfo.city, 'Town')
+        ids = [p.pk for p in self.products[:2]]
+        self.assertEqual(reservations.available(ids), {ids[0]: 3, ids[1]: 3})
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(reservations.sweep(), (0, 2))
+        self.assertEqual(list(Product.objects.filter(pk__in=ids).values_list('stock', flat=True)), [3, 3])
+        self.assertEqual(reservations.available(ids), {ids[0]: 3, ids[1]: 3})
+
+    def test_query_count_does_not_grow_with_order_size(self):
+        self.fill_cart(self.products[:1])
+        reservation = reservations.reserve(self.customer, {self.products[0].pk: 2})
+        with self.assertNumQueries(10) as small:
+            place_order(self.customer, self.cart, 'cs_test_small', reservation=reservation)
+        self.fill_cart(self.products)
+        reservation = reservations.reserve(self.customer, {p.pk: 2 for p in self.products})
+        with self.assertNumQueries(len(small)):
+            place_order(self.customer, self.cart, 'cs_test_large', reservation=reservation)
+
+    def test_order_stores_history_summary(self):
+        self.fill_cart(self.products[1:3])
+        order, _ = place_order(self.customer, self.cart, 'cs_test_1')
+        order.refresh_from_db()
+        self.assertEqual((order.item_count, order.first_product_name), (4, 'Gizmo 1'))
+
+    def test_same_session_places_one_order(self):
+        self.fill_cart(self.products[:1])
+        first, _ = place_order(self.customer, self.cart, 'cs_test_1')
+        self.fill_cart(self.products[1:2])
+        again, created = place_order(self.customer, self.cart, 'cs_test_1')
+        self.assertFalse(created)
+        self.assertEqual(again, first)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(CartItem.objects.count(), 1)
+
+    def test_short_stock_rolls_everything_back(self):
+        self.fill_cart(self.products[:1])
+        self.fill_cart(self.products[1:2], quantity=6)
+        with self.assertRaises(OutOfStock) as raised:
+            place_order(self.customer, self.cart, 'cs_test_1')
+        self.assertEqual(raised.exception.products, [self.products[1]])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(reservations.available([self.products[0].pk]), {self.products[0].pk: 5})
+        self.assertFalse(StockHold.objects.exists())
+        self.assertEqual(CartItem.objects.count(), 2)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user)
+        self.product = make_product(name='Gizmo', stock=20)
+
+    def available(self):
+        return reservations.available([self.product.pk])[self.product.pk]
+
+    def test_shards_follow_product_stock(self):
+        self.assertEqual(StockShard.objects.filter(product=self.product).count(), reservations.SHARDS)
+        self.assertEqual(self.available(), 20)
+        self.product.stock = 25
+        self.product.save()
+        self.assertEqual(self.available(), 25)
+
+    def test_reserve_and_release(self):
+        reservation = reservations.reserve(self.customer, {self.product.pk: 15})
+        self.assertEqual(self.available(), 5)
+        with self.assertRaises(reservations.OutOfStock) as raised:
+            reservations.reserve(self.customer, {self.product.pk: 6})
+        self.assertEqual(raised.exception.products, [self.product])
+        self.assertEqual(self.available(), 5)
+        self.assertEqual(reservations.release(reservation), 1)
+        self.assertEqual(reservations.release(reservation), 0)
+        self.assertEqual(self.available(), 20)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 20)
+
+    def test_expired_holds_are_swept(self):
+        reservations.reserve(self.customer, {self.product.pk: 3}, ttl=timedelta(minutes=1))
+        kept = reservations.reserve(self.customer, {self.product.pk: 2})
+        self.assertEqual(reservations.sweep(), (0, 0))
+        self.assertEqual(reservations.sweep(timezone.now() + timedelta(minutes=2)), (1, 0))
+        self.assertEqual(self.available(), 18)
+        self.assertEqual(list(StockHold.objects.values_list('reservation', flat=True)), [kept])
+
+    def test_sweep_command_folds_sales(self):
+        reservation = reservations.reserve(self.customer, {self.product.pk: 3})
+        with self.captureOnCommitCallbacks(execute=True):
+            reservations.commit(reservation, self.customer, {self.product.pk: 2})
+        self.assertEqual(self.available(), 18)
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('sweep_reservations', '--rebuild-shards', stdout=out)
+        self.assertIn('folded 1', out.getvalue())
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 18)
+        self.assertEqual(self.available(), 18)
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_checkout_cancel_gives_stock_back(self):
+        self.client.force_login(self.user)
+        with FakeStripe() as fake_stripe:
+            self.client.post(reverse('ecommerce:add_to_cart', args=[self.product.pk]))
+            self.client.post(reverse('ecommerce:create_checkout_session'))
+            self.assertEqual(self.available(), 19)
+            self.client.get(fake_stripe.last_session['cancel_url'])
+        self.assertEqual(self.available(), 20)
+        self.assertFalse(StockHold.objects.exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='whsec_test', ECOMMERCE_FULFILMENT='inline')
+    def test_expired_session_webhook_gives_stock_back(self):
+        self.client.force_login(self.user)
+        with FakeStripe() as fake_stripe:
+            self.client.post(reverse('ecommerce:add_to_cart', args=[self.product.pk]))
+            self.client.post(reverse('ecommerce:create_checkout_session'))
+            session_id = fake_stripe.expire(fake_stripe.last_session['id'])['id']
+            fake_stripe.send_webhook(Client(), session_id, 'whsec_test', type='checkout.session.expired')
+        self.assertEqual(self.available(), 20)
+        self.assertIsNotNone(StripeEvent.objects.get().processed_at)
+        self.assertFalse(Order.objects.exists())
+
+    def test_checkout_refuses_stock_held_by_others(self):
+        other = Customer.objects.create(user=User.objects.create_user('other', password='pw'))
+        reservations.reserve(other, {self.product.pk: 19})
+        self.client.force_login(self.user)
+        with FakeStripe() as fake_stripe:
+            self.client.post(reverse('ecommerce:add_to_cart', args=[self.product.pk]))
+            response = self.client.post(reverse('ecommerce:add_to_cart', args=[self.product.pk]), follow=True)
+            self.assertIn('only 1 of Gizmo left', [str(m) for m in response.context['messages']][-1])
+            CartStore(self.user).apply([{'op': 'set', 'product': self.product.pk, 'quantity': 2}])
+            response = self.client.post(reverse('ecommerce:create_checkout_session'))
+            self.assertRedirects(response, reverse('ecommerce:view_cart'), fetch_redirect_response=False)
+            self.assertEqual(fake_stripe.calls, [])
+
+    def test_large_quantities_span_shards(self):
+        product = make_product(name='Scarce', stock=5)
+        reservation = reservations.reserve(self.customer, {product.pk: 4})
+        self.assertEqual(reservations.available([product.pk]), {product.pk: 1})
+        with self.assertRaises(reservations.OutOfStock):
+            reservations.reserve(self.customer, {product.pk: 2})
+        reservations.release(reservation)
+        self.assertEqual(reservations.available([product.pk]), {product.pk: 5})
+
+
+class ReservationStressTests(TransactionTestCase):
+    def test_concurrent_reservations_never_oversell(self):
+        result = benchmarks.ReservationStress(workers=4, attempts=10, stock=25).run()
+        self.assertEqual(result['oversold'], 0)
+        self.assertTrue(result['consistent'])
+        self.assertEqual(result['units_reserved'] + result['units_left'], 25)
+        # Nothing is left behind in the database it ran against.
+        self.assertFalse(Product.objects.filter(name='Stress test product').exists())
+        self.assertFalse(User.objects.filter(username=benchmarks.BENCHMARK_USERNAME).exists())
+
+
+class SQLiteProfileTests(TestCase):
+    def open(self, pragmas, **options):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        settings_dict = {**connection.settings_dict, 'NAME': str(Path(directory) / 'db.sqlite3'),
+                         'OPTIONS': {**connection.settings_dict['OPTIONS'], **options}}
+        wrapper = type(connections['default'])(settings_dict, alias='profile_test')
+        self.addCleanup(wrapper.close)
+        with override_settings(ECOMMERCE_SQLITE_PRAGMAS=pragmas):
+            wrapper.ensure_connection()
+        return wrapper
+
+    def test_pragmas_are_applied_to_new_connections(self):
+        wrapper = self.open({'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -4321})
+        self.assertEqual(dbprofile.pragmas(wrapper, ['journal_mode', 'synchronous', 'cache_size']),
+                         {'journal_mode': 'wal', 'synchronous': 1, 'cache_size': -4321})
+
+    def test_busy_timeout_comes_from_the_timeout_option(self):
+        self.assertNotIn('busy_timeout', settings.ECOMMERCE_SQLITE_PRAGMAS)
+        wrapper = self.open(settings.ECOMMERCE_SQLITE_PRAGMAS, timeout=7)
+        self.assertEqual(dbprofile.pragmas(wrapper, ['busy_timeout']), {'busy_timeout': 7000})
+
+    def test_no_pragmas_leaves_connection_alone(self):
+        wrapper = self.open({})
+        self.assertEqual(dbprofile.pragmas(wrapper, ['journal_mode', 'synchronous']),
+                         {'journal_mode': 'delete', 'synchronous': 2})
+
+
+class MixedLoadBenchmarkTests(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The benchmark registers these aliases while it runs.
+        cls.databases = {'default', 'benchmark_basic', 'benchmark_production'}
+
+    def test_production_profile_has_no_lock_errors(self):
+        results = benchmarks.MixedLoadBenchmark(workers=4, operations=20, write_ratio=0.3, products=50).run()
+        self.assertEqual(set(results), {'basic', 'production'})
+        self.assertEqual(results['production']['errors'], 0)
+        self.assertEqual(results['production']['operations'], 80)
+        self.assertNotIn('benchmark_production', connections.settings)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test', ECOMMERCE_FULFILMENT='inline')
+class StripeWebhookTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user, phone='5550199')
+        self.product = make_product(name='Gizmo', price='4.00', stock=5)
+        self.client.force_login(self.user)
+        self.fake_stripe = FakeStripe().__enter__()
+        self.addCleanup(self.fake_stripe.__exit__, None, None, None)
+
+    def checkout(self):
+        self.client.post(reverse('ecommerce:add_to_cart', args=[self.product.pk]))
+        self.client.post(reverse('ecommerce:create_checkout_session'))
+        return self.fake_stripe.complete(self.fake_stripe.last_session['id'])['id']
+
+    def deliver(self, session_id, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.fake_stripe.send_webhook(Client(), session_id, 'whsec_test', **kwargs)
+
+    def test_webhook_builds_order_without_the_browser(self):
+        session_id = self.checkout()
+        response = self.client.get(reverse('ecommerce:payment_success'), {'session_id': session_id})
+        self.assertTemplateUsed(response, 'ecommerce/payment_pending.html')
+        self.assertEqual(self.deliver(session_id).status_code, 200)
+        order = Order.objects.get()
+        self.assertEqual(order.stripe_session_id, session_id)
+        self.assertEqual(order.shippinginfo.city, 'Testville')
+        self.assertEqual(reservations.available([self.product.pk]), {self.product.pk: 4})
+        self.assertIsNotNone(StockHold.objects.get().committed_at)
+        self.assertEqual(CartStore(self.user).quantities(), {})
+        self.assertIsNotNone(StripeEvent.objects.get().processed_at)
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('ecommerce:payment_success'), {'session_id': session_id})
+        self.assertEqual(response.context['order'], order)
+        self.assertNotIn('retrieve', [name for name, _ in self.fake_stripe.calls])
+
+    def test_redelivered_events_create_one_order(self):
+        session_id = self.checkout()
+        event = self.fake_stripe.event(session_id)
+        self.deliver(session_id, event=event)
+        self.deliver(session_id, event=event)
+        self.deliver(session_id)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(StripeEvent.objects.count(), 2)
+        self.assertEqual(reservations.available([self.product.pk]), {self.product.pk: 4})
+
+    def test_bad_signature_is_rejected(self):
+        session_id = self.checkout()
+        payload = json.dumps(self.fake_stripe.event(session_id))
+        response = Client().post(reverse('ecommerce:stripe_webhook'), payload, content_type='application/json',
+                                 HTTP_STRIPE_SIGNATURE=sign_payload(payload, 'whsec_wrong'))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+    def test_unpaid_session_is_not_fulfilled(self):
+        self.client.post(reverse('ecommerce:add_to_cart', args=[self.product.pk]))
+        self.client.post(reverse('ecommerce:create_checkout_session'))
+        with self.assertLogs('ecommerce.fulfilment', 'ERROR'):
+            self.deliver(self.fake_stripe.last_session['id'])
+        self.assertFalse(Order.objects.exists())
+        self.assertIn('not paid', StripeEvent.objects.get().error)
+
+    def test_order_is_built_from_what_was_paid_for(self):
+        session_id = self.checkout()
+        other = make_product(name='Extra', price='9.00')
+        store = CartStore(self.user)
+        store.apply([{'op': 'set', 'product': self.product.pk, 'quantity': 3}, {'op': 'add', 'product': other.pk}])
+        store.flush()
+        Product.objects.filter(pk=self.product.pk).update(price='5.00')
+        self.deliver(session_id)
+        order = Order.objects.get()
+        self.assertEqual(str(order.total), '4.00')
+        self.assertEqual(list(order.items.values_list('product_id', 'quantity', 'price')),
+                         [(self.product.pk, 1, Decimal('4.00'))])
+        # Only what was ordered leaves the cart.
+        self.assertEqual(list(CartItem.objects.values_list('product_id', flat=True)), [other.pk])
+        self.assertEqual(CartStore(self.user).quantities(), {other.pk: 1})
+
+    def test_amount_mismatch_needs_review(self):
+        session_id = self.checkout()
+        self.fake_stripe.sessions[session_id]['amount_total'] = 1
+        with self.assertLogs('ecommerce.fulfilment', 'ERROR'):
+            self.deliver(session_id)
+        self.assertFalse(Order.objects.exists())
+        event = StripeEvent.objects.get()
+        self.assertIn('Stripe charged 1 but the checkout came to 400', event.error)
+        self.assertIsNotNone(event.processed_at)
+
+    def test_pending_events_are_retried_by_command(self):
+        session_id = self.checkout()
+        with self.settings(ECOMMERCE_FULFILMENT='background'), mock.patch.object(fulfilment, 'dispatch'):
+            self.deliver(session_id)
+        self.assertFalse(Order.objects.exists())
+        out = StringIO()
+        call_command('process_stripe_events', stdout=out)
+        self.assertIn('Processed 1 events, 0 pending.', out.getvalue())
+        self.assertEqual(Order.objects.get().stripe_session_id, session_id)
+
+
+class PaymentClientTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = FakeStripeServer().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.addCleanup(payments.reset_clients)
+        # No backoff sleeps between retries.
+        patch = mock.patch.object(stripe.HTTPClient, 'INITIAL_DELAY', 0)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def run_requests(self, count, concurrent=False, **options):
+        params = {'mode': 'payment', 'line_items': [{'price_data': {'unit_amount': 250}, 'quantity': 2}]}
+
+        async def run():
+            if concurrent:
+                return await asyncio.gather(*[payments.create_checkout_session(**params) for _ in range(count)])
+            return [await payments.create_checkout_session(**params) for _ in range(count)]
+        with self.settings(ECOMMERCE_STRIPE_CLIENT={'API_BASE': self.server.url, **options}):
+            return asyncio.run(run())
+
+    def test_connections_are_kept_alive(self):
+        sessions = self.run_requests(5)
+        self.assertEqual([session.amount_total for session in sessions], [500] * 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_concurrency_is_bounded_by_the_pool(self):
+        self.server.delay = 0.05
+        self.assertEqual(len(self.run_requests(6, concurrent=True, MAX_CONNECTIONS=2)), 6)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_failures_are_retried_with_one_idempotency_key(self):
+        self.server.fail(503, times=2)
+        self.run_requests(1, MAX_RETRIES=2)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len({key for _, _, key in self.server.requests}), 1)
+        self.assertEqual(len(self.server.stripe.sessions), 1)
+
+    def test_slow_responses_time_out(self):
+        self.server.delay = 0.5
+        with self.assertRaises(payments.PaymentError):
+            self.run_requests(1, TIMEOUT=0.05, MAX_RETRIES=1)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_client_errors_are_not_retried(self):
+        self.server.fail(400)
+        with self.assertRaises(payments.PaymentError) as caught:
+            self.run_requests(1)
+        self.assertEqual(caught.exception.status, 400)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_checkout_view_uses_the_client(self):
+        user = User.objects.create_user('shopper', password='pw')
+        customer = Customer.objects.create(user=user)
+        product = make_product(price='2.50')
+        self.client.force_login(user)
+        self.client.post(reverse('ecommerce:add_to_cart', args=[product.pk]))
+        with self.settings(ECOMMERCE_STRIPE_CLIENT={'API_BASE': self.server.url}):
+            response = self.client.post(reverse('ecommerce:create_checkout_session'))
+        session = self.server.stripe.last_session
+        self.assertRedirects(response, session['url'], fetch_redirect_response=False)
+        self.assertEqual(session['amount_total'], 250)
+        self.assertEqual(session['metadata'], {
+            'customer_id': customer.pk, 'cart_id': Cart.objects.get().pk,
+            'reservation': StockHold.objects.get().reservation,
+        })
+        self.server.fail(400)
+        with self.settings(ECOMMERCE_STRIPE_CLIENT={'API_BASE': self.server.url}):
+            response = self.client.post(reverse('ecommerce:create_checkout_session'))
+        self.assertRedirects(response, reverse('ecommerce:view_cart'), fetch_redirect_response=False)
+        # The failed attempt gave its hold back; the first checkout's is still held.
+        self.assertEqual(StockHold.objects.count(), 1)
+
+
+class ProductRatingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user)
+        self.lamp = make_product(name='Lamp')
+        self.desk = make_product(name='Desk')
+        self.client.force_login(self.user)
+
+    def order(self, *products):
+        order = Order.objects.create(customer=self.customer, total='10.00', status='Paid')
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=p, quantity=1, price=p.price) for p in products])
+        return order
+
+    def review(self, order, rating):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('ecommerce:leave_review', args=[order.pk]),
+                                    {'rating': rating, 'comment': 'Fine.'})
+
+    def summary(self, product):
+        rating = ProductRating.objects.get(product=product)
+        return rating.count, rating.total, [count for _, count, _ in rating.histogram]
+
+    def test_reviews_update_every_product_on_the_order(self):
+        self.review(self.order(self.lamp, self.desk), 4)
+        self.review(self.order(self.lamp), 5)
+        self.assertEqual(self.summary(self.lamp), (2, 9, [1, 1, 0, 0, 0]))
+        self.assertEqual(self.summary(self.desk), (1, 4, [0, 1, 0, 0, 0]))
+        self.assertEqual(ProductRating.objects.get(product=self.lamp).average, 4.5)
+
+    def test_out_of_range_rating_is_rejected(self):
+        response = self.review(self.order(self.lamp), 9)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Review.objects.exists())
+        self.assertFalse(ProductRating.objects.exists())
+
+    def test_edits_and_deletes_keep_summaries_right(self):
+        self.review(self.order(self.lamp), 2)
+        self.review(self.order(self.lamp, self.desk), 5)
+        review = Review.objects.get(rating=2)
+        review.rating = 3
+        review.save()
+        self.assertEqual(self.summary(self.lamp), (2, 8, [1, 0, 1, 0, 0]))
+        Order.objects.get(pk=Review.objects.get(rating=5).order_id).delete()
+        self.assertEqual(self.summary(self.lamp), (1, 3, [0, 0, 1, 0, 0]))
+        self.assertEqual(self.summary(self.desk), (0, 0, [0, 0, 0, 0, 0]))
+
+    def test_rebuild_command_matches_incremental_updates(self):
+        for rating in (1, 3, 5):
+            self.review(self.order(self.lamp, self.desk), rating)
+        expected = {p.pk: self.summary(p) for p in (self.lamp, self.desk)}
+        ProductRating.objects.update(count=0, total=0, stars_1=0)
+        out = StringIO()
+        call_command('rebuild_ratings', stdout=out)
+        self.assertIn('2 products', out.getvalue())
+        self.assertEqual({p.pk: self.summary(p) for p in (self.lamp, self.desk)}, expected)
+        self.assertEqual(ratings.rebuild([self.lamp.pk]), 1)
+        self.assertEqual(self.summary(self.desk), expected[self.desk.pk])
+
+    def test_catalogue_shows_ratings_without_touching_reviews(self):
+        self.review(self.order(self.lamp), 4)
+        self.client.logout()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('ecommerce:product_list'), {'category': 'Tools'})
+        self.assertContains(response, '4.0 (1 review)')
+        self.assertFalse([q for q in queries.captured_queries if 'ecommerce_review' in q['sql']])
+        response = self.client.get(reverse('ecommerce:product_detail', args=[self.lamp.pk]))
+        self.assertContains(response, '4.0 / 5')
+
+    def test_a_review_renews_cached_pages_but_not_the_facets(self):
+        self.client.logout()
+        url = reverse('ecommerce:product_list') + '?category=Tools'
+        self.client.get(url)
+        generation = catalogue.get_generation()
+        self.review(self.order(self.lamp), 4)
+        self.assertEqual(catalogue.get_generation(), generation)
+        self.client.force_login(self.user)
+        self.review(self.order(self.desk), 2)
+        self.client.logout()
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertContains(response, '2.0 (1 review)')
+        self.assertEqual(catalogue.get_generation(), generation)
+
+    def test_reviews_are_paginated(self):
+        for rating in range(12):
+            Review.objects.create(order=self.order(self.lamp), customer=self.customer, rating=rating % 5 + 1)
+        response = self.client.get(reverse('ecommerce:product_reviews', args=[self.lamp.pk]))
+        page = response.context['page_obj']
+        self.assertEqual(len(page), 10)
+        response = self.client.get(reverse('ecommerce:product_reviews', args=[self.lamp.pk]),
+                                   {'cursor': page.next_cursor})
+        self.assertEqual(len(response.context['page_obj']), 2)
+        self.assertFalse(response.context['page_obj'].has_next())
+
+
+def png(width, height, color=(200, 30, 30)):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'PNG')
+    return SimpleUploadedFile('photo.png', buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(ECOMMERCE_IMAGE_PROCESSING='inline', ECOMMERCE_IMAGE_WIDTHS=[320, 640, 1280])
+class ProductImageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def upload(self, product=None, width=800, height=400, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            if product is None:
+                return make_product(image=png(width, height, **kwargs))
+            product.image = png(width, height, **kwargs)
+            product.save()
+        return product
+
+    def test_upload_builds_variants_without_upscaling(self):
+        product = self.upload()
+        product.refresh_from_db()
+        widths = [(width, height) for width, height, _ in product.image_variants['jpeg']]
+        self.assertEqual(widths, [(320, 160), (640, 320), (800, 400)])
+        for fmt, variants in product.image_variants.items():
+            for width, height, name in variants:
+                self.assertTrue(name.startswith(f'products/variants/{product.image_digest}-{width}.'))
+                self.assertTrue(default_storage.exists(name))
+        self.assertEqual(images.smallest(product), product.image_variants['jpeg'][0][2])
+
+    def test_unchanged_image_is_not_rebuilt_and_a_new_one_is(self):
+        product = self.upload()
+        product.refresh_from_db()
+        first = product.image_digest
+        self.assertFalse(images.build(product.pk))
+        self.assertTrue(images.build(product.pk, force=True))
+        product = self.upload(Product.objects.get(pk=product.pk), color=(0, 0, 255))
+        product.refresh_from_db()
+        self.assertNotEqual(product.image_digest, first)
+
+    def test_identical_uploads_share_variant_files(self):
+        one, two = self.upload(), self.upload()
+        one.refresh_from_db()
+        two.refresh_from_db()
+        self.assertNotEqual(one.image.name, two.image.name)
+        self.assertEqual(one.image_variants, two.image_variants)
+
+    def test_removing_the_image_clears_variants(self):
+        product = Product.objects.get(pk=self.upload().pk)
+        product.image = None
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual((product.image_digest, product.image_variants), ('', {}))
+
+    def test_catalogue_and_detail_pages_use_srcset(self):
+        product = self.upload(width=1600, height=1200)
+        product.refresh_from_db()
+        name = product.image_variants['jpeg'][0][2]
+        for url in (reverse('ecommerce:product_list') + '?category=Tools',
+                    reverse('ecommerce:product_detail', args=[product.pk])):
+            response = self.client.get(url)
+            self.assertContains(response, f'{default_storage.url(name)} 320w')
+            self.assertContains(response, 'sizes="')
+            self.assertNotContains(response, f'src="{product.image.url}"')
+        if 'webp' in images.FORMATS:
+            self.assertContains(response, '<source type="image/webp"')
+        self.assertNotContains(response, 'loading="lazy"')
+
+    def test_variants_are_served_with_far_future_headers(self):
+        product = self.upload()
+        product.refresh_from_db()
+        variant = product.image_variants['jpeg'][0][2]
+        response = self.client.get(default_storage.url(variant))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], assets.IMMUTABLE)
+        response = self.client.get(product.image.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+    def test_original_is_shown_until_variants_exist(self):
+        product = make_product(image=png(100, 100))
+        response = self.client.get(reverse('ecommerce:product_detail', args=[product.pk]))
+        self.assertContains(response, f'src="{product.image.url}"')
+
+
+class StaticAssetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(assets.is_local.cache_clear)
+        self.addCleanup(assets.read_text.cache_clear)
+        assets.is_local.cache_clear()
+
+    def static_dir(self, files):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        for name, body in files.items():
+            (directory / name).parent.mkdir(parents=True, exist_ok=True)
+            (directory / name).write_text(body)
+        return directory
+
+    def test_vendored_files_match_their_pins(self):
+        missing, problems = assets.check_vendor_files()
+        self.assertEqual(problems, [])
+        for path in assets.VENDOR_ASSETS:
+            if path not in missing:
+                self.assertIsNotNone(assets.VENDOR_ASSETS[path][1], path)
+
+    def test_vendor_files_fall_back_to_the_cdn_until_vendored(self):
+        assets.is_local.cache_clear()
+        with override_settings(STATICFILES_DIRS=[self.static_dir({})]):
+            response = self.client.get(reverse('ecommerce:view_cart'))
+        url, integrity = assets.VENDOR_ASSETS['vendor/bootstrap/bootstrap.min.css']
+        self.assertContains(response, f'<link rel="stylesheet" href="{url}" integrity="{integrity}"')
+
+        directory = self.static_dir({'vendor/bootstrap/bootstrap.min.css': 'body{}'})
+        with override_settings(STATICFILES_DIRS=[directory]):
+            assets.is_local.cache_clear()
+            response = self.client.get(reverse('ecommerce:view_cart'))
+        self.assertContains(response, '<link rel="stylesheet" href="/static/vendor/bootstrap/bootstrap.min.css">')
+        self.assertNotContains(response, url)
+
+    def test_collectstatic_refuses_vendor_files_that_fail_their_pins(self):
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        files = {'vendor/bootstrap/bootstrap.min.css': 'body{}'}
+        with override_settings(STATICFILES_DIRS=[self.static_dir(files)], STATIC_ROOT=root):
+            with self.assertRaisesMessage(CommandError, 'vendor/bootstrap/bootstrap.min.css: does not match'):
+                call_command('collectstatic', interactive=False, verbosity=0)
+        self.assertEqual(list(root.iterdir()), [])
+
+    def test_vendor_assets_only_writes_pinned_files(self):
+        body = b'body{}\n/*# sourceMappingURL=a.css.map */'
+        pinned = assets.integrity(body)
+        url = 'https://cdn.example/'
+        vendor = {'vendor/a.css': (url + 'a.css', pinned), 'vendor/b.css': (url + 'b.css', None)}
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        response = mock.Mock(content=body)
+        stderr = StringIO()
+        with mock.patch.dict('ecommerce.management.commands.vendor_assets.__dict__',
+                             VENDOR_ASSETS=vendor, STATIC_DIR=directory), \
+                mock.patch('requests.get', return_value=response):
+            call_command('vendor_assets', stdout=StringIO(), stderr=stderr)
+            self.assertIn(f'vendor/b.css skipped: no hash is pinned. Check {pinned}', stderr.getvalue())
+            self.assertEqual((directory / 'vendor/a.css').read_bytes(), body)
+            self.assertFalse((directory / 'vendor/b.css').exists())
+
+            response.content = b'body{color:red}'
+            with self.assertRaisesMessage(CommandError, 'does not match'):
+                call_command('vendor_assets', stdout=StringIO(), stderr=StringIO())
+
+    def test_catalogue_inlines_critical_css_and_defers_bootstrap(self):
+        response = self.client.get(reverse('ecommerce:product_list'))
+        self.assertContains(response, '<style>')
+        self.assertContains(response, '.col-md-4{flex:0 0 auto;width:33.33333333%}')
+        self.assertContains(response, 'rel="preload"', count=2)
+        self.assertContains(response, '<noscript>', count=2)
+        self.assertContains(response, ' defer></script>')
+
+    def test_collectstatic_fingerprints_and_compresses(self):
+        css = 'body { color: #212529; }\n' * 40
+        source = self.static_dir({'site/main.css': css, 'site/app.js': 'go()\n//# sourceMappingURL=app.js.map'})
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        with override_settings(STATICFILES_DIRS=[source], STATIC_ROOT=root):
+            call_command('collectstatic', interactive=False, verbosity=0, stderr=StringIO())
+            hashed = staticfiles_storage.stored_name('site/main.css')
+            self.assertRegex(hashed, r'^site/main\.[0-9a-f]{12}\.css$')
+            self.assertEqual(gzip.decompress((root / f'{hashed}.gz').read_bytes()).decode(), css)
+            self.assertEqual(static('site/main.css'), f'/static/{hashed}')
+
+            response = self.client.get(f'/static/{hashed}', HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Content-Type'], 'text/css')
+            self.assertEqual(response['Cache-Control'], assets.IMMUTABLE)
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertEqual(gzip.decompress(b''.join(response.streaming_content)).decode(), css)
+
+            response = self.client.get(f'/static/{hashed}')
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(b''.join(response.streaming_content).decode(), css)
+
+            response = self.client.get('/static/site/main.css')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Cache-Control'], 'no-cache')
+
+
+class CatalogueExportTests(TestCase):
+    def setUp(self):
+        self.lamp = make_product(name='Export Lamp', price='5.00', stock=7)
+        ProductRating.objects.create(product=self.lamp, count=2, total=7, stars_3=1, stars_4=1)
+        self.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+
+    def records(self, body):
+        return [json.loads(line) for line in body.decode().splitlines()]
+
+    def get(self, **params):
+        return self.client.get(reverse('ecommerce:export_catalogue'), params)
+
+    def test_jsonl_streams_every_product_in_order(self):
+        self.client.force_login(self.staff)
+        response = self.get(stock='1', ratings='1')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        records = self.records(b''.join(response.streaming_content))
+        self.assertEqual(len(records), Product.objects.count())
+        self.assertEqual([r['id'] for r in records], sorted(r['id'] for r in records))
+        lamp = next(r for r in records if r['id'] == self.lamp.pk)
+        self.assertEqual(lamp['name'], 'Export Lamp')
+        self.assertEqual((lamp['price'], lamp['stock'], lamp['image']), ('5.00', 7, ''))
+        self.assertEqual((lamp['rating_count'], lamp['rating_average']), (2, 3.5))
+
+    def test_csv_with_gzip_and_changed_since(self):
+        self.client.force_login(self.staff)
+        since = timezone.now()
+        Product.objects.exclude(pk=self.lamp.pk).update(updated_at=since - timedelta(days=1))
+        Product.objects.filter(pk=self.lamp.pk).update(updated_at=since + timedelta(seconds=1))
+        response = self.client.get(reverse('ecommerce:export_catalogue'),
+                                   {'format': 'csv', 'since': since.isoformat()}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        rows = list(csv.reader(io.StringIO(gzip.decompress(b''.join(response.streaming_content)).decode())))
+        self.assertEqual(rows[0], list(export.FIELDS) + ['deleted'])
+        self.assertEqual([(row[1], row[-1]) for row in rows[1:]], [('Export Lamp', 'False')])
+        self.assertTrue(response['X-Export-As-Of'])
+
+    def test_changed_since_reports_deletions_and_stock_moves(self):
+        since = export.started_at()
+        self.assertLessEqual(since, timezone.now() - export.SINCE_OVERLAP)
+        Product.objects.update(updated_at=since - timedelta(days=1))
+        StockShard.objects.update(updated_at=since - timedelta(days=1))
+        gone = make_product(name='Gone Lamp')
+        gone_pk = gone.pk
+        gone.delete()
+        with transaction.atomic():
+            self.assertEqual(reservations.take({self.lamp.pk: 3}), [])
+        records = self.records(''.join(export.lines('jsonl', since=since, stock=True)).encode())
+        self.assertEqual([(r['id'], r['deleted'], r['stock']) for r in records],
+                         [(gone_pk, True, None), (self.lamp.pk, False, 4)])
+        self.assertIsNone(records[0]['name'])
+
+    def test_requires_staff_or_token(self):
+        self.assertEqual(self.get().status_code, 403)
+        with override_settings(ECOMMERCE_EXPORT_TOKENS=['s3cret']):
+            response = self.client.get(reverse('ecommerce:export_catalogue'), HTTP_AUTHORIZATION='Bearer s3cret')
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(reverse('ecommerce:export_catalogue'), HTTP_AUTHORIZATION='Bearer nope')
+            self.assertEqual(response.status_code, 403)
+
+    def test_bad_parameters(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.get(format='xml').status_code, 400)
+        self.assertEqual(self.get(since='last week').status_code, 400)
+
+    def test_chunks_are_bounded(self):
+        with mock.patch.object(export, 'CHUNK_BYTES', 1024):
+            chunks = list(export.lines('jsonl'))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) < 1024 + 2048 for chunk in chunks))
+        self.assertEqual(len(''.join(chunks).splitlines()), Product.objects.count())
+
+    def test_command_writes_gzip_file(self):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        target = directory / 'catalogue.jsonl.gz'
+        stderr = StringIO()
+        call_command('export_catalogue', '--output', str(target), '--since', '2000-01-01', stderr=stderr)
+        records = self.records(gzip.decompress(target.read_bytes()))
+        self.assertEqual(len(records), Product.objects.count())
+        self.assertIn('Exported as of', stderr.getvalue())
+        stdout = StringIO()
+        call_command('export_catalogue', '--format', 'csv', stdout=stdout, stderr=StringIO())
+        self.assertEqual(len(list(csv.reader(io.StringIO(stdout.getvalue())))), Product.objects.count() + 1)
+
+
+class ProductImportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        search.reset_backend()
+        Product.objects.all().delete()
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write_csv(self, name, rows):
+        path = self.directory / name
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(importing.FIELDS)
+            writer.writerows(rows)
+        return str(path)
+
+    def import_file(self, path, *args):
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_products', path, *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def test_csv_creates_then_updates_by_sku(self):
+        path = self.write_csv('feed.csv', [
+            ('K-1', 'Copper Kettle', 'Acme', 'Kitchen', 'Whistles.', '19.99', '5'),
+            ('H-1', 'Claw Hammer', 'Forge', 'Tools', '', '12.50', '0'),
+        ])
+        output = self.import_file(path)
+        self.assertIn('2 created, 0 updated, 0 rejected', output)
+        self.assertIn('rows/s', output)
+        kettle = Product.objects.get(sku='K-1')
+        self.assertEqual((kettle.name, str(kettle.price), kettle.stock), ('Copper Kettle', '19.99', 5))
+        self.assertEqual(reservations.available([kettle.pk]), {kettle.pk: 5})
+        self.assertEqual([p.sku for p in search.search_products(Product.objects.all(), 'kettle')], ['K-1'])
+        self.assertEqual(facets.facet_counts()['brand'], [('Acme', 1), ('Forge', 1)])
+
+        version = catalogue.get_product_version(kettle.pk)
+        path = self.write_csv('update.csv', [
+            ('K-1', 'Copper Kettle', 'Forge', 'Kitchen', 'Whistles.', '17.99', '8'),
+            ('S-1', 'Hand Saw', 'Forge', 'Tools', '', '9.00', '3'),
+        ])
+        output = self.import_file(path)
+        self.assertIn('1 created, 1 updated, 0 rejected', output)
+        self.assertEqual(Product.objects.count(), 3)
+        kettle = Product.objects.get(pk=kettle.pk)
+        self.assertEqual((kettle.brand, str(kettle.price), kettle.stock), ('Forge', '17.99', 8))
+        self.assertEqual(reservations.available([kettle.pk]), {kettle.pk: 8})
+        self.assertGreater(catalogue.get_product_version(kettle.pk), version)
+        self.assertEqual(facets.facet_counts()['brand'], [('Forge', 3)])
+        facets.invalidate()
+        self.assertEqual(facets.facet_counts()['brand'], [('Forge', 3)])
+
+    def test_rejects_go_to_side_file(self):
+        path = self.write_csv('feed.csv', [
+            ('', 'No SKU', 'Acme', 'Tools', '', '1.00', '1'),
+            ('B-1', 'Bad Price', 'Acme', 'Tools', '', '1.005', '1'),
+            ('B-2', 'Bad Stock', 'Acme', 'Tools', '', '1.00', '-2'),
+            ('G-1', 'Good', 'Acme', 'Tools', '', '1.00', '1'),
+        ])
+        output = self.import_file(path)
+        self.assertIn('1 created, 0 updated, 3 rejected', output)
+        rejects = [json.loads(line) for line in open(path + '.rejects.jsonl')]
+        self.assertEqual([r['line'] for r in rejects], [2, 3, 4])
+        self.assertEqual(rejects[1]['record']['name'], 'Bad Price')
+        self.assertIn('sku is required', rejects[0]['error'])
+        self.assertEqual(list(Product.objects.values_list('sku', flat=True)), ['G-1'])
+
+    def test_gzipped_jsonl_on_worker_processes(self):
+        path = self.directory / 'feed.jsonl.gz'
+        lines = [json.dumps({'sku': f'P-{i}', 'name': f'Part {i}', 'brand': 'Acme', 'category': 'Parts',
+                             'price': '1.50', 'stock': i}) for i in range(30)]
+        lines += ['not json', json.dumps({'sku': 'P-0', 'name': 'Part zero', 'brand': 'Acme', 'category': 'Parts',
+                                          'price': 2, 'stock': 1})]
+        path.write_bytes(gzip.compress('\n'.join(lines).encode()))
+        rejects = self.directory / 'rejects.jsonl'
+        output = self.import_file(str(path), '--workers', '2', '--batch-size', '7', '--rejects', str(rejects))
+        self.assertIn('30 created, 1 updated, 1 rejected', output)
+        self.assertEqual(Product.objects.count(), 30)
+        self.assertEqual(Product.objects.get(sku='P-0').name, 'Part zero')
+        self.assertEqual(json.loads(rejects.read_text())['line'], 31)
+
+    def test_csv_records_are_parsed_on_worker_processes(self):
+        path = self.write_csv('feed.csv', [
+            ('K-1', 'Copper Kettle', 'Acme', 'Kitchen', 'Whistles,\nloudly "when" hot.', '19.99', '5'),
+            ('H-1', 'Claw Hammer', 'Forge', 'Tools', '', '12.50', '1'),
+        ])
+        with open(path, 'a') as f:
+            f.write('\nB-1,Bad "Quote,Acme,Tools,,1.00,1\nS-1,Saw,Forge,Tools,,9.00,2\n')
+        output = self.import_file(path, '--workers', '2')
+        self.assertIn('2 created, 0 updated, 1 rejected', output)
+        self.assertEqual(Product.objects.get(sku='K-1').description, 'Whistles,\nloudly "when" hot.')
+        self.assertEqual(Product.objects.get(sku='H-1').stock, 1)
+        rejects = [json.loads(line) for line in open(path + '.rejects.jsonl')]
+        self.assertEqual([(r['line'], r['error']) for r in rejects], [(6, 'Invalid CSV: unbalanced quotes.')])
+
+    def test_missing_columns(self):
+        path = self.directory / 'feed.csv'
+        path.write_text('sku,name\nA-1,Thing\n')
+        with self.assertRaisesMessage(CommandError, 'brand, category, price, stock'):
+            call_command('import_products', str(path), stdout=StringIO())
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        recommendations.reset_cache()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user)
+        self.kettle, self.mug, self.tea, self.saw = (
+            make_product(name=name) for name in ('Kettle', 'Mug', 'Loose Tea', 'Saw')
+        )
+
+    def order(self, products, days_ago=0):
+        order = Order.objects.create(customer=self.customer, total='1.00', status='Paid')
+        OrderItem.objects.bulk_create(OrderItem(order=order, product=p, quantity=1, price='1.00') for p in products)
+        Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+
+    def build(self, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return recommendations.build(**kwargs)
+
+    def test_recent_orders_outweigh_old_ones(self):
+        self.order([self.kettle, self.mug], days_ago=365)
+        self.order([self.kettle, self.mug, self.mug], days_ago=300)
+        self.order([self.kettle, self.tea])
+        self.order([self.saw])
+        stats = self.build(half_life_days=90)
+        self.assertEqual((stats.orders, stats.pairs, stats.products), (4, 4, 3))
+        self.assertEqual(recommendations.related_ids(self.kettle.pk), (self.tea.pk, self.mug.pk))
+        self.assertEqual(recommendations.related_ids(self.mug.pk), (self.kettle.pk,))
+        self.assertEqual(recommendations.related_ids(self.saw.pk), ())
+        stats = self.build(half_life_days=10_000)
+        self.assertEqual(recommendations.related_ids(self.kettle.pk), (self.mug.pk, self.tea.pk))
+        self.assertEqual(stats.changed, 1)
+
+    def test_folding_in_chunks_gives_the_same_result(self):
+        for i in range(12):
+            self.order([self.kettle, self.mug, self.tea][i % 3:] + [self.saw], days_ago=i)
+        matrix = recommendations.CoOccurrence()
+        for created_at, products in recommendations.baskets():
+            matrix.add(products, 1.0)
+        expected = list(matrix.top(2))
+        with mock.patch.object(recommendations, 'FOLD_PAIRS', 3):
+            matrix = recommendations.CoOccurrence()
+            for created_at, products in recommendations.baskets(chunk_size=5):
+                matrix.add(products, 1.0)
+            self.assertEqual(list(matrix.top(2)), expected)
+        # Ties go to the lower product id.
+        self.assertEqual(expected[0], (self.kettle.pk, [(self.mug.pk, 4.0), (self.tea.pk, 4.0)]))
+
+    def test_pure_python_fold_keeps_a_bounded_number_of_partners(self):
+        with mock.patch.object(recommendations, 'numpy', None), \
+                mock.patch.object(recommendations, 'FOLD_PAIRS', 4), \
+                mock.patch.object(recommendations, 'MAX_PARTNERS', 4):
+            matrix = recommendations.CoOccurrence()
+            for _ in range(3):
+                matrix.add([1, 2], 1.0)
+            for other in range(10, 30):
+                matrix.add([1, other], 0.1)
+            matrix.fold()
+            self.assertLessEqual(len(matrix.totals[1]), 4)
+            self.assertEqual(next(matrix.top(1)), (1, [(2, 3.0)]))
+
+    def test_lookups_are_cached_per_process_until_a_rebuild(self):
+        self.order([self.kettle, self.mug])
+        self.build()
+        with self.assertNumQueries(1):
+            recommendations.related_many([self.kettle.pk, self.mug.pk, self.saw.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(recommendations.related_ids(self.kettle.pk), (self.mug.pk,))
+        self.order([self.kettle, self.tea])
+        self.order([self.kettle, self.tea])
+        self.build()
+        self.assertEqual(recommendations.related_ids(self.kettle.pk), (self.tea.pk, self.mug.pk))
+
+    def test_product_and_cart_pages_show_recommendations(self):
+        self.order([self.kettle, self.mug, self.tea])
+        self.order([self.kettle, self.tea])
+        url = reverse('ecommerce:product_detail', args=[self.kettle.pk])
+        self.assertNotContains(self.client.get(url), 'Frequently bought together')
+        self.build()
+        response = self.client.get(url)
+        self.assertContains(response, 'Frequently bought together')
+        self.assertEqual([p.pk for p in recommendations.for_product(self.kettle.pk)], [self.tea.pk, self.mug.pk])
+        self.assertContains(response, reverse('ecommerce:product_detail', args=[self.tea.pk]))
+
+        self.client.force_login(self.user)
+        CartStore(self.user).apply([{'op': 'add', 'product': self.kettle.pk}, {'op': 'add', 'product': self.tea.pk}])
+        response = self.client.get(reverse('ecommerce:view_cart'))
+        self.assertContains(response, 'Customers also bought')
+        self.assertEqual([p.pk for p in recommendations.for_cart([self.kettle.pk, self.tea.pk])], [self.mug.pk])
+
+    def test_cached_product_page_follows_recommended_products(self):
+        self.order([self.kettle, self.mug])
+        self.build()
+        url = reverse('ecommerce:product_detail', args=[self.kettle.pk])
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mug.name = 'Tall Mug'
+            self.mug.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Tall Mug')
+
+    def test_command(self):
+        self.order([self.kettle, self.mug])
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('build_recommendations', '--top-k', '1', '--since-days', '30', stdout=stdout)
+        self.assertIn('Read 1 orders', stdout.getvalue())
+        self.assertEqual(ProductRecommendation.objects.get(pk=self.mug.pk).related, [self.kettle.pk])
+
+
+class OrderHistoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user)
+        self.products = [make_product(name=f'Gizmo {i}') for i in range(3)]
+        self.client.force_login(self.user)
+
+    def make_orders(self, count, items=1):
+        now = timezone.now()
+        orders = Order.objects.bulk_create([
+            Order(customer=self.customer, total='9.99', status='Paid') for _ in range(count)
+        ])
+        for i, order in enumerate(orders):
+            order.created_at = now - timedelta(hours=i)
+        Order.objects.bulk_update(orders, ['created_at'])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=2, price=product.price)
+            for order in orders for product in self.products[:items]
+        ])
+        summarise([order.pk for order in orders])
+        return orders
+
+    def test_history_is_paginated_from_the_summary(self):
+        orders = self.make_orders(25, items=3)
+        url = reverse('ecommerce:order_history')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        page = response.context['page_obj']
+        self.assertEqual([o.pk for o in page], [o.pk for o in orders[:20]])
+        self.assertContains(response, 'Gizmo 0 &middot; 6 items')
+        self.assertFalse([q for q in queries.captured_queries if 'ecommerce_orderitem' in q['sql']])
+        response = self.client.get(url, {'cursor': page.next_cursor})
+        self.assertEqual([o.pk for o in response.context['page_obj']], [o.pk for o in orders[20:]])
+
+    def test_order_detail_runs_a_fixed_number_of_queries(self):
+        small, large = self.make_orders(2, items=1)[0], self.make_orders(1, items=3)[0]
+        for order in (small, large):
+            Review.objects.create(order=order, customer=self.customer, rating=4, comment='Sturdy.')
+            ShippingInfo.objects.create(customer=self.customer, order=order, address='1 Road', city='Town',
+                                        postal_code='1', country='US', phone='1')
+        with self.assertNumQueries(6) as counted:
+            response = self.client.get(reverse('ecommerce:order_detail', args=[small.pk]))
+        self.assertContains(response, 'Sturdy.')
+        self.assertContains(response, 'Town')
+        with self.assertNumQueries(len(counted)):
+            response = self.client.get(reverse('ecommerce:order_detail', args=[large.pk]))
+        self.assertContains(response, 'Gizmo 2')
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    # Two SQLite databases: the test database as primary and a file as
+    # replica, added once the runner has set up the configured ones.
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.replica_dir = Path(tempfile.mkdtemp())
+        connections.settings['replica'] = {
+            **connections['default'].settings_dict, 'NAME': str(cls.replica_dir / 'replica.sqlite3'),
+        }
+        cls.databases = {'default', 'replica'}
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        cls.databases = {'default'}
+        shutil.rmtree(cls.replica_dir)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        routing.reset_health()
+        self.addCleanup(routing.reset_health)
+        self.replica_path = self.replica_dir / 'replica.sqlite3'
+        connections['replica'].close()
+        self.replica_path.unlink(missing_ok=True)
+        replicas = self.settings(ECOMMERCE_DB_REPLICAS=['replica'])
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+
+        self.user = User.objects.create_user('shopper', password='pw')
+        self.customer = Customer.objects.create(user=self.user)
+        self.wishlist = Wishlist.objects.create(customer=self.customer, name='Later')
+        self.product = make_product(name='Old name')
+        self.client.force_login(self.user)
+
+    def rename_on_primary(self):
+        Product.objects.filter(pk=self.product.pk).update(name='New name')
+
+    def detail(self):
+        return self.client.get(reverse('ecommerce:product_detail', args=[self.product.pk]))
+
+    def test_catalogue_reads_replica_until_the_browser_writes(self):
+        call_command('sync_replicas', stdout=StringIO())
+        self.rename_on_primary()
+        self.assertContains(self.detail(), 'Old name')
+        response = self.client.post(reverse('ecommerce:add_to_wishlist', args=[self.product.pk]),
+                                    {'wishlist_id': self.wishlist.pk})
+        self.assertIn(routing.PIN_COOKIE, response.cookies)
+        self.assertContains(self.detail(), 'New name')
+
+    def test_cached_anonymous_pages_are_rendered_from_the_primary(self):
+        call_command('sync_replicas', stdout=StringIO())
+        self.rename_on_primary()
+        self.client.logout()
+        response = self.detail()
+        self.assertContains(response, 'New name')
+        self.assertEqual(response['X-Cache'], 'MISS')
+
+    def test_reads_inside_transactions_and_non_catalogue_models_use_primary(self):
+        router = routing.ReplicaRouter()
+        self.assertEqual(router.db_for_read(Product), 'default')
+        token = routing._route.set(routing._Route(True))
+        try:
+            with mock.patch.object(routing, 'is_healthy', return_value=True):
+                self.assertEqual(router.db_for_read(Product), 'replica')
+                self.assertEqual(router.db_for_read(Cart), 'default')
+                with transaction.atomic():
+                    self.assertEqual(router.db_for_read(Product), 'default')
+        finally:
+            routing._route.reset(token)
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        sqlite3.connect(self.replica_path).close()
+        self.rename_on_primary()
+        self.assertContains(self.detail(), 'New name')
+        self.assertFalse(routing.is_healthy('replica'))
+
+    def test_failing_replica_query_is_retried_on_primary(self):
+        replica = sqlite3.connect(self.replica_path)
+        replica.execute('CREATE TABLE django_migrations (id integer)')
+        replica.execute('INSERT INTO django_migrations VALUES (1)')
+        replica.commit()
+        replica.close()
+        self.rename_on_primary()
+        response = self.detail()
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'New name')
+        self.assertFalse(routing.is_healthy('replica'))
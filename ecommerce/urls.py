@@ -5,17 +5,21 @@ app_name = "ecommerce"
 urlpatterns = [
     path('', views.product_list, name='product_list'),
     path('product/<int:pk>/', views.product_detail, name='product_detail'),
+    path('product/<int:pk>/reviews/', views.product_reviews, name='product_reviews'),
     path('register/', views.register, name='register'),
     path('login/', views.login, name='login'),
     path('logout/', views.logout, name='logout'),
     path('cart/', views.view_cart, name='view_cart'),
     path('cart/add/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
-    path('cart/increment/<int:item_id>/', views.increment_cart_item, name='increment_cart_item'),
-    path('cart/decrement/<int:item_id>/', views.decrement_cart_item, name='decrement_cart_item'),
-    path('cart/remove/<int:item_id>/', views.remove_cart_item, name='remove_cart_item'),
+    path('cart/increment/<int:product_id>/', views.increment_cart_item, name='increment_cart_item'),
+    path('cart/decrement/<int:product_id>/', views.decrement_cart_item, name='decrement_cart_item'),
+    path('cart/remove/<int:product_id>/', views.remove_cart_item, name='remove_cart_item'),
+    path('cart/update/', views.update_cart, name='update_cart'),
     path('wishlist/add/<int:product_id>/', views.add_to_wishlist, name='add_to_wishlist'),
     path('create-checkout-session/', views.create_checkout_session, name='create_checkout_session'),
+    path('stripe/webhook/', views.stripe_webhook, name='stripe_webhook'),
     path('success/', views.payment_success, name='payment_success'),
+    path('cancel/', views.payment_cancel, name='payment_cancel'),
     path('orders/', views.order_history, name='order_history'),
     path('orders/<int:order_id>/', views.order_detail, name='order_detail'),
     path('orders/<int:order_id>/review/', views.leave_review, name='leave_review'),
@@ -26,8 +30,11 @@ urlpatterns = [
     path('wishlists/<int:wishlist_id>/', views.wishlist_detail, name='wishlist_detail'),
     path('wishlists/<int:wishlist_id>/remove/<int:item_id>/', views.wishlist_remove_item, name='wishlist_remove_item'),
     path('wishlists/<int:wishlist_id>/add_to_cart/<int:item_id>/', views.wishlist_add_to_cart, name='wishlist_add_to_cart'),
+    path('wishlists/<int:wishlist_id>/move_to_cart/', views.wishlist_move_to_cart, name='wishlist_move_to_cart'),
     path('addresses/', views.shipping_address_list, name='shipping_address_list'),
     path('addresses/add/', views.shipping_address_add, name='shipping_address_add'),
     path('addresses/<int:address_id>/edit/', views.shipping_address_edit, name='shipping_address_edit'),
     path('addresses/<int:address_id>/delete/', views.shipping_address_delete, name='shipping_address_delete'),
+    path('stats/queries/', views.query_stats, name='query_stats'),
+    path('export/catalogue/', views.export_catalogue, name='export_catalogue'),
 ]
@@ -1,19 +1,39 @@
 from django import forms
-import os
+import hmac
+import json
+import re
+import time
 import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.contrib.auth import logout as auth_logout
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
+from django.urls import reverse
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django import forms
 from django.contrib.auth import login as auth_login
 from django.contrib import messages
 from django.core.paginator import Paginator
-from .models import Customer, Order, OrderItem, Product, Cart, CartItem, Wishlist, WishlistItem, ShippingInfo
+from django.db import router, transaction
+from django.db.models import Max, Prefetch
+from .models import Customer, Order, OrderItem, Product, CartItem, Wishlist, WishlistItem, ShippingInfo
 from django import forms
 from .models import Review
+from . import caching, catalogue, export, fulfilment, payments, querystats, ratings, recommendations, reservations
+from .cart import CartOperationError
+from .cartstore import CartStore
 from .forms import ShippingInfoForm
+from .orders import record_checkout, unit_amount
+from .facets import facet_counts
+from .pagination import CursorPaginator
+from .search import search_products
+from .wishlists import customer_wishlists, move_to_cart
 # --- Shipping Address Management Views ---
 
 @login_required
@@ -108,45 +128,150 @@ def logout(request):
     return redirect('ecommerce:product_list')
 
 
+# Catalogue sort options: (label, ordering). Every ordering ends in the
+# primary key so cursor pagination has a unique position to resume from.
+PRODUCT_SORTS = {
+    '': ('Default', ('pk',)),
+    'price': ('Price: low to high', ('price', 'pk')),
+    '-price': ('Price: high to low', ('-price', '-pk')),
+    'name': ('Name', ('name', 'pk')),
+}
+PRODUCTS_PER_PAGE = 10
+
+
+def catalogue_version(request):
+    # Cards show ratings, which change without a catalogue generation bump.
+    return catalogue.get_generation(), catalogue.get_version(ratings.VERSION_KEY)
+
+
+def catalogue_modified(request):
+    # Product.updated_at only when the cache has not seen a change yet.
+    modified = catalogue.get_generation_modified(
+        lambda: Product.objects.aggregate(latest=Max('updated_at'))['latest'])
+    rated = catalogue.get_modified(ratings.VERSION_KEY, lambda: None)
+    if modified is not None and rated is not None:
+        modified = max(modified, rated)
+    return modified
+
+
+def _recommended_ids(pk):
+    return list(recommendations.related_ids(pk)[:settings.ECOMMERCE_RECOMMENDATIONS_SHOWN])
+
+
+def product_version(request, pk):
+    # The page embeds the recommended products' cards, so their versions count too.
+    ids = [pk, *_recommended_ids(pk)]
+    versions = catalogue.get_product_versions(ids)
+    return tuple(versions[i] for i in ids)
+
+
+def product_modified(request, pk):
+    modified = catalogue.get_product_modified(
+        pk, lambda: Product.objects.filter(pk=pk).values_list('updated_at', flat=True).first())
+    for other in _recommended_ids(pk):
+        other_modified = catalogue.get_product_modified(other, lambda: None)
+        if modified is not None and other_modified is not None:
+            modified = max(modified, other_modified)
+    return modified
+
+
+# The query parameters product_list reads; cached pages ignore any others.
+CATALOGUE_QUERY = ('category', 'brand', 'search', 'sort', 'page', 'cursor')
+
+
+@caching.conditional_page(catalogue_version, catalogue_modified, CATALOGUE_QUERY)
+@caching.cache_anonymous_page(catalogue_version, CATALOGUE_QUERY)
 def product_list(request):
-    products = Product.objects.all()
-    categories = Product.objects.values_list('category', flat=True).distinct()
-    brands = Product.objects.values_list('brand', flat=True).distinct()
+    # Ratings come from the summary table (see ecommerce.ratings) in the same query.
+    products = Product.objects.select_related('rating')
 
     selected_category = request.GET.get('category', '')
     selected_brand = request.GET.get('brand', '')
     search_query = request.GET.get('search', '')
+    selected_sort = request.GET.get('sort', '')
+    if selected_sort not in PRODUCT_SORTS:
+        selected_sort = ''
+    counts = facet_counts(selected_category, selected_brand, search_query)
 
     if selected_category:
         products = products.filter(category=selected_category)
     if selected_brand:
         products = products.filter(brand=selected_brand)
+    ordering = PRODUCT_SORTS[selected_sort][1]
     if search_query:
-        products = products.filter(name__icontains=search_query)
+        products = search_products(products, search_query)
+        if not selected_sort:
+            ordering = ('search_rank', 'pk')
 
-    paginator = Paginator(products, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    context = {
-        'page_obj': page_obj,
-        'categories': categories,
-        'brands': brands,
+    # The category facet already honours the brand filter and the search, so
+    # it gives the number of matching products without a COUNT(*).
+    category_counts = dict(counts['category'])
+    if selected_category:
+        total = category_counts.get(selected_category, 0)
+    else:
+        total = sum(category_counts.values())
+
+    params = request.GET.copy()
+    params.pop('page', None)
+    params.pop('cursor', None)
+    page_range = None
+    if settings.ECOMMERCE_CATALOGUE_PAGINATION == 'cursor':
+        paginator = CursorPaginator(products, PRODUCTS_PER_PAGE, ordering)
+        page_obj = paginator.get_page(request.GET.get('cursor'), estimated_total=total)
+    else:
+        paginator = Paginator(products.order_by(*ordering), PRODUCTS_PER_PAGE)
+        page_obj = paginator.get_page(request.GET.get('page'))
+        page_range = paginator.get_elided_page_range(page_obj.number)
+    filter_context = {
+        'categories': counts['category'],
+        'brands': counts['brand'],
+        'sorts': [(value, label) for value, (label, _) in PRODUCT_SORTS.items()],
         'selected_category': selected_category,
         'selected_brand': selected_brand,
+        'selected_sort': selected_sort,
         'search_query': search_query,
     }
+    filters = caching.cached_fragment(
+        'catalogue_filters',
+        [selected_category, selected_brand, search_query, selected_sort],
+        lambda: render_to_string('ecommerce/includes/catalogue_filters.html', filter_context),
+    )
+    context = {
+        'page_obj': page_obj,
+        'page_range': page_range,
+        'cards': caching.product_cards(page_obj),
+        'filters': filters,
+        'total': total,
+        'filter_query': params.urlencode(),
+    }
     return render(request, 'ecommerce/product_list.html', context)
 
 
+@caching.conditional_page(product_version, product_modified)
+@caching.cache_anonymous_page(product_version)
 def product_detail(request, pk):
-    product = get_object_or_404(Product, pk=pk)
+    product = get_object_or_404(Product.objects.select_related('rating'), pk=pk)
     customer = None
     wishlists = None
     if request.user.is_authenticated:
         customer = Customer.objects.filter(user=request.user).first()
         if customer:
             wishlists = Wishlist.objects.filter(customer=customer)
-    return render(request, 'ecommerce/product_detail.html', {'product': product, 'wishlists': wishlists})
+    return render(request, 'ecommerce/product_detail.html', {
+        'product': product,
+        'wishlists': wishlists,
+        'recommended': caching.product_cards(recommendations.for_product(product.pk)),
+    })
+
+
+REVIEWS_PER_PAGE = 10
+
+
+def product_reviews(request, pk):
+    product = get_object_or_404(Product.objects.select_related('rating'), pk=pk)
+    reviews = Review.objects.filter(order__items__product=product).select_related('customer__user')
+    page_obj = CursorPaginator(reviews, REVIEWS_PER_PAGE, ('-pk',)).get_page(request.GET.get('cursor'))
+    return render(request, 'ecommerce/product_reviews.html', {'product': product, 'page_obj': page_obj})
 
 
 @login_required
@@ -155,34 +280,31 @@ def add_to_wishlist(request, product_id):
     product = get_object_or_404(Product, pk=product_id)
     wishlist_id = request.POST.get('wishlist_id')
     wishlist = get_object_or_404(Wishlist, id=wishlist_id, customer=customer)
-    # Prevent duplicates
-    if not WishlistItem.objects.filter(wishlist=wishlist, product=product).exists():
-        WishlistItem.objects.create(wishlist=wishlist, product=product)
+    # The (wishlist, product) unique constraint prevents duplicates.
+    _, created = WishlistItem.objects.get_or_create(wishlist=wishlist, product=product)
+    if created:
         messages.success(request, f'Added {product.name} to wishlist {wishlist.name}.')
     else:
         messages.info(request, f'{product.name} is already in wishlist {wishlist.name}.')
     return redirect('ecommerce:product_detail', pk=product_id)
 
-def get_user_cart(request):
-    if not request.user.is_authenticated:
-        return None
-    customer, _ = Customer.objects.get_or_create(user=request.user)
-    cart, _ = Cart.objects.get_or_create(customer=customer)
-    return cart
+
+def has_stock_for(request, store, product, extra=1):
+    # Advisory only: stock is held for real when checkout starts.
+    left = reservations.available([product.pk])[product.pk]
+    if store.quantities().get(product.pk, 0) + extra > left:
+        messages.error(request, f'Sorry, only {left} of {product.name} left in stock.')
+        return False
+    return True
 
 
 @require_POST
 def add_to_cart(request, product_id):
-    cart = get_user_cart(request)
-    if not cart:
-        messages.error(request, 'You must be logged in to add items to cart.')
-        return redirect('ecommerce:login')
     product = get_object_or_404(Product, pk=product_id)
-    item, created = CartItem.objects.get_or_create(cart=cart, product=product)
-    if not created:
-        item.quantity += 1
-        item.save()
-    messages.success(request, f'Added {product.name} to cart.')
+    store = CartStore.for_request(request)
+    if has_stock_for(request, store, product):
+        store.apply([{'op': 'add', 'product': product.pk}])
+        messages.success(request, f'Added {product.name} to cart.')
     # We can add to cart from the product detail page or the product list page
     # Without this the user would be taken to the product list page everytime
     # Let's use this to redirect back to whatever page the user was on (e.g from product detail page) else go back to the product list page
@@ -192,62 +314,107 @@ def add_to_cart(request, product_id):
     return redirect('ecommerce:product_list')
 
 
+def get_cart_line(request, product_id):
+    store = CartStore.for_request(request)
+    quantity = store.quantities().get(product_id)
+    if quantity is None:
+        raise Http404('No such item in your cart.')
+    return store, get_object_or_404(Product, pk=product_id), quantity
+
+
 @require_POST
-def increment_cart_item(request, item_id):
-    item = get_object_or_404(CartItem, pk=item_id,
-                             cart__customer__user=request.user)
-    item.quantity += 1
-    item.save()
-    messages.success(request, f'Increased quantity for {item.product.name}.')
+def increment_cart_item(request, product_id):
+    store, product, quantity = get_cart_line(request, product_id)
+    if has_stock_for(request, store, product):
+        store.apply([{'op': 'add', 'product': product.pk}])
+        messages.success(request, f'Increased quantity for {product.name}.')
     return redirect('ecommerce:view_cart')
 
 
 @require_POST
-def decrement_cart_item(request, item_id):
-    item = get_object_or_404(CartItem, pk=item_id,
-                             cart__customer__user=request.user)
-    if item.quantity > 1:
-        item.quantity -= 1
-        item.save()
+def decrement_cart_item(request, product_id):
+    store, product, quantity = get_cart_line(request, product_id)
+    store.apply([{'op': 'add', 'product': product.pk, 'quantity': -1}])
+    if quantity > 1:
         messages.success(
-            request, f'Decreased quantity for {item.product.name}.')
+            request, f'Decreased quantity for {product.name}.')
     else:
-        item.delete()
-        messages.success(request, f'Removed {item.product.name} from cart.')
+        messages.success(request, f'Removed {product.name} from cart.')
     return redirect('ecommerce:view_cart')
 
 
 @require_POST
-def remove_cart_item(request, item_id):
-    item = get_object_or_404(CartItem, pk=item_id,
-                             cart__customer__user=request.user)
-    item.delete()
-    messages.success(request, f'Removed {item.product.name} from cart.')
+def remove_cart_item(request, product_id):
+    store, product, quantity = get_cart_line(request, product_id)
+    store.apply([{'op': 'remove', 'product': product.pk}])
+    messages.success(request, f'Removed {product.name} from cart.')
     return redirect('ecommerce:view_cart')
 
 
-@login_required
+@require_POST
+def update_cart(request):
+    """Apply a JSON batch of cart operations (see ecommerce.cart) and return the cart."""
+    store = CartStore.for_request(request)
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Request body must be JSON.'}, status=400)
+    try:
+        store.apply(payload.get('operations') if isinstance(payload, dict) else None)
+    except CartOperationError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(store.state())
+
+
 def view_cart(request):
-    cart = get_user_cart(request)
-    items = cart.items.select_related('product') if cart else []
+    lines = CartStore.for_request(request).lines()
+    items = [CartItem(product=product, quantity=quantity) for product, quantity in lines]
     subtotal = sum(item.product.price * item.quantity for item in items)
-    return render(request, 'ecommerce/cart.html', {'cart': cart, 'items': items, 'subtotal': subtotal})
+    recommended = recommendations.for_cart([product.pk for product, _ in lines]) if lines else []
+    return render(request, 'ecommerce/cart.html', {
+        'items': items,
+        'subtotal': subtotal,
+        'recommended': caching.product_cards(recommended),
+    })
 
 # Shipping info form
 
 
 
 
-def create_checkout_session(request):
-    if not request.user.is_authenticated:
+def checkout_lines(request):
+    """Return (cart, items, reservation key) with the items' stock held; raises OutOfStock."""
+    # The cart store writes behind; Stripe is priced from the tables.
+    cart = CartStore.for_request(request).flush()
+    items = list(cart.items.select_related('product', 'cart__customer')) if cart else []
+    if not items:
+        return cart, items, None
+    with transaction.atomic():
+        reservation = reservations.reserve(cart.customer, {item.product_id: item.quantity for item in items})
+        # The webhook orders exactly these lines at these prices.
+        record_checkout(cart.customer, cart, reservation, items)
+    return cart, items, reservation
+
+
+# Stripe requires at least 30 minutes, so keep the hold TTL above 31.
+CHECKOUT_EXPIRY_MARGIN = 60
+
+
+async def create_checkout_session(request):
+    # Async so the wait on Stripe does not hold a worker thread under ASGI;
+    # see ecommerce.payments.
+    user = await request.auser()
+    if not user.is_authenticated:
         return redirect('ecommerce:login')
-    cart = get_user_cart(request)
-    items = cart.items.select_related('product') if cart else []
+    try:
+        cart, items, reservation = await sync_to_async(checkout_lines)(request)
+    except reservations.OutOfStock as e:
+        messages.error(request, f'{e}. Please update your cart.')
+        return redirect('ecommerce:view_cart')
     if not items:
         messages.error(request, 'Your cart is empty.')
         return redirect('ecommerce:view_cart')
 
-    stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
     line_items = []
     for item in items:
         line_items.append({
@@ -256,25 +423,31 @@ def create_checkout_session(request):
                 'product_data': {
                     'name': item.product.name,
                 },
-                'unit_amount': int(item.product.price * 100),
+                'unit_amount': unit_amount(item.product.price),
             },
             'quantity': item.quantity,
         })
     try:
-        session = stripe.checkout.Session.create(
+        session = await payments.create_checkout_session(
             payment_method_types=['card'],
             line_items=line_items,
             mode='payment',
+            # The webhook builds the order from this cart; see ecommerce.fulfilment.
+            client_reference_id=str(cart.pk),
+            metadata={'customer_id': cart.customer_id, 'cart_id': cart.pk, 'reservation': reservation},
+            # Stripe stops taking payment before the stock holds run out.
+            expires_at=int(time.time() + reservations.hold_ttl().total_seconds() - CHECKOUT_EXPIRY_MARGIN),
             success_url=request.build_absolute_uri('/success/') + '?session_id={CHECKOUT_SESSION_ID}',
-            cancel_url=request.build_absolute_uri('/cart/'),
+            cancel_url=request.build_absolute_uri(reverse('ecommerce:payment_cancel')) + f'?reservation={reservation}',
             shipping_address_collection={
                 'allowed_countries': ['US', 'CA', 'GB', 'AU', 'FR', 'DE', 'IN']
             },
         )
-        return redirect(session.url)
-    except Exception as e:
+    except payments.PaymentError as e:
+        await sync_to_async(reservations.release)(reservation)
         messages.error(request, f'Error creating Stripe session: {str(e)}')
-        return redirect('ecommerce:checkout')
+        return redirect('ecommerce:view_cart')
+    return redirect(session.url)
 
 # Success and cancel views
 
@@ -283,69 +456,73 @@ def payment_success(request):
     if not request.user.is_authenticated:
         return redirect('ecommerce:login')
     customer = Customer.objects.get(user=request.user)
-    cart = get_user_cart(request)
-    items = cart.items.select_related('product') if cart else []
-    if not items:
+    session_id = request.GET.get('session_id')
+    if not session_id:
         messages.error(request, 'No items found for order.')
         return redirect('ecommerce:product_list')
-    total = sum(item.product.price * item.quantity for item in items)
-    # Get Stripe session and shipping info
-    session_id = request.GET.get('session_id')
-    shipping_info = None
-    if session_id:
-        stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-        session = stripe.checkout.Session.retrieve(session_id)
-        shipping = session.shipping_details
-        if shipping:
-            address = shipping.address
-            shipping_info = ShippingInfo.objects.create(
-                customer=customer,
-                address=address.get('line1', ''),
-                city=address.get('city', ''),
-                postal_code=address.get('postal_code', ''),
-                country=address.get('country', ''),
-                phone=shipping.phone or customer.phone
-            )
-    # Create order
-    order = Order.objects.create(
-        customer=customer, total=total, status='Paid')
-    for item in items:
-        OrderItem.objects.create(
-            order=order, product=item.product, quantity=item.quantity, price=item.product.price)
-    # Link shipping info to order
-    if shipping_info:
-        shipping_info.order = order
-        shipping_info.save()
-    # Clear cart
-    cart.items.all().delete()
+    # Orders are built by the Stripe webhook (see stripe_webhook); this page
+    # only shows the result and never waits on Stripe.
+    order = (
+        Order.objects.filter(customer=customer, stripe_session_id=session_id)
+        .select_related('shippinginfo').prefetch_related('items__product').first()
+    )
+    if order is None:
+        return render(request, 'ecommerce/payment_pending.html', {'session_id': session_id})
     context = {
         'order': order,
-        'shipping_info': shipping_info,
+        'shipping_info': getattr(order, 'shippinginfo', None),
     }
     return render(request, 'ecommerce/payment_success.html', context)
 
 
 def payment_cancel(request):
+    reservation = request.GET.get('reservation')
+    if reservation and request.user.is_authenticated:
+        reservations.release(reservation, customer=Customer.objects.filter(user=request.user).first())
     messages.info(request, 'You have cancelled the payment.')
     return redirect('ecommerce:view_cart')
 
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    secret = settings.STRIPE_WEBHOOK_SECRET
+    if not secret:
+        return HttpResponse('Webhook secret is not configured.', status=503)
+    try:
+        stripe.Webhook.construct_event(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''), secret)
+        event = json.loads(request.body)
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return HttpResponse(status=400)
+    fulfilment.record_event(event)
+    return HttpResponse(status=200)
+
 # Order detail view
 @login_required
 def order_detail(request, order_id):
     customer = Customer.objects.get(user=request.user)
-    order = get_object_or_404(customer.order_set, id=order_id)
-    # Check if the user has already left a review for this order
-    has_reviewed = order.reviews.filter(customer=customer).exists()
-    return render(request, 'ecommerce/order_detail.html', {'order': order, 'has_reviewed': has_reviewed})
+    # One query for the order and its shipping row, one each for items and reviews.
+    orders = customer.order_set.select_related('shippinginfo').prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('product').order_by('pk')),
+        Prefetch('reviews', queryset=Review.objects.filter(customer=customer), to_attr='customer_reviews'),
+    )
+    order = get_object_or_404(orders, id=order_id)
+    context = {
+        'order': order,
+        'reviews': order.customer_reviews,
+        'has_reviewed': bool(order.customer_reviews),
+        'shipping_info': getattr(order, 'shippinginfo', None),
+    }
+    return render(request, 'ecommerce/order_detail.html', context)
 
 
 # --- Review Form and View ---
 class ReviewForm(forms.ModelForm):
+    rating = forms.IntegerField(min_value=1, max_value=5, widget=forms.NumberInput(attrs={'min': 1, 'max': 5}))
+
     class Meta:
         model = Review
         fields = ['rating', 'comment']
         widgets = {
-            'rating': forms.NumberInput(attrs={'min': 1, 'max': 5}),
             'comment': forms.Textarea(attrs={'rows': 3}),
         }
 
@@ -370,20 +547,25 @@ def leave_review(request, order_id):
         form = ReviewForm()
     return render(request, 'ecommerce/leave_review.html', {'form': form, 'order': order})
 # Order history view
+ORDERS_PER_PAGE = 20
 
 
 @login_required
 def order_history(request):
     customer = Customer.objects.get(user=request.user)
-    orders = customer.order_set.order_by('-created_at').prefetch_related('items__product')
-    return render(request, 'ecommerce/order_history.html', {'orders': orders})
+    # Seeks on the (customer, created_at, id) index and reads only the
+    # summary stored on each order, never its items.
+    orders = customer.order_set.only(
+        'id', 'customer_id', 'created_at', 'status', 'total', 'item_count', 'first_product_name', 'thumbnail',
+    )
+    page_obj = CursorPaginator(orders, ORDERS_PER_PAGE, ('-created_at', '-pk')).get_page(request.GET.get('cursor'))
+    return render(request, 'ecommerce/order_history.html', {'orders': page_obj, 'page_obj': page_obj})
 
 # --- Wishlist Management Views ---
 @login_required
 def wishlist_list(request):
     customer = get_object_or_404(Customer, user=request.user)
-    wishlists = Wishlist.objects.filter(customer=customer)
-    return render(request, 'ecommerce/wishlist_list.html', {'wishlists': wishlists})
+    return render(request, 'ecommerce/wishlist_list.html', {'wishlists': customer_wishlists(customer)})
 
 @login_required
 def wishlist_create(request):
@@ -441,16 +623,88 @@ def wishlist_remove_item(request, wishlist_id, item_id):
         return redirect('ecommerce:wishlist_detail', wishlist_id=wishlist.id)
     return redirect('ecommerce:wishlist_detail', wishlist_id=wishlist.id)
 
+def _report_move(request, moved, skipped):
+    if moved:
+        noun = 'item' if len(moved) == 1 else 'items'
+        messages.success(request, f'Moved {len(moved)} {noun} to your cart.')
+    if skipped:
+        messages.error(request, f'Not enough stock to move: {", ".join(skipped)}.')
+
+
 @login_required
+@require_POST
 def wishlist_add_to_cart(request, wishlist_id, item_id):
     wishlist = get_object_or_404(Wishlist, id=wishlist_id, customer__user=request.user)
     item = get_object_or_404(WishlistItem, id=item_id, wishlist=wishlist)
-    customer = get_object_or_404(Customer, user=request.user)
-    cart, _ = Cart.objects.get_or_create(customer=customer)
-    cart_item, created = CartItem.objects.get_or_create(cart=cart, product=item.product)
-    if not created:
-        cart_item.quantity += 1
-        cart_item.save()
-    item.delete()
-    messages.success(request, f'Item added to cart and removed from wishlist.')
-    return redirect('ecommerce:wishlist_detail', wishlist_id=wishlist.id)
\ No newline at end of file
+    _report_move(request, *move_to_cart(wishlist, CartStore.for_request(request), [item.pk]))
+    return redirect('ecommerce:wishlist_detail', wishlist_id=wishlist.id)
+
+
+@login_required
+@require_POST
+def wishlist_move_to_cart(request, wishlist_id):
+    """Move the checked items (``item`` fields), or every item with ``all``, to the cart."""
+    wishlist = get_object_or_404(Wishlist, id=wishlist_id, customer__user=request.user)
+    item_ids = None
+    if 'all' not in request.POST:
+        item_ids = [int(pk) for pk in request.POST.getlist('item') if pk.isdigit()]
+        if not item_ids:
+            messages.info(request, 'Select the items to move to your cart.')
+            return redirect('ecommerce:wishlist_detail', wishlist_id=wishlist.id)
+    _report_move(request, *move_to_cart(wishlist, CartStore.for_request(request), item_ids))
+    return redirect('ecommerce:wishlist_detail', wishlist_id=wishlist.id)
+
+
+# --- Instrumentation ---
+@staff_member_required
+def query_stats(request):
+    try:
+        minutes = int(request.GET.get('minutes', querystats.WINDOW_MINUTES))
+    except ValueError:
+        minutes = querystats.WINDOW_MINUTES
+    return JsonResponse({
+        'views': querystats.collect(minutes),
+        'cache': caching.get_stats(),
+    })
+
+
+# --- Export ---
+def _export_allowed(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and any(
+        hmac.compare_digest(token.encode(), allowed.encode()) for allowed in settings.ECOMMERCE_EXPORT_TOKENS
+    )
+
+
+def export_catalogue(request):
+    """
+    Stream the catalogue (see ecommerce.export). Query parameters: ``format``
+    (jsonl or csv), ``since`` (ISO date or datetime), ``stock`` and
+    ``ratings`` (1 to include). Gzipped when the client accepts it.
+    """
+    if not _export_allowed(request):
+        return JsonResponse({'error': 'Staff login or an export token is required.'}, status=403)
+    fmt = request.GET.get('format', 'jsonl')
+    if fmt not in export.FORMATS:
+        return JsonResponse({'error': f'format must be one of {", ".join(export.FORMATS)}.'}, status=400)
+    try:
+        since = export.parse_since(request.GET['since']) if request.GET.get('since') else None
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    started = export.started_at()
+    # Chosen now: the rows are read after ReplicaMiddleware has returned.
+    using = router.db_for_read(Product)
+    chunks = export.lines(fmt, since, request.GET.get('stock') == '1', request.GET.get('ratings') == '1', using)
+    compress = re.search(r'\bgzip\b', request.headers.get('Accept-Encoding', '')) is not None
+    response = StreamingHttpResponse(export.gzipped(chunks) if compress else chunks,
+                                     content_type=f'{export.CONTENT_TYPES[fmt]}; charset=utf-8')
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'private, no-store'
+    response['Content-Disposition'] = f'attachment; filename="catalogue.{fmt}"'
+    # Pass this back as ?since= to fetch what changed meanwhile.
+    response['X-Export-As-Of'] = started.isoformat()
+    return response
@@ -0,0 +1,61 @@
+"""
+Wishlist listing and moving items to the cart.
+
+``customer_wishlists`` returns a customer's wishlists with their item count
+and the newest ``PREVIEW_ITEMS`` products in a fixed number of queries: the
+count is an annotation and the previews one sliced prefetch (a window
+function), so the page costs the same with two wishlists or two hundred.
+
+``move_to_cart`` moves any number of items in one transaction: one query for
+the items, one for available stock, a single DELETE for the moved items and
+the cart change as batched operations on the cart tables (see
+``ecommerce.cart``). The cached cart is written through for this (see
+``CartStore.writing_through``), so the wishlist and the cart commit or roll
+back together. Items whose product has no stock left stay in the wishlist,
+as the single add-to-cart buttons refuse them.
+"""
+from django.db.models import Count, Prefetch
+
+from . import cart, reservations
+from .models import Wishlist, WishlistItem
+
+PREVIEW_ITEMS = 4
+
+
+def customer_wishlists(customer):
+    previews = (WishlistItem.objects.select_related('product')
+                .only('wishlist_id', 'product__name', 'product__image', 'product__image_variants')
+                .order_by('-added_at', '-pk')[:PREVIEW_ITEMS])
+    return (Wishlist.objects.filter(customer=customer)
+            .annotate(item_count=Count('items'))
+            .prefetch_related(Prefetch('items', queryset=previews, to_attr='preview_items'))
+            .order_by('pk'))
+
+
+def move_to_cart(wishlist, store, item_ids=None):
+    """
+    Move the wishlist's items (all, or those in ``item_ids``) to a signed-in
+    shopper's CartStore, one unit each. Returns (moved, skipped) lists of
+    product names.
+    """
+    items = wishlist.items.order_by('pk').values_list('pk', 'product_id', 'product__name')
+    if item_ids is not None:
+        items = items.filter(pk__in=item_ids)
+    items = list(items)
+    if not items:
+        return [], []
+    in_cart = store.quantities()
+    left = reservations.available([product_id for _, product_id, _ in items])
+    moving, skipped = [], []
+    for pk, product_id, name in items:
+        if in_cart.get(product_id, 0) < left[product_id]:
+            moving.append((pk, product_id, name))
+        else:
+            skipped.append(name)
+    if moving:
+        operations = [{'op': 'add', 'product': product_id} for _, product_id, _ in moving]
+        with store.writing_through() as cart_row:
+            WishlistItem.objects.filter(pk__in=[pk for pk, _, _ in moving]).delete()
+            for start in range(0, len(operations), cart.MAX_OPERATIONS):
+                cart.apply_operations(cart_row, operations[start:start + cart.MAX_OPERATIONS])
+    return [name for _, _, name in moving], skipped
@@ -34,6 +34,7 @@ ALLOWED_HOSTS = []
 import os
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY', '')
 STRIPE_PUBLISHABLE_KEY = os.environ.get('STRIPE_PUBLISHABLE_KEY', '')
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')
 
 INSTALLED_APPS = [
     'ecommerce.apps.EcommerceConfig',
@@ -46,6 +47,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it also counts the session and auth queries of later middleware.
+    'ecommerce.middleware.QueryInstrumentationMiddleware',
+    'ecommerce.routing.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -86,6 +90,30 @@ DATABASES = {
     }
 }
 
+# SQLite production profile (see ecommerce.dbprofile): connections are reused
+# for CONN_MAX_AGE seconds and checked before reuse, write transactions take
+# the write lock when they begin so they wait for it (busy timeout) instead of
+# failing with "database is locked", and ECOMMERCE_SQLITE_PRAGMAS below are
+# set on each new connection. DB_PROFILE=basic restores Django's defaults.
+DB_PROFILE = os.environ.get('DB_PROFILE', 'production')
+if DB_PROFILE == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+    })
+
+# Read replicas (see ecommerce.routing). Set DB_REPLICA to a second SQLite file
+# to try it locally; `manage.py sync_replicas` copies the primary into it.
+if os.environ.get('DB_REPLICA'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['DB_REPLICA'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['ecommerce.routing.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -122,6 +150,44 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# collectstatic fingerprints every file (name.<hash>.css) and writes .gz/.br
+# copies next to it; see ecommerce.assets. Without a web server in front,
+# mysite.urls serves them with far-future cache headers.
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'ecommerce.assets.CompressedManifestStaticFilesStorage'},
+}
+
+# Uploaded product images and their variants; mysite.urls serves them when no
+# web server sits in front, variants with far-future cache headers (see
+# ecommerce.images.serve).
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Catalogue caches are invalidated by bumping counters in this cache, so every
+# worker process must share it: set CACHE_DIR to use the file-based backend
+# when running more than one process.
+
+if os.environ.get('CACHE_DIR'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ['CACHE_DIR'],
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'ecommerce',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -130,3 +196,69 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Redirect unauthenticated users to ecommerce login page
 LOGIN_URL = '/login/'
+
+# Product search backend: 'auto' uses the SQLite FTS5 index when the migration
+# created it and the in-process index otherwise; 'fts5' or 'python' force one.
+ECOMMERCE_SEARCH_BACKEND = 'auto'
+
+# How long a reverse proxy may serve anonymous catalogue and product pages
+# before revalidating them; browsers always revalidate (ETag/Last-Modified).
+ECOMMERCE_SHARED_CACHE_SECONDS = 60
+
+# Bearer tokens that may download /export/catalogue/ (ecommerce.export), from
+# a comma-separated EXPORT_TOKENS; staff can always use it.
+ECOMMERCE_EXPORT_TOKENS = [token for token in os.environ.get('EXPORT_TOKENS', '').split(',') if token]
+
+# Catalogue pagination: 'cursor' pages by key with opaque next/previous tokens,
+# so deep pages cost the same as the first; 'page' uses numbered pages.
+ECOMMERCE_CATALOGUE_PAGINATION = 'cursor'
+
+# Order fulfilment for Stripe webhooks: 'background' builds orders on a worker
+# thread after the webhook is acknowledged, 'inline' before responding.
+# Events left unprocessed are retried by `manage.py process_stripe_events`.
+ECOMMERCE_FULFILMENT = 'background'
+
+# Product image variants (ecommerce.images): widths in pixels, each saved as
+# JPEG and WebP. 'background' builds them on a worker pool after an upload,
+# 'inline' before the save returns; `manage.py build_product_images` backfills.
+ECOMMERCE_IMAGE_WIDTHS = [320, 640, 1280]
+ECOMMERCE_IMAGE_PROCESSING = 'background'
+
+# "Frequently bought together" (ecommerce.recommendations): products shown on
+# product and cart pages, and the half-life in days with which an order's
+# weight decays when `manage.py build_recommendations` rebuilds them.
+ECOMMERCE_RECOMMENDATIONS_SHOWN = 4
+ECOMMERCE_RECOMMENDATION_HALF_LIFE_DAYS = 90
+
+# Stripe client used during checkout (ecommerce.payments): keep-alive
+# connection pool per process, connect and read timeouts in seconds, and the
+# retries the Stripe SDK makes. Unset keys use ecommerce.payments.DEFAULTS.
+ECOMMERCE_STRIPE_CLIENT = {
+    'CONNECT_TIMEOUT': 3.0,
+    'TIMEOUT': 10.0,
+    'MAX_RETRIES': 2,
+    'MAX_CONNECTIONS': 20,
+}
+
+# How long checkout holds stock, in seconds; Stripe sessions expire a minute
+# earlier. Expired holds are released by `manage.py sweep_reservations`.
+ECOMMERCE_RESERVATION_TTL = 35 * 60
+
+# Database aliases that GET requests may read the catalogue and order history
+# from (ecommerce.routing). After a request writes, that browser reads from the
+# primary for ECOMMERCE_PRIMARY_STICKY_SECONDS so it sees its own changes.
+ECOMMERCE_DB_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+ECOMMERCE_PRIMARY_STICKY_SECONDS = 5
+
+# PRAGMAs set on every new SQLite connection (ecommerce.dbprofile): WAL so
+# readers and the writer stop blocking each other, NORMAL sync (never corrupt
+# with WAL; a power cut can lose the last commits), and memory-mapped I/O plus
+# a larger page cache (negative = KiB). The busy timeout is the 'timeout'
+# option above, so it is set in one place only.
+ECOMMERCE_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+} if DB_PROFILE == 'production' else {}
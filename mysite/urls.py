@@ -14,10 +14,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path
 
+from ecommerce import assets, images
+
 urlpatterns = [
     path('', include('ecommerce.urls')),
     path('admin/', admin.site.urls),
+    # Collected static files; under DEBUG runserver serves them from the apps first.
+    path(f"{settings.STATIC_URL.strip('/')}/<path:path>", assets.serve),
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", images.serve),
 ]